@@ -1,42 +1,151 @@
-import os
+"""Warbler web app.
+
+`create_app(config)` builds and configures an app. Importing this module
+doesn't create one; `app.app` is a default app made on first access, for
+`flask run`, `gunicorn app:app` and the tests.
+
+Heavy modules (forms, numpy via graph_snapshot) are imported by the views
+that need them, so workers start quickly. With `gunicorn --preload`,
+`create_app` leaves no open database connections behind for forked
+workers to share, and models.py replaces any that a worker inherits
+anyway.
+"""
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import os
+import pickle
+from datetime import datetime
+
+import click
+from flask import (Blueprint, Flask, current_app, render_template, request,
+                   flash, redirect, session, g, abort, Response,
+                   stream_with_context)
+from flask.cli import with_appcontext
 # from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 from urllib.parse import urlparse
 
-from forms import UserAddForm, LoginForm, MessageForm, EditProfile
-from models import db, connect_db, User, Message, Likes
+import archive
+import assets
+import avatars
+import compression
+import export
+import jobs
+import like_counts
+import likes_migration
+import live
+import loader
+import metrics
+import overload
+import paging
+import parallel
+import search
+import sharding
+import tags
+import trending
+from author_cache import author_cards
+from cache import cache
+from loader import loaders
+from models import (db, connect_db, User, Message, Likes, Follows,
+                    UserDeletion, GraphChange)
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+bp = Blueprint('warbler', __name__)
+
+
+def create_app(config=None):
+    """Create the Warbler app; `config` overrides the defaults."""
+
+    app = Flask(__name__)
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+    app.config['GRAPH_SNAPSHOT_PATH'] = os.environ.get(
+        'GRAPH_SNAPSHOT_PATH', 'instance/follows.graph')
+    app.config['ARCHIVE_DIR'] = os.environ.get('ARCHIVE_DIR',
+                                               'instance/archive')
+    app.config['PARALLEL_READS'] = os.environ.get('PARALLEL_READS', 'auto')
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
+    if config:
+        app.config.update(config)
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+    # toolbar = DebugToolbarExtension(app)
 
-# toolbar = DebugToolbarExtension(app)
+    connect_db(app)
+    cache.init_app(app)
+    author_cards.init_app(app)
+    assets.init_app(app)
+    avatars.init_app(app)
+    compression.init_app(app)
+    live.init_app(app)
+    parallel.init_app(app)
+    metrics.init_app(app)
+    overload.init_app(app)
+    like_counts.init_app(app)
+    sharding.init_app(app)
+    loader.init_app(app)
+    tags.init_app(app)
+    jobs.init_app(app)
 
-connect_db(app)
+    app.register_blueprint(bp)
+    for command in CLI_COMMANDS:
+        app.cli.add_command(command)
+
+    # nothing above should have connected, but if it did, don't let a
+    # preloading master hand its connections to forked workers
+    with app.app_context():
+        db.engine.dispose()
+
+    return app
+
+
+def portable_config(app):
+    """`app`'s config, for `create_app` in another process to start from.
+
+    Leaves out values that can't be pickled.
+    """
+
+    config = {}
+    for key, value in app.config.items():
+        try:
+            pickle.dumps(value)
+        except Exception:
+            continue
+        config[key] = value
+    return config
+
+
+def __getattr__(name):
+    """Create the default app the first time `app.app` is used."""
+
+    global app
+
+    if name == 'app':
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = (User.query
+                  .filter(User.id == session[CURR_USER_KEY],
+                          User.not_deleting())
+                  .first())
 
     else:
         g.user = None
@@ -55,7 +164,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -67,15 +176,25 @@ def signup():
     and re-present form.
     """
 
+    from forms import UserAddForm
+
     form = UserAddForm()
 
     if form.validate_on_submit():
+        image_url = form.image_url.data or User.image_url.default.arg
+        if form.image_file.data:
+            try:
+                image_url = avatars.save_upload(form.image_file.data, 'avatar')
+            except ValueError as e:
+                form.image_file.errors.append(str(e))
+                return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
                 password=form.password.data,
                 email=form.email.data,
-                image_url=form.image_url.data or User.image_url.default.arg,
+                image_url=image_url,
             )
             db.session.commit()
 
@@ -91,10 +210,12 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
+    from forms import LoginForm
+
     form = LoginForm()
 
     if form.validate_on_submit():
@@ -111,7 +232,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """Handle logout of user."""
 
@@ -123,7 +244,29 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+def count_queries(user_id):
+    """Callables counting a user's messages, following, followers and likes.
+
+    Pass them to parallel.gather and the results to `counts_dict`.
+    """
+
+    return [
+        lambda: Message.query.filter_by(user_id=user_id).count(),
+        lambda: Follows.query.filter_by(user_following_id=user_id).count(),
+        lambda: (Follows.query
+                 .filter_by(user_being_followed_id=user_id).count()),
+        lambda: Likes.query.filter_by(user_id=user_id).count(),
+    ]
+
+
+def counts_dict(values):
+    """Name the results of `count_queries` for the templates."""
+
+    return dict(zip(('messages', 'following', 'followers', 'likes'), values))
+
+
+@bp.route('/users')
+@overload.shed_when_overloaded
 def list_users():
     """Page with listing of users.
 
@@ -137,27 +280,46 @@ def list_users():
     else:
         users = User.query.filter(User.username.like(f"%{search}%")).all()
 
+    if g.user:
+        loaders.follows.prime((g.user.id, user.id) for user in users)
+
     return render_template('users/index.html', users=users)
 
 
-@app.route('/users/<int:user_id>')
+@bp.route('/users/<int:user_id>')
+@overload.stale_while_overloaded
 def users_show(user_id):
     """Show user profile."""
 
     user = User.query.get_or_404(user_id)
+    # nothing to write; give the connection back while the reads run
+    db.session.commit()
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    messages, *counts = parallel.gather(
+        lambda: (Message
+                 .query
+                 .filter(Message.user_id == user_id)
+                 .order_by(Message.timestamp.desc())
+                 .limit(100)
+                 .all()),
+        *count_queries(user_id))
+
+    import graph_snapshot
+
+    # how many people the viewer follows also follow this user
+    followed_by = None
+    snapshot = graph_snapshot.get_snapshot(current_app)
+    if g.user and g.user.id != user_id and snapshot:
+        followed_by = len(snapshot.followed_by_following(g.user.id, user_id))
+
+    return render_template('users/show.html', user=user, messages=messages,
+                           counts=counts_dict(counts),
+                           followed_by=followed_by)
 
 
-@app.route('/users/<int:user_id>/following')
+@bp.route('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -166,10 +328,14 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    db.session.commit()
+    counts = counts_dict(parallel.gather(*count_queries(user_id)))
+    following = loaders.following_of(user_id, viewer_id=g.user.id)
+    return render_template('users/following.html', user=user, counts=counts,
+                           following=following)
 
 
-@app.route('/users/<int:user_id>/followers')
+@bp.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -178,10 +344,14 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    db.session.commit()
+    counts = counts_dict(parallel.gather(*count_queries(user_id)))
+    followers = loaders.followers_of(user_id, viewer_id=g.user.id)
+    return render_template('users/followers.html', user=user, counts=counts,
+                           followers=followers)
 
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -191,6 +361,8 @@ def add_follow(follow_id):
     if g.user.id != follow_id:
         followed_user = User.query.get_or_404(follow_id)
         g.user.following.append(followed_user)
+        db.session.add(GraphChange(follower_id=g.user.id,
+                                   followed_id=follow_id, added=True))
         db.session.commit()
         return redirect(f"/users/{g.user.id}/following")
     else:
@@ -202,7 +374,7 @@ def add_follow(follow_id):
         return redirect(f"{path}")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@bp.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -212,12 +384,14 @@ def stop_following(follow_id):
 
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
+    db.session.add(GraphChange(follower_id=g.user.id,
+                               followed_id=follow_id, added=False))
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/add_like/<int:message_id>', methods=['POST'])
+@bp.route('/users/add_like/<int:message_id>', methods=['POST'])
 def like_message(message_id):
     """Have a currently-logged-in-user like a message"""
     if not g.user:
@@ -226,8 +400,15 @@ def like_message(message_id):
 
     msg = Message.query.get_or_404(message_id)
     if g.user.id != msg.user_id:
-        liked_message = Likes(user_id=g.user.id, message_id=message_id)
-        db.session.add(liked_message)
+        try:
+            with db.session.begin_nested():
+                db.session.add(Likes(user_id=g.user.id, message_id=message_id))
+        except IntegrityError:
+            # liked already (maybe by a double click)
+            pass
+        else:
+            trending.record_like(message_id)
+            like_counts.record_like(message_id)
         db.session.commit()
     else:
         flash("You can only like posts created by other users.", "info")
@@ -239,17 +420,20 @@ def like_message(message_id):
     return redirect(f"{path}")
 
 
-@app.route('/users/remove_like/<int:message_id>', methods=['POST'])
+@bp.route('/users/remove_like/<int:message_id>', methods=['POST'])
 def remove_like(message_id):
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/login")
 
-    unlike = Likes.query.filter_by(
-        user_id=g.user.id, message_id=message_id).first()
-    db.session.delete(unlike)
-    db.session.commit()
+    unliked = (Likes.query
+               .filter_by(user_id=g.user.id, message_id=message_id)
+               .delete(synchronize_session=False))
+    if unliked:
+        trending.record_like(message_id, -1)
+        like_counts.record_like(message_id, -1)
+        db.session.commit()
 
     # return user to the page they were previously on
     referer = request.headers.get('Referer')
@@ -258,33 +442,89 @@ def remove_like(message_id):
     return redirect(f"{path}")
 
 
-@app.route('/users/<int:user_id>/likes')
+@bp.route('/users/<int:user_id>/likes')
 def likes_detail(user_id):
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/login")
 
-    return render_template("/users/likes.html", user=g.user)
+    user_id = g.user.id
+    db.session.commit()
+    counts = counts_dict(parallel.gather(*count_queries(user_id)))
+    liked = loaders.liked_by(user_id)
+    authors = author_cards.get_many(msg.user_id for msg in liked)
+    return render_template("/users/likes.html", user=g.user, authors=authors,
+                           counts=counts, liked=liked)
+
+
+@bp.route('/users/<int:user_id>/export/<dataset>.<fmt>')
+def export_data(user_id, dataset, fmt):
+    """Download your messages, likes or follows as CSV or NDJSON.
 
+    The file is streamed as it's read, so big accounts don't need to fit
+    in memory.
+    """
 
-@app.route('/users/profile', methods=["GET", "POST"])
+    if not g.user or g.user.id != user_id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    progress = export.ExportProgress()
+    try:
+        chunks = export.export(user_id, dataset, fmt, progress)
+    except ValueError:
+        abort(404)
+
+    logger = current_app.logger
+
+    def generate():
+        yield from chunks
+        logger.info(f"exported {dataset}.{fmt} for user #{user_id}: "
+                    f"{progress}")
+
+    filename = f"warbler-{g.user.username}-{dataset}.{fmt}"
+    return Response(stream_with_context(generate()),
+                    mimetype=export.FORMATS[fmt],
+                    headers={'Content-Disposition':
+                             f'attachment; filename="{filename}"'})
+
+
+@bp.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
     if not g.user:
         flash("Access unauthorized", "danger")
         return redirect("/")
 
+    from forms import EditProfile
+
     form = EditProfile()
 
     if form.validate_on_submit():
         if User.authenticate(g.user.username, form.password.data):
+            uploads = {}
+            try:
+                if form.image_file.data:
+                    uploads['image_url'] = avatars.save_upload(
+                        form.image_file.data, 'avatar')
+                if form.header_image_file.data:
+                    uploads['header_image_url'] = avatars.save_upload(
+                        form.header_image_file.data, 'header')
+            except ValueError as e:
+                flash(str(e), "danger")
+                return render_template("users/edit.html", form=form)
+
             for key, value in form.data.items():
-                if key != 'csrf_token' and key != 'password':
+                if key not in ('csrf_token', 'password', 'image_file',
+                               'header_image_file'):
                     if value != "":
                         setattr(g.user, key, value)
+            for key, value in uploads.items():
+                setattr(g.user, key, value)
             db.session.add(g.user)
             db.session.commit()
+            author_cards.invalidate(g.user.id)
             flash(f"{form.username.data}'s profile successfully updated", "success")
             return redirect(f"/users/{g.user.id}")
         else:
@@ -292,7 +532,7 @@ def profile():
     return render_template("users/edit.html", form=form)
 
 
-@app.route('/users/delete', methods=["POST"])
+@bp.route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
 
@@ -300,10 +540,16 @@ def delete_user():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    user_id = g.user.id
     do_logout()
 
-    db.session.delete(g.user)
+    # a heavy account can take a while; the job resumes if interrupted,
+    # and meanwhile the account can't be logged into
+    User.start_deletion(user_id)
+    jobs.enqueue('delete-user', dict(user_id=user_id),
+                 key=f'delete-user:{user_id}')
     db.session.commit()
+    author_cards.invalidate(user_id)
 
     return redirect("/signup")
 
@@ -311,7 +557,7 @@ def delete_user():
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -322,27 +568,64 @@ def messages_add():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    from forms import MessageForm
+
     form = MessageForm()
 
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        jobs.enqueue('index-message', dict(message_id=msg.id))
         db.session.commit()
 
+        if current_app.config['LIVE_UPDATES']:
+            # push the new warble to followers watching their timelines
+            authors = author_cards.get_many([g.user.id])
+            html = render_template('messages/_timeline_item.html', msg=msg,
+                                   authors=authors, likes=[])
+            live.broker.publish(live.author_channel(g.user.id),
+                                dict(message_id=msg.id, html=html))
+
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@bp.route('/timeline/stream')
+def timeline_stream():
+    """Stream new warbles from followed users as Server-Sent Events."""
+
+    if not current_app.config['LIVE_UPDATES']:
+        abort(404)
+    if not g.user:
+        abort(401)
+
+    followed_ids = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == g.user.id))
+    subscription = live.broker.subscribe(
+        live.author_channel(user_id) for (user_id,) in followed_ids)
+
+    stream = live.event_stream(subscription,
+                               current_app.config['LIVE_HEARTBEAT_SECONDS'])
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no'})
+
+
+@bp.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = (Message.query.get(message_id)
+           or archive.find_archived_message(message_id))
+    if msg is None:
+        abort(404)
+
     return render_template('messages/show.html', message=msg)
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@bp.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -351,41 +634,413 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    search.unindex_messages([msg.id])
+    tags.unindex_messages([msg.id])
     db.session.delete(msg)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}")
 
 
+@bp.route('/messages/search')
+@overload.shed_when_overloaded
+def messages_search():
+    """Search message text; `cursor` continues from a previous page."""
+
+    query = request.args.get('q', '')
+    try:
+        page = search.search(query, request.args.get('cursor'))
+    except ValueError:
+        abort(400)
+
+    authors = author_cards.get_many(
+        result.message.user_id for result in page.results)
+    return render_template('messages/search.html', query=query, page=page,
+                           authors=authors)
+
+
+@bp.route('/tags/<tag>')
+def tag_timeline(tag):
+    """Messages tagged #tag, newest first."""
+
+    try:
+        messages, before = tags.tag_timeline(tag, request.args.get('before'))
+    except ValueError:
+        abort(400)
+
+    return render_timeline(f"#{tag.lower()}", messages, before)
+
+
+@bp.route('/users/<int:user_id>/mentions')
+def mention_timeline(user_id):
+    """Messages mentioning a user, newest first."""
+
+    user = User.query.get_or_404(user_id)
+    try:
+        messages, before = tags.mention_timeline(user_id,
+                                                 request.args.get('before'))
+    except ValueError:
+        abort(400)
+
+    return render_timeline(f"Mentioning @{user.username}", messages, before)
+
+
+def render_timeline(title, messages, before):
+    """Render a page of a tag or mention timeline."""
+
+    likes = []
+    if g.user and messages:
+        likes = [message_id for (message_id,) in (db.session
+                 .query(Likes.message_id)
+                 .filter(Likes.user_id == g.user.id,
+                         Likes.message_id.in_([msg.id for msg in messages])))]
+    authors = author_cards.get_many(msg.user_id for msg in messages)
+    return render_template('messages/timeline.html', title=title,
+                           messages=messages, likes=likes, authors=authors,
+                           before=before)
+
+
+@bp.route('/trending')
+def messages_trending():
+    """Show the messages with the most recent likes."""
+
+    top = trending.trending_messages()
+    authors = author_cards.get_many(item.message.user_id for item in top)
+    return render_template('messages/trending.html', trending=top,
+                           authors=authors)
+
+
 ##############################################################################
 # Homepage and error pages
 
 
-@app.route('/')
+@bp.route('/')
+@overload.stale_while_overloaded
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, with a
+      `before` cursor for older pages
     """
 
     if g.user:
-        following = [user_id.id for user_id in g.user.following]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        user_likes = Likes.query.filter_by(user_id=g.user.id)
-        likes = [like.message_id for like in user_likes]
-
-        return render_template('home.html', messages=messages, likes=likes)
+        user_id = g.user.id
+        following = (db.select([Follows.user_being_followed_id])
+                     .where(Follows.user_following_id == user_id))
+        before = request.args.get('before')
+        if before:
+            # check it here, not in a worker thread
+            try:
+                paging.decode_cursor(before)
+            except ValueError:
+                abort(400)
+
+        # nothing to write; give the connection back while the reads run
+        db.session.commit()
+
+        # none of these depend on each other, so they can run concurrently
+        (messages, before), likes, suggestions, *counts = parallel.gather(
+            lambda: paging.keyset_page(
+                Message.query.filter(Message.user_id.in_(following)),
+                Message.timestamp, Message.id, before),
+            lambda: [message_id for (message_id,) in (db.session
+                     .query(Likes.message_id)
+                     .filter(Likes.user_id == user_id))],
+            lambda: User.query.get(user_id).suggestions(),
+            *count_queries(user_id))
+        authors = author_cards.get_many(msg.user_id for msg in messages)
+
+        return render_template('home.html', messages=messages, likes=likes,
+                               authors=authors, suggestions=suggestions,
+                               counts=counts_dict(counts), before=before)
 
     else:
         return render_template('home-anon.html')
 
 
+##############################################################################
+# Background jobs (see jobs.py)
+
+
+@jobs.task('delete-user')
+def delete_user_job(user_id):
+    """Delete an account and everything in it."""
+
+    User.bulk_delete(user_id, before_chunk=jobs.heartbeat)
+
+
+@jobs.task('index-message')
+def index_message_job(message_id):
+    """Add a new message to search results and tag and mention pages."""
+
+    msg = Message.query.get(message_id)
+    if msg is None:
+        # deleted before we got to it
+        return
+
+    # start clean, in case an earlier attempt got part way
+    search.unindex_messages([message_id])
+    tags.unindex_messages([message_id])
+    search.index_messages([msg])
+    tags.index_messages([msg])
+
+
+##############################################################################
+# CLI commands
+
+
+@click.command('resume-deletions')
+@with_appcontext
+def resume_deletions():
+    """Finish account deletions that were interrupted part way through."""
+
+    pending = UserDeletion.query.filter_by(finished_at=None).all()
+    for record in pending:
+        record = User.bulk_delete(record.user_id)
+        print(f"user #{record.user_id}: "
+              f"{record.messages_deleted} messages deleted")
+
+
+@click.command('build-assets')
+@with_appcontext
+def build_assets():
+    """Fingerprint, compress and resize everything under static/."""
+
+    manifest = assets.build_assets(current_app.static_folder)
+    print(f"built {len(manifest)} assets into static/{assets.DIST_DIR}/")
+
+
+@click.command('compute-suggestions')
+@with_appcontext
+def compute_suggestions():
+    """Recompute who-to-follow suggestions for every user."""
+
+    import suggestions
+
+    saved = suggestions.refresh_suggestions()
+    print(f"saved {saved} suggestions")
+
+
+@click.command('refresh-trending')
+@with_appcontext
+def refresh_trending():
+    """Recompute the trending list and drop expired like buckets."""
+
+    count = trending.refresh_trending()
+    print(f"{count} trending messages")
+
+
+@click.command('export-graph')
+@with_appcontext
+def export_graph():
+    """Write or incrementally update the follows graph snapshot."""
+
+    import graph_snapshot
+
+    path = current_app.config['GRAPH_SNAPSHOT_PATH']
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    edges = graph_snapshot.export_snapshot(path)
+    print(f"{edges} edges in {path}")
+
+
+@click.command('archive-messages')
+@with_appcontext
+@click.argument('before')
+def archive_messages(before):
+    """Move whole months of messages older than BEFORE (YYYY-MM-DD) to
+    cold storage."""
+
+    cutoff = datetime.strptime(before, '%Y-%m-%d')
+    partitions = archive.archive_messages(cutoff,
+                                          current_app.config['ARCHIVE_DIR'])
+    for partition in partitions:
+        print(f"{partition.name}: {partition.row_count} messages -> "
+              f"{partition.path}")
+
+
+@click.command('export-user')
+@click.argument('user_id', type=int)
+@click.option('--dataset', default='account',
+              help="messages, likes, following, followers or account "
+                   "(everything; NDJSON only)")
+@click.option('--format', 'fmt', type=click.Choice(sorted(export.FORMATS)),
+              default='ndjson')
+@click.option('--output', '-o', type=click.File('w'), default='-')
+@with_appcontext
+def export_user(user_id, dataset, fmt, output):
+    """Stream a user's data to OUTPUT (stdout by default)."""
+
+    progress = export.ExportProgress(
+        report=lambda p: click.echo(f"  {p}", err=True))
+    try:
+        chunks = export.export(user_id, dataset, fmt, progress)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+    for data in chunks:
+        output.write(data)
+    click.echo(f"exported {progress}", err=True)
+
+
+@click.command('import-messages')
+@click.argument('source', type=click.File('r'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']),
+              help="Input format; guessed from the file name by default.")
+@click.option('--workers', type=int,
+              help="Worker processes loading batches in parallel "
+                   "[one per CPU on Postgres, else 1].")
+@click.option('--batch-size', type=int,
+              help="Rows per transaction.")
+@click.option('--dead-letter', type=click.File('w'),
+              help="Where to write rejected rows [SOURCE.rejected.ndjson].")
+@with_appcontext
+def import_messages(source, fmt, workers, batch_size, dead_letter):
+    """Bulk load messages from an NDJSON or CSV file (or - for stdin)."""
+
+    import bulk_import
+
+    if fmt is None:
+        fmt = 'csv' if source.name.endswith('.csv') else 'ndjson'
+    if dead_letter is None:
+        name = 'stdin' if source.name == '<stdin>' else source.name
+        dead_letter = open(f"{name}.rejected.ndjson", 'w')
+
+    if workers is None:
+        # SQLite takes one writer at a time; more only wait for the lock
+        workers = (os.cpu_count() if db.engine.dialect.name == 'postgresql'
+                   else 1)
+
+    stats = bulk_import.ImportStats(
+        report=lambda s: click.echo(f"  {s}", err=True))
+    with dead_letter:
+        bulk_import.import_messages(
+            source, fmt, dead_letter, workers=workers,
+            batch_size=batch_size or bulk_import.BATCH_SIZE, stats=stats)
+
+    click.echo(f"imported {stats}", err=True)
+    if stats.rejected:
+        click.echo(f"rejected rows written to {dead_letter.name}", err=True)
+
+
+@click.command('reindex-messages')
+@with_appcontext
+def reindex_messages():
+    """Rebuild the message search index."""
+
+    indexed = search.reindex()
+    print(f"{indexed} messages indexed")
+
+
+@click.command('backfill-tags')
+@with_appcontext
+def backfill_tags():
+    """Index the #tags and @mentions of every message."""
+
+    indexed = tags.backfill()
+    print(f"{indexed} messages indexed")
+
+
+@click.command('fold-like-counts')
+@with_appcontext
+def fold_like_counts():
+    """Move sharded like count changes into messages.like_count."""
+
+    updated = like_counts.fold_shards()
+    print(f"{updated} like counts updated")
+
+
+@click.command('reconcile-like-counts')
+@with_appcontext
+def reconcile_like_counts():
+    """Recount every message's likes and repair drifted counts."""
+
+    repaired = like_counts.reconcile()
+    print(f"{repaired} like counts repaired")
+
+
+@click.command('init-shards')
+@click.option('--no-copy', is_flag=True,
+              help="Don't copy existing messages and likes to the shards.")
+@with_appcontext
+def init_shards(no_copy):
+    """Create the shard tables and assign users to shards."""
+
+    copied = sharding.init_shards(copy_primary=not no_copy)
+    print(f"{sharding.shard_count()} shards ready, {copied} messages copied")
+
+
+@click.command('rebalance-shards')
+@with_appcontext
+def rebalance_shards():
+    """Spread users evenly over SHARD_DATABASE_URLS, moving their data."""
+
+    def report(bucket, from_shard, to_shard, moved):
+        print(f"bucket {bucket}: shard{from_shard} -> shard{to_shard}, "
+              f"{moved} messages")
+
+    moves = sharding.rebalance(report=report)
+    print(f"{moves} buckets moved")
+
+
+@click.command('migrate-likes')
+@click.option('--batch-size', type=int,
+              help="Old likes rows copied per transaction.")
+@with_appcontext
+def migrate_likes(batch_size):
+    """Key likes on (user_id, message_id), dropping duplicate rows."""
+
+    def report(read, last_id):
+        click.echo(f"  copied {read} rows (through id {last_id})", err=True)
+
+    result = likes_migration.migrate(batch_size, report)
+    if result is None:
+        print("likes is already migrated")
+        return
+
+    for label in ('before', 'after'):
+        stats = result[label]
+        size = ('?' if stats['bytes'] is None
+                else f"{stats['bytes'] / 1024:.1f} kB")
+        lookup = ('?' if stats['lookup_ms'] is None
+                  else f"{stats['lookup_ms']:.3f} ms")
+        print(f"{label}: {stats['rows']} rows, {size}, "
+              f"median lookup {lookup}")
+    print(f"repaired {result['repaired']} like counts")
+
+
+@click.command('work-jobs')
+@click.option('--threads', default=4, show_default=True,
+              help="Worker threads per process.")
+@click.option('--processes', default=1, show_default=True,
+              help="Worker processes.")
+@with_appcontext
+def work_jobs(threads, processes):
+    """Run queued background jobs until interrupted."""
+
+    jobs.work(threads, processes)
+
+
+CLI_COMMANDS = [
+    resume_deletions,
+    build_assets,
+    compute_suggestions,
+    refresh_trending,
+    export_graph,
+    archive_messages,
+    export_user,
+    import_messages,
+    fold_like_counts,
+    reconcile_like_counts,
+    reindex_messages,
+    backfill_tags,
+    init_shards,
+    rebalance_shards,
+    migrate_likes,
+    work_jobs,
+]
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -393,9 +1048,18 @@ def homepage():
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+@bp.after_app_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request.
+
+    Fingerprinted assets and uploaded images never change under the same
+    name, so those are cached for as long as browsers will keep them
+    instead.
+    """
+
+    if request.endpoint in ('dist_asset', 'media'):
+        req.headers['Cache-Control'] = assets.IMMUTABLE_CACHE_CONTROL
+        return req
 
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
@@ -0,0 +1,303 @@
+"""Monthly partitions of old messages in cold storage.
+
+Timelines only read recent messages, so `archive_messages` moves every
+whole calendar month older than a cutoff out of the `messages` table.
+Each month goes to a gzip'd NDJSON file in ARCHIVE_DIR, ordered by id.
+Each line holds the message and the ids of users who liked it. The
+message_partitions table records each file. archived_message_routes maps
+every archived message id to its partition and to the byte offset of its
+block: every ARCHIVE_BLOCK_SIZE messages are compressed as a gzip member
+of their own, so `find_archived_message` serves /messages/<id> by
+decompressing one block rather than the file up to the message. The file
+as a whole is still ordinary gzip. Routes also record each message's
+author, and archived_likes who liked it, so exporting one user's
+archived messages and likes reads only the blocks holding them.
+
+This is a routing-table scheme rather than native Postgres declarative
+partitioning. Native partitioning needs the partition key (timestamp) in
+every unique constraint, which would break the foreign keys from likes
+and trending onto messages.id.
+"""
+
+import gzip
+import json
+import os
+import zlib
+from datetime import datetime
+
+from models import (db, User, Message, Likes, MessagePartition,
+                    ArchivedMessageRoute, ArchivedLike, TrendingBucket,
+                    TrendingMessage, LikeCountShard, SearchPosting,
+                    MessageTag, MessageMention)
+
+# messages read, written and deleted per round trip while archiving
+ARCHIVE_BATCH_SIZE = 5000
+
+# messages per gzip member; a lookup decompresses one member
+ARCHIVE_BLOCK_SIZE = 100
+
+# routes fetched from the cursor at a time when reading a user's messages
+ROUTE_CHUNK_SIZE = 1000
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class ArchivedMessage:
+    """A message read back from cold storage.
+
+    Has the same attributes templates use on Message.
+    """
+
+    def __init__(self, id, text, timestamp, user_id, liked_by):
+        self.id = id
+        self.text = text
+        self.timestamp = timestamp
+        self.user_id = user_id
+        self.liked_by = liked_by
+        self.like_count = len(liked_by)
+        self.user = User.query.get(user_id)
+
+
+def _month_start(when):
+    return datetime(when.year, when.month, 1)
+
+
+def _next_month(when):
+    if when.month == 12:
+        return datetime(when.year + 1, 1, 1)
+    return datetime(when.year, when.month + 1, 1)
+
+
+def _encode(msg, liked_by):
+    return json.dumps(dict(
+        id=msg.id,
+        text=msg.text,
+        timestamp=msg.timestamp.strftime(TIMESTAMP_FORMAT),
+        user_id=msg.user_id,
+        liked_by=liked_by,
+    ))
+
+
+def _archive_month(starts_at, ends_at, directory):
+    """Move messages in [starts_at, ends_at) to a new cold partition."""
+
+    partition = MessagePartition(
+        name=starts_at.strftime('%Y_%m'),
+        starts_at=starts_at,
+        ends_at=ends_at,
+        path='',
+        row_count=0,
+    )
+    db.session.add(partition)
+    db.session.flush()
+
+    partition.path = os.path.join(
+        directory, f"messages-{partition.name}-{partition.id}.ndjson.gz")
+    tmp = partition.path + '.tmp'
+
+    in_month = ((Message.timestamp >= starts_at)
+                & (Message.timestamp < ends_at))
+    archived_ids = []
+    offsets = {}
+    authors = {}
+    likes = []
+
+    with open(tmp, 'wb') as f:
+        last_id = 0
+        while True:
+            msgs = (db.session
+                    .query(Message.id, Message.text, Message.timestamp,
+                           Message.user_id)
+                    .filter(in_month, Message.id > last_id)
+                    .order_by(Message.id)
+                    .limit(ARCHIVE_BATCH_SIZE)
+                    .all())
+            if not msgs:
+                break
+
+            ids = [msg.id for msg in msgs]
+            liked_by = {}
+            for user_id, message_id in (db.session
+                                        .query(Likes.user_id, Likes.message_id)
+                                        .filter(Likes.message_id.in_(ids))):
+                liked_by.setdefault(message_id, []).append(user_id)
+                likes.append(dict(user_id=user_id, message_id=message_id))
+
+            for start in range(0, len(msgs), ARCHIVE_BLOCK_SIZE):
+                block = msgs[start:start + ARCHIVE_BLOCK_SIZE]
+                offset = f.tell()
+                f.write(gzip.compress(''.join(
+                    _encode(msg, liked_by.get(msg.id, [])) + '\n'
+                    for msg in block).encode('utf-8')))
+                for msg in block:
+                    offsets[msg.id] = offset
+                    authors[msg.id] = msg.user_id
+
+            archived_ids.extend(ids)
+            last_id = ids[-1]
+
+    os.replace(tmp, partition.path)
+    partition.row_count = len(archived_ids)
+
+    for start in range(0, len(archived_ids), ARCHIVE_BATCH_SIZE):
+        ids = archived_ids[start:start + ARCHIVE_BATCH_SIZE]
+        db.session.bulk_insert_mappings(ArchivedMessageRoute, [
+            dict(message_id=msg_id, partition_id=partition.id,
+                 offset=offsets[msg_id], user_id=authors[msg_id])
+            for msg_id in ids
+        ])
+        for model in (Likes, TrendingBucket, TrendingMessage,
+                      LikeCountShard, SearchPosting, MessageTag,
+                      MessageMention):
+            (model.query
+             .filter(model.message_id.in_(ids))
+             .delete(synchronize_session=False))
+        (Message.query
+         .filter(Message.id.in_(ids))
+         .delete(synchronize_session=False))
+
+    # routes first: archived likes reference them
+    db.session.flush()
+    for start in range(0, len(likes), ARCHIVE_BATCH_SIZE):
+        db.session.bulk_insert_mappings(
+            ArchivedLike, likes[start:start + ARCHIVE_BATCH_SIZE])
+
+    db.session.commit()
+    return partition
+
+
+def archive_messages(before, directory):
+    """Archive every whole month of messages older than `before`.
+
+    Each month is committed on its own, after its file is safely written.
+    Returns the new MessagePartitions.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    cutoff = _month_start(before)
+
+    oldest = db.session.query(db.func.min(Message.timestamp)).scalar()
+    if oldest is None:
+        return []
+
+    partitions = []
+    month = _month_start(oldest)
+    while month < cutoff:
+        ends_at = _next_month(month)
+        exists = (db.session.query(Message.id)
+                  .filter(Message.timestamp >= month,
+                          Message.timestamp < ends_at)
+                  .first())
+        if exists:
+            partitions.append(_archive_month(month, ends_at, directory))
+        month = ends_at
+
+    return partitions
+
+
+def _read_block(path, offset):
+    """Lines of the gzip member starting at byte `offset` of `path`."""
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while not decompressor.eof:
+            chunk = f.read(64 * 1024)
+            if not chunk:
+                break
+            data.append(decompressor.decompress(chunk))
+    return b''.join(data).decode('utf-8').splitlines()
+
+
+def _decode(data):
+    return ArchivedMessage(
+        id=data['id'],
+        text=data['text'],
+        timestamp=datetime.strptime(data['timestamp'], TIMESTAMP_FORMAT),
+        user_id=data['user_id'],
+        liked_by=data['liked_by'],
+    )
+
+
+def _routes(query):
+    """Stream (message_id, path, offset) of the routes `query` filters.
+
+    Read with a server-side cursor in chunks of ROUTE_CHUNK_SIZE, so a
+    heavy account's routes are never all in memory.
+    """
+
+    query = (query
+             .with_entities(ArchivedMessageRoute.message_id,
+                            MessagePartition.path, ArchivedMessageRoute.offset)
+             .join(ArchivedMessageRoute.partition)
+             .order_by(ArchivedMessageRoute.message_id))
+    result = db.session.execute(
+        query.statement.execution_options(stream_results=True))
+    try:
+        while True:
+            rows = result.fetchmany(ROUTE_CHUNK_SIZE)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        result.close()
+
+
+def _read_routes(routes):
+    """Yield the partition line of each of `routes`, decoded, in order.
+
+    Each block is decompressed once however many of the routes it holds.
+    """
+
+    block = None
+    lines = {}
+    for message_id, path, offset in routes:
+        if (path, offset) != block:
+            block = (path, offset)
+            lines = {}
+            for line in _read_block(path, offset):
+                data = json.loads(line)
+                lines[data['id']] = data
+        if message_id in lines:
+            yield lines[message_id]
+
+
+def archived_messages_of(user_id):
+    """Yield the data of `user_id`'s archived messages, by id.
+
+    Reads only the blocks holding them.
+    """
+
+    yield from _read_routes(_routes(
+        ArchivedMessageRoute.query
+        .filter(ArchivedMessageRoute.user_id == user_id)))
+
+
+def archived_likes_of(user_id):
+    """Yield the data of the archived messages `user_id` liked, by id."""
+
+    yield from _read_routes(_routes(
+        ArchivedMessageRoute.query
+        .join(ArchivedLike,
+              ArchivedLike.message_id == ArchivedMessageRoute.message_id)
+        .filter(ArchivedLike.user_id == user_id)))
+
+
+def find_archived_message(message_id):
+    """Return the ArchivedMessage with `message_id`, or None."""
+
+    route = ArchivedMessageRoute.query.get(message_id)
+    if route is None:
+        return None
+
+    for line in _read_block(route.partition.path, route.offset):
+        data = json.loads(line)
+        if data['id'] == message_id:
+            msg = _decode(data)
+            # messages of deleted accounts stay hidden
+            return msg if msg.user else None
+        if data['id'] > message_id:
+            break
+
+    return None
@@ -0,0 +1,205 @@
+"""Fingerprinted static assets.
+
+`flask build-assets` copies every file under static/ into static/dist/ with
+a content hash in its name, so the copies can be cached for a year. Text
+assets also get precompressed .gz (and .br, when the brotli package is
+installed) siblings, and oversized images are downsized and recompressed
+when Pillow is installed. The name mapping goes into
+static/dist/manifest.json, which `asset_url` reads to point templates at the
+fingerprinted copies.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+from io import BytesIO
+
+from flask import current_app, request, send_from_directory
+
+from compression import accepted_codings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+
+# one year, the longest lifetime caches honour
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt'}
+
+# logical path -> maximum width in pixels for the built copy
+MAX_IMAGE_WIDTHS = {
+    'images/warbler-hero.jpg': 1280,
+    'images/signed-out-home.jpg': 1280,
+    'images/nav-bg.png': 1920,
+}
+
+JPEG_QUALITY = 80
+
+CSS_URL_RE = re.compile(r'url\(["\']?/static/([^"\')]+)["\']?\)')
+
+_manifest = {}
+
+
+def _fingerprint(path, data):
+    """Return `path` with a short hash of `data` before its extension."""
+
+    root, ext = os.path.splitext(path)
+    digest = hashlib.md5(data).hexdigest()[:12]
+    return f"{root}.{digest}{ext}"
+
+
+def _shrink_image(path, data, max_width):
+    """Return `data` downsized to `max_width` and recompressed, if possible."""
+
+    if Image is None:
+        return data
+
+    img = Image.open(BytesIO(data))
+    if img.width > max_width:
+        height = round(img.height * max_width / img.width)
+        img = img.resize((max_width, height), Image.LANCZOS)
+
+    out = BytesIO()
+    if path.endswith('.jpg') or path.endswith('.jpeg'):
+        img.convert('RGB').save(out, 'JPEG', quality=JPEG_QUALITY,
+                                optimize=True, progressive=True)
+    else:
+        img.save(out, img.format or 'PNG', optimize=True)
+
+    # keep the original if recompressing didn't help
+    return min(out.getvalue(), data, key=len)
+
+
+def _write(dist, name, data):
+    """Write `data` to dist/name, plus precompressed variants for text."""
+
+    dest = os.path.join(dist, name)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    with open(dest, 'wb') as f:
+        f.write(data)
+
+    if os.path.splitext(name)[1] not in COMPRESSIBLE:
+        return
+
+    with open(dest + '.gz', 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(dest + '.br', 'wb') as f:
+            f.write(brotli.compress(data, quality=11))
+
+
+def build_assets(static_folder):
+    """Build static/dist/ and its manifest from `static_folder`.
+
+    Returns the manifest, a dict of logical path -> fingerprinted path.
+    """
+
+    dist = os.path.join(static_folder, DIST_DIR)
+    shutil.rmtree(dist, ignore_errors=True)
+
+    sources = []
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != dist]
+        for filename in files:
+            full = os.path.join(root, filename)
+            sources.append(os.path.relpath(full, static_folder)
+                           .replace(os.sep, '/'))
+
+    # stylesheets go last so their url()s can point at built images
+    sources.sort(key=lambda path: (path.endswith('.css'), path))
+
+    manifest = {}
+    for path in sources:
+        with open(os.path.join(static_folder, path), 'rb') as f:
+            data = f.read()
+
+        if path in MAX_IMAGE_WIDTHS:
+            data = _shrink_image(path, data, MAX_IMAGE_WIDTHS[path])
+        elif path.endswith('.css'):
+            css = data.decode('utf-8')
+            css = CSS_URL_RE.sub(
+                lambda m: f'url("{_dist_url(manifest, m.group(1))}")', css)
+            data = css.encode('utf-8')
+
+        manifest[path] = _fingerprint(path, data)
+        _write(dist, manifest[path], data)
+
+    with open(os.path.join(dist, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def _dist_url(manifest, path):
+    """URL for logical `path`: fingerprinted if it's in `manifest`."""
+
+    if path in manifest:
+        return f"/static/{DIST_DIR}/{manifest[path]}"
+    return f"/static/{path}"
+
+
+def asset_url(path):
+    """URL to use in templates for the static asset `path`.
+
+    Accepts "stylesheets/style.css" or "/static/stylesheets/style.css".
+    Anything that isn't a static path (e.g. a remote image URL) is returned
+    unchanged, as is everything when no build has been run.
+    """
+
+    if not path:
+        return path
+    if path.startswith('/static/'):
+        path = path[len('/static/'):]
+    elif path.startswith('/') or '://' in path:
+        return path
+    return _dist_url(_manifest, path)
+
+
+def serve_dist_asset(filename):
+    """Serve a fingerprinted asset, preferring a precompressed variant."""
+
+    dist = os.path.join(current_app.static_folder, DIST_DIR)
+
+    accepted = accepted_codings(request.headers.get('Accept-Encoding', ''))
+    mimetype = mimetypes.guess_type(filename)[0]
+
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if (encoding in accepted
+                and os.path.isfile(os.path.join(dist, filename + suffix))):
+            resp = send_from_directory(dist, filename + suffix,
+                                       mimetype=mimetype)
+            resp.headers['Content-Encoding'] = encoding
+            break
+    else:
+        resp = send_from_directory(dist, filename)
+
+    resp.headers['Vary'] = 'Accept-Encoding'
+    return resp
+
+
+def init_app(app):
+    """Load the asset manifest and register `asset_url` with Jinja."""
+
+    _manifest.clear()
+    path = os.path.join(app.static_folder, DIST_DIR, MANIFEST)
+    if os.path.isfile(path):
+        with open(path) as f:
+            _manifest.update(json.load(f))
+
+    app.jinja_env.globals['asset_url'] = asset_url
+    app.add_url_rule(f'{app.static_url_path}/{DIST_DIR}/<path:filename>',
+                     'dist_asset', serve_dist_asset)
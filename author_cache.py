@@ -0,0 +1,113 @@
+"""Process-wide cache of the author details shown next to each warble."""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from models import db, User
+
+
+class AuthorCard:
+    """Just enough of a User to render a message's author."""
+
+    __slots__ = ('id', 'username', 'image_url', 'expires')
+
+    def __init__(self, id, username, image_url, expires):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+        self.expires = expires
+
+    def __repr__(self):
+        return f"<AuthorCard #{self.id}: {self.username}>"
+
+
+class AuthorCardCache:
+    """Bounded LRU cache of AuthorCards keyed by user id.
+
+    Misses for a page are filled together with a single `IN` query.
+    Size and time-to-live come from the AUTHOR_CACHE_SIZE and
+    AUTHOR_CACHE_TTL config keys when `init_app` is called.
+    """
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._cards = OrderedDict()
+        self._lock = Lock()
+
+    def init_app(self, app):
+        """Read cache size and TTL (seconds) from `app.config`."""
+
+        self.max_size = app.config.setdefault('AUTHOR_CACHE_SIZE',
+                                              self.max_size)
+        self.ttl = app.config.setdefault('AUTHOR_CACHE_TTL', self.ttl)
+        self.clear()
+
+    def get_many(self, user_ids):
+        """Return a dict of user id -> AuthorCard for `user_ids`."""
+
+        now = monotonic()
+        found = {}
+        missing = set()
+
+        with self._lock:
+            for user_id in set(user_ids):
+                card = self._cards.get(user_id)
+                if card is not None and card.expires > now:
+                    self._cards.move_to_end(user_id)
+                    found[user_id] = card
+                else:
+                    missing.add(user_id)
+            self.hits += len(found)
+            self.misses += len(missing)
+
+        if missing:
+            rows = (db.session
+                    .query(User.id, User.username, User.image_url)
+                    .filter(User.id.in_(missing))
+                    .all())
+            expires = now + self.ttl
+            with self._lock:
+                for user_id, username, image_url in rows:
+                    card = AuthorCard(user_id, username, image_url, expires)
+                    self._cards[user_id] = card
+                    self._cards.move_to_end(user_id)
+                    found[user_id] = card
+                while len(self._cards) > self.max_size:
+                    self._cards.popitem(last=False)
+
+        return found
+
+    def invalidate(self, user_id):
+        """Drop the cached card for `user_id`, if any."""
+
+        with self._lock:
+            self._cards.pop(user_id, None)
+
+    def clear(self):
+        """Empty the cache and reset its statistics."""
+
+        with self._lock:
+            self._cards.clear()
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def hit_rate(self):
+        """Fraction of lookups answered from the cache."""
+
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        """Return a dict of cache size and hit/miss counters."""
+
+        return dict(size=len(self._cards), max_size=self.max_size,
+                    hits=self.hits, misses=self.misses,
+                    hit_rate=self.hit_rate)
+
+
+author_cards = AuthorCardCache()
@@ -0,0 +1,170 @@
+"""Uploaded profile and header images.
+
+An upload is checked, stored under UPLOAD_DIR/originals, and resized by a
+pool of AVATAR_WORKERS processes into a fixed set of sizes, each saved as
+both WebP and JPEG. Files are named after a hash of the original image, so
+they are served from /media/ with a year-long cache lifetime. The user's
+image_url (or header_image_url) is set to the largest size's URL, and
+`image_url(url, size)` in templates points at the size a page needs.
+/media/ serves the WebP copy to browsers that accept it.
+
+Pillow is needed for uploads; without it the form refuses them.
+"""
+
+import hashlib
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from flask import abort, current_app, request, send_from_directory
+
+import assets
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# target box of each size, per kind of image; the last is the largest
+SIZES = {
+    'avatar': {
+        'timeline': (96, 96),
+        'card': (200, 200),
+        'profile': (400, 400),
+    },
+    'header': {
+        'card': (600, 200),
+        'profile': (1500, 500),
+    },
+}
+
+# refuse images that would decompress to more pixels than this; checked
+# here, as Pillow only refuses twice its MAX_IMAGE_PIXELS (and warns below)
+MAX_PIXELS = 40_000_000
+
+MEDIA_URL = '/media/'
+
+_MEDIA_NAME = re.compile(r'^/media/(?P<digest>[0-9a-f]{20})'
+                         r'-(?P<kind>avatar|header)-(?P<size>\w+)\.jpg$')
+
+_executor = None
+
+
+def _pool():
+    global _executor
+
+    if _executor is None:
+        _executor = ProcessPoolExecutor(current_app.config['AVATAR_WORKERS'])
+    return _executor
+
+
+def _open(source):
+    """Image.open `source`, refusing images of more than MAX_PIXELS."""
+
+    img = Image.open(source)
+    width, height = img.size
+    if width * height > MAX_PIXELS:
+        img.close()
+        raise ValueError(f"{width}x{height} is more than {MAX_PIXELS} pixels")
+    return img
+
+
+def make_thumbnail(original, destination, box):
+    """Write `destination`.webp and .jpg, `original` cropped to fill `box`."""
+
+    with _open(original) as img:
+        img = ImageOps.exif_transpose(img).convert('RGB')
+        img = ImageOps.fit(img, box, Image.LANCZOS)
+        img.save(destination + '.webp', 'WEBP', quality=80, method=4)
+        img.save(destination + '.jpg', 'JPEG', quality=85, optimize=True,
+                 progressive=True)
+
+
+def save_upload(upload, kind):
+    """Store an uploaded image and its thumbnails; return its URL.
+
+    Raises ValueError if the upload isn't a usable image.
+    """
+
+    if Image is None:
+        raise ValueError("Image uploads aren't available.")
+
+    data = upload.read()
+    try:
+        with _open(BytesIO(data)) as img:
+            img.verify()
+    except (OSError, ValueError, Image.DecompressionBombError):
+        raise ValueError("That file isn't an image we can read.")
+
+    directory = current_app.config['UPLOAD_DIR']
+    originals = os.path.join(directory, 'originals')
+    os.makedirs(originals, exist_ok=True)
+
+    digest = hashlib.sha256(data).hexdigest()[:20]
+    original = os.path.join(originals, digest)
+    with open(original, 'wb') as f:
+        f.write(data)
+
+    jobs = [(original, os.path.join(directory, f"{digest}-{kind}-{size}"), box)
+            for size, box in SIZES[kind].items()]
+    try:
+        if current_app.config['AVATAR_WORKERS']:
+            futures = [_pool().submit(make_thumbnail, *job) for job in jobs]
+            for future in futures:
+                future.result()
+        else:
+            for job in jobs:
+                make_thumbnail(*job)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        raise ValueError("That file isn't an image we can read.")
+
+    largest = list(SIZES[kind])[-1]
+    return f"{MEDIA_URL}{digest}-{kind}-{largest}.jpg"
+
+
+def image_url(url, size):
+    """URL of the `size` version of an image, for templates.
+
+    Uploaded images are swapped for the requested size; anything else
+    (remote URLs, the default pictures) goes through `asset_url`.
+    """
+
+    match = _MEDIA_NAME.match(url or '')
+    if match and size in SIZES[match['kind']]:
+        return f"{MEDIA_URL}{match['digest']}-{match['kind']}-{size}.jpg"
+    return assets.asset_url(url)
+
+
+def serve_media(filename):
+    """Serve an uploaded image, as WebP when the browser accepts it.
+
+    Only thumbnails are served; originals keep the uploader's metadata.
+    """
+
+    if not _MEDIA_NAME.match(MEDIA_URL + filename):
+        abort(404)
+
+    directory = current_app.config['UPLOAD_DIR']
+    webp = filename[:-len('.jpg')] + '.webp'
+    if ('image/webp' in request.headers.get('Accept', '')
+            and filename.endswith('.jpg')
+            and os.path.isfile(os.path.join(directory, webp))):
+        resp = send_from_directory(directory, webp)
+    else:
+        resp = send_from_directory(directory, filename)
+
+    resp.headers['Vary'] = 'Accept'
+    return resp
+
+
+def init_app(app):
+    """Register /media/ and `image_url`, and read UPLOAD_DIR."""
+
+    app.config.setdefault('UPLOAD_DIR', os.path.join(app.instance_path,
+                                                     'uploads'))
+    app.config.setdefault('AVATAR_WORKERS', 2)
+    app.config.setdefault('MAX_CONTENT_LENGTH', 16 * 1024 * 1024)
+
+    app.jinja_env.globals['image_url'] = image_url
+    app.add_url_rule(f'{MEDIA_URL}<path:filename>', 'media', serve_media)
@@ -0,0 +1,71 @@
+"""Benchmark response compression on real Warbler pages.
+
+Seeds a user who follows everyone in generator/, renders the home and
+followers pages, and reports the bytes saved and CPU time spent by each
+compression setting.
+
+Run it like:
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.bench_compression
+"""
+
+import gzip
+from time import process_time
+
+from app import app, CURR_USER_KEY
+from benchmarks.sample_data import load_sample_data
+from models import db, User
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ROUNDS = 50
+
+
+def seed():
+    """Load the sample data and have one user follow everybody."""
+
+    load_sample_data()
+
+    user = User.query.first()
+    for other in User.query.filter(User.id != user.id):
+        if not user.is_following(other):
+            user.following.append(other)
+    db.session.commit()
+    return user.id
+
+
+def settings():
+    for level in (1, 6, 9):
+        yield f"gzip -{level}", lambda data, l=level: gzip.compress(data, l)
+    if brotli is not None:
+        for quality in (4, 8, 11):
+            yield f"brotli q{quality}", \
+                lambda data, q=quality: brotli.compress(data, quality=q)
+
+
+def main():
+    with app.app_context():
+        user_id = seed()
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = user_id
+
+    for path in ('/', f'/users/{user_id}/followers'):
+        data = client.get(path).data
+        print(f"{path}: {len(data):,} bytes uncompressed")
+        for name, compress in settings():
+            start = process_time()
+            for _ in range(ROUNDS):
+                out = compress(data)
+            cpu_ms = (process_time() - start) / ROUNDS * 1000
+            saved = 1 - len(out) / len(data)
+            print(f"  {name:<11} {len(out):>8,} bytes  "
+                  f"{saved:6.1%} saved  {cpu_ms:6.2f}ms cpu")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Benchmark concurrent home and profile page throughput.
+
+Starts gunicorn with sync workers and then with gevent workers (with
+gathered reads), logs in a sample user who follows everyone, and reports
+requests per second with CONCURRENCY clients hitting / and /users/<id>.
+
+Run it like:
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.bench_concurrency
+"""
+
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app, CURR_USER_KEY
+from benchmarks.sample_data import load_sample_data
+from models import db, User
+
+CONCURRENCY = 50
+REQUESTS = 1000
+PORT = 8537
+
+SETUPS = [
+    ("sync x4", ['-w', '4'], 'off'),
+    ("gevent x4", ['-w', '4', '-k', 'gevent', '--worker-connections', '500'],
+     'auto'),
+]
+
+
+def seed():
+    """Load the sample data and have one user follow everybody."""
+
+    load_sample_data()
+
+    user = User.signup('bench', 'bench@example.com', 'benchpass', None)
+    db.session.commit()
+    for other in User.query.filter(User.id != user.id):
+        user.following.append(other)
+    db.session.commit()
+    return user.id
+
+
+def wait_for_server(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url + '/login')
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+
+def session_cookie(user_id):
+    """A signed session cookie logging in `user_id`."""
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    return f"session={serializer.dumps({CURR_USER_KEY: user_id})}"
+
+
+def run(url, paths, cookie):
+    def fetch(i):
+        request = urllib.request.Request(url + paths[i % len(paths)],
+                                         headers={'Cookie': cookie})
+        with urllib.request.urlopen(request) as resp:
+            resp.read()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(CONCURRENCY) as pool:
+        list(pool.map(fetch, range(REQUESTS)))
+    return REQUESTS / (time.perf_counter() - start)
+
+
+def main():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user_id = seed()
+
+    url = f"http://127.0.0.1:{PORT}"
+    paths = ['/', f'/users/{user_id}']
+    cookie = session_cookie(user_id)
+
+    for name, args, mode in SETUPS:
+        env = dict(os.environ, PARALLEL_READS=mode)
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-b', f'127.0.0.1:{PORT}',
+             *args, 'app:app'], env=env)
+        try:
+            wait_for_server(url)
+            print(f"{name:>10}: {run(url, paths, cookie):8.1f} req/s")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Benchmark deleting a heavy account.
+
+Seeds one user with a large number of messages (and likes on them), then
+times User.bulk_delete against it.
+
+Run it like:
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.bench_delete_user 1000000
+"""
+
+import sys
+from datetime import datetime
+from time import perf_counter
+
+from app import app
+from models import db, User, Message, Likes, UserDeletion
+
+INSERT_CHUNK = 50000
+
+
+def seed(num_messages):
+    """Create an author with `num_messages` messages and a liker."""
+
+    author = User(email="author@bench.com", username="bench_author",
+                  password="HASHED_PASSWORD")
+    liker = User(email="liker@bench.com", username="bench_liker",
+                 password="HASHED_PASSWORD")
+    db.session.add_all([author, liker])
+    db.session.commit()
+
+    now = datetime.utcnow()
+    for start in range(0, num_messages, INSERT_CHUNK):
+        count = min(INSERT_CHUNK, num_messages - start)
+        db.session.execute(Message.__table__.insert(), [
+            dict(text=f"bench message {start + i}", timestamp=now,
+                 user_id=author.id)
+            for i in range(count)
+        ])
+    db.session.commit()
+
+    # like every tenth message so the likes cascade has work to do
+    msg_ids = db.session.query(Message.id).filter_by(user_id=author.id)
+    db.session.execute(Likes.__table__.insert(), [
+        dict(user_id=liker.id, message_id=msg_id)
+        for (msg_id,) in msg_ids if msg_id % 10 == 0
+    ])
+    db.session.commit()
+
+    return author.id
+
+
+def main(num_messages):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        start = perf_counter()
+        user_id = seed(num_messages)
+        print(f"seeded {num_messages} messages in "
+              f"{perf_counter() - start:.1f}s")
+
+        start = perf_counter()
+        User.bulk_delete(user_id)
+        elapsed = perf_counter() - start
+
+        record = UserDeletion.query.filter_by(user_id=user_id).one()
+        print(f"bulk_delete: {record.messages_deleted} messages in "
+              f"{elapsed:.2f}s ({record.messages_deleted / elapsed:,.0f}/s)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
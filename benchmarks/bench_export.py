@@ -0,0 +1,62 @@
+"""Benchmark streaming a large account's export.
+
+Seeds one user with a large number of messages, then exports them in each
+format to /dev/null, reporting throughput and peak Python memory. Peak
+memory should stay flat as the message count grows.
+
+Run it like:
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.bench_export 1000000
+"""
+
+import os
+import sys
+import tracemalloc
+from datetime import datetime
+
+import export
+from app import app
+from models import db, User, Message
+
+INSERT_CHUNK = 50000
+
+
+def seed(num_messages):
+    """Create a user with `num_messages` messages."""
+
+    user = User(email="export@bench.com", username="bench_export",
+                password="HASHED_PASSWORD")
+    db.session.add(user)
+    db.session.commit()
+
+    now = datetime.utcnow()
+    for start in range(0, num_messages, INSERT_CHUNK):
+        count = min(INSERT_CHUNK, num_messages - start)
+        db.session.execute(Message.__table__.insert(), [
+            dict(text=f"bench message {start + i}", timestamp=now,
+                 user_id=user.id)
+            for i in range(count)
+        ])
+    db.session.commit()
+    return user.id
+
+
+def main(num_messages):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user_id = seed(num_messages)
+
+        for fmt in sorted(export.FORMATS):
+            progress = export.ExportProgress()
+            tracemalloc.start()
+            with open(os.devnull, 'w') as out:
+                for data in export.export(user_id, 'messages', fmt, progress):
+                    out.write(data)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"{fmt:>7}: {progress}, peak {peak / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
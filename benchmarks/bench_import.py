@@ -0,0 +1,56 @@
+"""Benchmark bulk message import.
+
+Writes an NDJSON file of generated messages for the sample users, then
+loads it with `bulk_import.import_messages` using one worker and then
+every CPU, reporting rows per second for each.
+
+Run it like:
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.bench_import 1000000
+"""
+
+import io
+import json
+import os
+import sys
+import tempfile
+
+import bulk_import
+from app import app
+from benchmarks.sample_data import load_sample_data
+from models import db, User, Message
+
+
+def write_source(path, num_messages, user_ids):
+    with open(path, 'w') as f:
+        for i in range(num_messages):
+            f.write(json.dumps(dict(
+                user_id=user_ids[i % len(user_ids)],
+                text=f"imported message {i}",
+                timestamp='2017-01-01T00:00:00',
+            )) + '\n')
+
+
+def main(num_messages):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        load_sample_data()
+        user_ids = [user_id for (user_id,) in db.session.query(User.id)]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'messages.ndjson')
+            write_source(path, num_messages, user_ids)
+
+            for workers in sorted({1, os.cpu_count()}):
+                Message.query.delete()
+                db.session.commit()
+
+                with open(path) as source:
+                    stats = bulk_import.import_messages(
+                        source, 'ndjson', io.StringIO(), workers=workers)
+                print(f"{workers:>3} worker(s): {stats}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,41 @@
+"""Benchmark the cost of recording metrics on the request path.
+
+Reports the time per call of each recording operation, which should stay
+well under 10µs.
+
+Run it like:
+
+    python -m benchmarks.bench_metrics
+"""
+
+import timeit
+
+import metrics
+
+CALLS = 1000000
+
+
+def per_call(fn):
+    seconds = min(timeit.repeat(fn, number=CALLS, repeat=5))
+    return seconds / CALLS * 1e6
+
+
+def main():
+    hist = metrics.Histogram('bench_seconds', "Bench.", ('endpoint', 'status'))
+    counter = metrics.Counter('bench_total', "Bench.", ('endpoint',))
+    gauge = metrics.Gauge('bench_active', "Bench.")
+
+    def in_and_out():
+        gauge.inc()
+        gauge.dec()
+
+    for name, fn in [
+        ("histogram observe", lambda: hist.observe(0.012, 'homepage', '200')),
+        ("counter inc", lambda: counter.inc(3, 'homepage')),
+        ("gauge inc + dec", in_and_out),
+    ]:
+        print(f"{name:>20}: {per_call(fn):6.2f} µs")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Benchmark import time and worker boot time.
+
+Each measurement runs in a fresh interpreter, ROUNDS times, and the median
+is reported:
+
+- import: `import app` (no app is created)
+- create_app: importing and building an app
+- first request: building an app and serving /login, which pulls in the
+  lazily imported forms
+- gunicorn: launching `gunicorn -w WORKERS app:app` until it answers,
+  with and without --preload
+
+Run it like:
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.bench_startup
+"""
+
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+ROUNDS = 10
+WORKERS = 4
+PORT = 8538
+
+STAGES = [
+    ("import", "import app"),
+    ("create_app", "import app; app.create_app()"),
+    ("first request",
+     "import app; app.create_app().test_client().get('/login')"),
+]
+
+
+def time_python(code):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], check=True)
+    return time.perf_counter() - start
+
+
+def time_gunicorn(extra_args):
+    url = f"http://127.0.0.1:{PORT}/login"
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-b', f'127.0.0.1:{PORT}',
+         '-w', str(WORKERS), *extra_args, 'app:app'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                urllib.request.urlopen(url).read()
+                return time.perf_counter() - start
+            except OSError:
+                if server.poll() is not None:
+                    raise RuntimeError("gunicorn exited before serving")
+                time.sleep(0.01)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def report(name, timings):
+    print(f"{name:>20}: {statistics.median(timings) * 1000:7.1f} ms")
+
+
+def main():
+    for name, code in STAGES:
+        report(name, [time_python(code) for _ in range(ROUNDS)])
+
+    for name, args in (("gunicorn", []), ("gunicorn --preload", ['--preload'])):
+        report(name, [time_gunicorn(args) for _ in range(ROUNDS)])
+
+    print("\nslowest imports:")
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             'import app; app.create_app()'],
+                            stderr=subprocess.PIPE, text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines()[1:]:
+        _, cumulative, module = line.split('|')
+        rows.append((int(cumulative), module.strip()))
+    for cumulative, module in sorted(rows, reverse=True)[:10]:
+        print(f"{cumulative / 1000:8.1f} ms  {module}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+"""Load the generator/ CSVs into the database for benchmarks."""
+
+from csv import DictReader
+from datetime import datetime
+
+from models import db, User, Message, Follows
+
+
+def load_sample_data():
+    """Recreate all tables and fill them from generator/*.csv."""
+
+    db.drop_all()
+    db.create_all()
+
+    with open('generator/users.csv') as users:
+        db.session.bulk_insert_mappings(User, DictReader(users))
+
+    with open('generator/messages.csv') as messages:
+        db.session.bulk_insert_mappings(Message, [
+            dict(row, timestamp=datetime.fromisoformat(row['timestamp']))
+            for row in DictReader(messages)
+        ])
+
+    with open('generator/follows.csv') as follows:
+        db.session.bulk_insert_mappings(Follows, DictReader(follows))
+
+    db.session.commit()
@@ -0,0 +1,257 @@
+"""Bulk loading of messages from other platforms.
+
+`flask import-messages` streams an NDJSON or CSV file of messages, each
+with a user_id, text and optional ISO 8601 timestamp, into the messages
+table. The input is read in batches of BATCH_SIZE and handed to a pool of
+worker processes, each with its own app, configured like the importing
+one, and its own database connection. Every
+batch is validated and loaded in its own transaction: COPY on Postgres,
+multi-row INSERTs elsewhere.
+
+Rows that fail validation (bad JSON, missing fields, text over 140
+characters, unknown users) are written to a dead-letter NDJSON file with
+their line number and the reason, and the rest of the batch still loads.
+Imported messages aren't searchable until `flask reindex-messages` runs.
+"""
+
+import csv
+import io
+import json
+import multiprocessing
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from flask import current_app
+
+from models import db, User, Message
+
+# rows validated and loaded per transaction
+BATCH_SIZE = 10000
+
+# rows per INSERT statement where COPY isn't available (SQLite caps the
+# number of bound parameters)
+INSERT_ROWS = 300
+
+# how many rows between progress reports
+REPORT_EVERY = 100000
+
+MAX_TEXT_LENGTH = Message.text.type.length
+
+
+class ImportStats:
+    """Rows loaded and rejected so far, and how fast."""
+
+    def __init__(self, report=None, every=REPORT_EVERY):
+        self.loaded = 0
+        self.rejected = 0
+        self.started = time.perf_counter()
+        self._report = report
+        self._every = every
+        self._next_report = every
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def rows_per_second(self):
+        return self.loaded / self.elapsed if self.elapsed else 0.0
+
+    def add(self, loaded, rejected):
+        self.loaded += loaded
+        self.rejected += rejected
+        if self._report and self.loaded + self.rejected >= self._next_report:
+            self._report(self)
+            self._next_report = self.loaded + self.rejected + self._every
+
+    def __str__(self):
+        return (f"{self.loaded} loaded, {self.rejected} rejected in "
+                f"{self.elapsed:.1f}s ({self.rows_per_second:.0f} rows/s)")
+
+
+def read_records(f, fmt):
+    """Yield (line number, record) for each row of `f`.
+
+    A record is a dict of fields, or the raw line if it couldn't be
+    parsed; `validate` rejects those.
+    """
+
+    if fmt == 'csv':
+        reader = csv.DictReader(f)
+        for record in reader:
+            yield reader.line_num, record
+    elif fmt == 'ndjson':
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield line_no, json.loads(line)
+            except ValueError:
+                yield line_no, line.rstrip('\n')
+    else:
+        raise ValueError(f"Unknown import format {fmt!r}")
+
+
+def batches(records, size=BATCH_SIZE):
+    """Group `records` into lists of at most `size`."""
+
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def validate(record):
+    """Return a (user_id, text, timestamp) row, or raise ValueError."""
+
+    if not isinstance(record, dict):
+        raise ValueError("not a JSON object")
+
+    try:
+        user_id = int(record['user_id'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("missing or invalid user_id")
+
+    text = record.get('text')
+    if not isinstance(text, str) or not text.strip():
+        raise ValueError("missing text")
+    if len(text) > MAX_TEXT_LENGTH:
+        raise ValueError(f"text longer than {MAX_TEXT_LENGTH} characters")
+
+    timestamp = record.get('timestamp')
+    if timestamp:
+        try:
+            timestamp = datetime.fromisoformat(str(timestamp).rstrip('Z'))
+        except ValueError:
+            raise ValueError("invalid timestamp")
+        if timestamp.tzinfo is not None:
+            # messages.timestamp is naive UTC
+            timestamp = (timestamp.astimezone(timezone.utc)
+                         .replace(tzinfo=None))
+    else:
+        timestamp = datetime.utcnow()
+
+    return user_id, text, timestamp
+
+
+def _copy_rows(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(
+        (text, timestamp.isoformat(), user_id)
+        for user_id, text, timestamp in rows)
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert("COPY messages (text, timestamp, user_id) "
+                       "FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def _insert_rows(rows):
+    for start in range(0, len(rows), INSERT_ROWS):
+        db.session.execute(Message.__table__.insert().values([
+            dict(user_id=user_id, text=text, timestamp=timestamp)
+            for user_id, text, timestamp in rows[start:start + INSERT_ROWS]
+        ]))
+
+
+def load_batch(batch):
+    """Validate and load one batch in its own transaction.
+
+    Returns (rows loaded, [dead letters]).
+    """
+
+    rows, dead = [], []
+    for line_no, record in batch:
+        try:
+            rows.append((line_no, record, validate(record)))
+        except ValueError as e:
+            dead.append(dict(line=line_no, error=str(e), record=record))
+
+    user_ids = {row[0] for _, _, row in rows}
+    known = {user_id for (user_id,) in (db.session
+                                        .query(User.id)
+                                        .filter(User.id.in_(user_ids)))}
+    valid = []
+    for line_no, record, row in rows:
+        if row[0] in known:
+            valid.append((line_no, record, row))
+        else:
+            dead.append(dict(line=line_no, error="unknown user_id",
+                             record=record))
+
+    if valid:
+        try:
+            if db.engine.dialect.name == 'postgresql':
+                _copy_rows([row for _, _, row in valid])
+            else:
+                _insert_rows([row for _, _, row in valid])
+            db.session.commit()
+        except Exception as e:
+            # e.g. a user deleted mid-import; the batch is retryable
+            # from the dead letters
+            db.session.rollback()
+            dead.extend(dict(line=line_no, error=f"batch failed: {e}",
+                             record=record)
+                        for line_no, record, _ in valid)
+            return 0, dead
+
+    return len(valid), dead
+
+
+_worker_app = None
+
+
+def _init_worker(config):
+    """Give each worker process its own app, context and connections."""
+
+    global _worker_app
+
+    from app import create_app
+
+    _worker_app = create_app(config)
+    _worker_app.app_context().push()
+
+
+def import_messages(f, fmt, dead_letters, workers=1, batch_size=BATCH_SIZE,
+                    stats=None):
+    """Load messages from `f`, writing rejected rows to `dead_letters`.
+
+    With more than one worker, batches are loaded in parallel processes;
+    at most two per worker are queued at once, so the whole file is never
+    read into memory. Returns the ImportStats.
+    """
+
+    if stats is None:
+        stats = ImportStats()
+
+    def handle(result):
+        loaded, dead = result
+        for letter in sorted(dead, key=lambda letter: letter['line']):
+            dead_letters.write(json.dumps(letter) + '\n')
+        stats.add(loaded, len(dead))
+
+    source = batches(read_records(f, fmt), batch_size)
+
+    if workers <= 1:
+        for batch in source:
+            handle(load_batch(batch))
+        return stats
+
+    from app import portable_config
+
+    config = portable_config(current_app)
+    with multiprocessing.Pool(workers, _init_worker, (config,)) as pool:
+        pending = deque()
+        for batch in source:
+            pending.append(pool.apply_async(load_batch, (batch,)))
+            if len(pending) >= workers * 2:
+                handle(pending.popleft().get())
+        while pending:
+            handle(pending.popleft().get())
+
+    return stats
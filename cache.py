@@ -0,0 +1,575 @@
+"""Shared cache for Warbler.
+
+`cache` is configured from the Flask config by `cache.init_app(app)`:
+
+- CACHE_TYPE: 'local' (in-process LRU, the default), 'file' (a directory
+  shared by every worker on the machine), 'memcached' or 'null'.
+- CACHE_DEFAULT_TIMEOUT: TTL in seconds when `set` isn't given one
+  (0 means no expiry).
+- CACHE_KEY_PREFIX: prepended to every key.
+- CACHE_MAX_SIZE: entries kept by the 'local' backend.
+- CACHE_DIR: directory for the 'file' backend.
+- CACHE_SWEEP_INTERVAL: seconds between sweeps of expired 'file' entries.
+- CACHE_SERVERS: list of "host:port" strings for the 'memcached' backend.
+
+Every backend has the same interface: get, set, delete, get_many, incr and
+clear. `cache.namespace(name)` returns a view whose keys can all be
+invalidated at once by bumping its version.
+"""
+
+import fcntl
+import hashlib
+import os
+import pickle
+import socket
+import tempfile
+import zlib
+from collections import OrderedDict
+from threading import Lock, local
+from time import time
+
+# memcached treats expiry times above 30 days as unix timestamps
+MEMCACHED_MAX_RELATIVE_TTL = 60 * 60 * 24 * 30
+
+# a FileCache temp or lock file this old was left by a crashed writer
+STALE_FILE_SECONDS = 60
+
+
+class BaseCache:
+    """Interface every cache backend implements.
+
+    `ttl` is in seconds; None means the backend's default, 0 means never
+    expire.
+    """
+
+    def __init__(self, default_ttl=300):
+        self.default_ttl = default_ttl
+
+    def _expires(self, ttl):
+        ttl = self.default_ttl if ttl is None else ttl
+        return time() + ttl if ttl else None
+
+    def get(self, key):
+        """Return the value for `key`, or None if missing or expired."""
+
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        """Store `value` under `key`."""
+
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Remove `key`, if present."""
+
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        """Return a dict of the keys in `keys` that are present."""
+
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def incr(self, key, delta=1, ttl=None):
+        """Add `delta` to the integer at `key` (starting from 0).
+
+        Returns the new value.
+        """
+
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove everything."""
+
+        raise NotImplementedError
+
+    def namespace(self, name):
+        """Return a versioned view of this cache for keys under `name`."""
+
+        return Namespace(self, name)
+
+
+class Namespace:
+    """Keys grouped under a name and version, invalidated as one."""
+
+    def __init__(self, cache, name):
+        self.cache = cache
+        self.name = name
+        self._version_key = f"__ns__:{name}"
+
+    def _prefix(self):
+        version = self.cache.get(self._version_key) or 0
+        return f"{self.name}:{version}:"
+
+    def invalidate(self):
+        """Make every key in the namespace unreachable."""
+
+        self.cache.incr(self._version_key, ttl=0)
+
+    def get(self, key):
+        return self.cache.get(self._prefix() + key)
+
+    def set(self, key, value, ttl=None):
+        self.cache.set(self._prefix() + key, value, ttl)
+
+    def delete(self, key):
+        self.cache.delete(self._prefix() + key)
+
+    def get_many(self, keys):
+        prefix = self._prefix()
+        found = self.cache.get_many([prefix + key for key in keys])
+        return {key[len(prefix):]: value for key, value in found.items()}
+
+    def incr(self, key, delta=1, ttl=None):
+        return self.cache.incr(self._prefix() + key, delta, ttl)
+
+
+class NullCache(BaseCache):
+    """Cache that stores nothing."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def incr(self, key, delta=1, ttl=None):
+        return delta
+
+    def clear(self):
+        pass
+
+
+class LocalCache(BaseCache):
+    """Bounded in-process LRU cache. Each worker has its own copy."""
+
+    def __init__(self, default_ttl=300, max_size=10000):
+        super().__init__(default_ttl)
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires <= time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries[key] = (self._expires(ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def incr(self, key, delta=1, ttl=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[0] is not None and entry[0] <= time()):
+                entry = (self._expires(ttl), 0)
+            value = entry[1] + delta
+            self._entries[key] = (entry[0], value)
+            self._entries.move_to_end(key)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FileCache(BaseCache):
+    """Cache stored as one file per key in a local directory.
+
+    Every process on the machine sees the same entries, so it works across
+    forked gunicorn workers. Writes go through a rename so readers never see
+    a partial file; `incr` holds an flock while it reads and rewrites.
+    Expired entries are deleted by `sweep`, which `set` runs once every
+    `sweep_interval` seconds among all the processes sharing the directory.
+    """
+
+    SWEPT = '.swept'
+
+    def __init__(self, directory, default_ttl=300, sweep_interval=300):
+        super().__init__(default_ttl)
+        self.directory = directory
+        self.sweep_interval = sweep_interval
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _load(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None, None
+
+    def _read(self, path):
+        expires, value = self._load(path)
+        if expires is not None and expires <= time():
+            return None
+        return value
+
+    def _write(self, path, value, expires):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((expires, value), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def get(self, key):
+        return self._read(self._path(key))
+
+    def set(self, key, value, ttl=None):
+        self._write(self._path(key), value, self._expires(ttl))
+        self._maybe_sweep()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _lock(self, path):
+        """Open and flock `path`, retrying if a sweep unlinked it meanwhile."""
+
+        while True:
+            lock = open(path, 'a')
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.samestat(os.fstat(lock.fileno()), os.stat(path)):
+                    return lock
+            except FileNotFoundError:
+                pass
+            lock.close()
+
+    def incr(self, key, delta=1, ttl=None):
+        path = self._path(key)
+        with self._lock(path + '.lock') as lock:
+            try:
+                value = (self._read(path) or 0) + delta
+                self._write(path, value, self._expires(ttl))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return value
+
+    def _maybe_sweep(self):
+        marker = os.path.join(self.directory, self.SWEPT)
+        now = time()
+        try:
+            if os.stat(marker).st_mtime > now - self.sweep_interval:
+                return
+            os.utime(marker, (now, now))
+        except FileNotFoundError:
+            open(marker, 'a').close()
+        self.sweep()
+
+    def _remove_lock(self, path):
+        """Delete lock file `path` unless someone holds it."""
+
+        with open(path, 'rb') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            # `_lock` notices and takes a fresh file
+            os.remove(path)
+            return True
+
+    def sweep(self):
+        """Delete expired entries and files left by crashed writers.
+
+        Returns the number of files deleted.
+        """
+
+        now = time()
+        removed = 0
+        for filename in os.listdir(self.directory):
+            if filename.startswith('.'):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                stat = os.stat(path)
+                if filename.endswith('.tmp') or filename.endswith('.lock'):
+                    if stat.st_mtime > now - STALE_FILE_SECONDS:
+                        continue
+                    if filename.endswith('.lock'):
+                        removed += self._remove_lock(path)
+                        continue
+                else:
+                    expires, _ = self._load(path)
+                    if expires is None or expires > now:
+                        continue
+                    # unless it was rewritten since we read it
+                    if not os.path.samestat(stat, os.stat(path)):
+                        continue
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def clear(self):
+        for filename in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+
+
+class MemcachedCache(BaseCache):
+    """Client for servers speaking the memcached text protocol.
+
+    Keys are spread over `servers` by CRC32. Integers are stored as ASCII
+    digits so server-side `incr` works on them; anything else is pickled.
+    Each thread (or greenlet, once gevent has patched threading) has its
+    own connections, so replies can't cross between requests; they're
+    reopened after a fork. Counters can't go below 0: memcached's `decr`
+    stops there.
+
+    Servers are shared, so `clear` doesn't flush them: every key carries
+    the generation stored under `prefix`, and clearing bumps it. A server
+    that can't be reached counts as a miss: `get` finds nothing, `set` and
+    `delete` do nothing and `incr` returns None.
+    """
+
+    FLAG_INT = 0
+    FLAG_PICKLE = 1
+
+    def __init__(self, servers, default_ttl=300, timeout=1.0, prefix=''):
+        super().__init__(default_ttl)
+        self.servers = [self._parse_server(server) for server in servers]
+        self.timeout = timeout
+        self._local = local()
+        self._generation_key = self._key(prefix + '__generation__')
+
+    @staticmethod
+    def _parse_server(server):
+        host, _, port = server.rpartition(':')
+        return host, int(port)
+
+    @staticmethod
+    def _key(key, generation=None):
+        # memcached keys can't contain whitespace or exceed 250 bytes
+        if generation is not None:
+            key = f"{generation}:{key}"
+        key = key.encode('utf-8')
+        if len(key) > 200 or any(c <= 32 or c == 127 for c in key):
+            key = b'sha1:' + hashlib.sha1(key).hexdigest().encode()
+        return key
+
+    def _server(self, key):
+        return self.servers[zlib.crc32(key) % len(self.servers)]
+
+    def _conns(self):
+        """This thread's {server: (socket, reader)}."""
+
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.conns = {}
+            self._local.pid = os.getpid()
+        return self._local.conns
+
+    def _call(self, server, command, read):
+        """Send `command` to `server` and parse the reply with `read`.
+
+        Returns None, dropping the connection, if the server can't be
+        reached or the reply is cut off.
+        """
+
+        conns = self._conns()
+        try:
+            conn = conns.get(server)
+            if conn is None:
+                sock = socket.create_connection(server, self.timeout)
+                conn = conns[server] = (sock, sock.makefile('rb'))
+            sock, reader = conn
+            sock.sendall(command)
+            return read(reader)
+        except (OSError, ValueError):
+            conn = conns.pop(server, None)
+            if conn:
+                conn[0].close()
+            return None
+
+    def _generation(self):
+        """The current generation, or None if its server is down."""
+
+        key = self._generation_key
+        values = self._call(self._server(key), b'get %s\r\n' % key,
+                            self._read_values)
+        return None if values is None else values.get(key, 0)
+
+    def _ttl(self, ttl):
+        ttl = self.default_ttl if ttl is None else ttl
+        if ttl > MEMCACHED_MAX_RELATIVE_TTL:
+            return int(time() + ttl)
+        return int(ttl)
+
+    def _encode(self, value):
+        if isinstance(value, int) and not isinstance(value, bool):
+            return self.FLAG_INT, str(value).encode()
+        return self.FLAG_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _decode(self, flags, data):
+        if flags == self.FLAG_INT:
+            return int(data)
+        return pickle.loads(data)
+
+    def _store(self, verb, key, value, ttl):
+        flags, data = self._encode(value)
+        command = b'%s %s %d %d %d\r\n%s\r\n' % (
+            verb, key, flags, self._ttl(ttl), len(data), data)
+        return self._call(self._server(key), command,
+                          lambda r: r.readline().strip())
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        generation = self._generation()
+        if generation is None:
+            return {}
+
+        by_server = {}
+        for key in keys:
+            mkey = self._key(key, generation)
+            by_server.setdefault(self._server(mkey), {})[mkey] = key
+
+        found = {}
+        for server, mkeys in by_server.items():
+            command = b'get ' + b' '.join(mkeys) + b'\r\n'
+            values = self._call(server, command, self._read_values) or {}
+            for mkey, value in values.items():
+                found[mkeys[mkey]] = value
+        return found
+
+    def _read_values(self, reader):
+        values = {}
+        while True:
+            line = reader.readline()
+            if not line:
+                raise ValueError("memcached connection closed")
+            if line == b'END\r\n':
+                return values
+            _, mkey, flags, length = line.split()
+            data = reader.read(int(length) + 2)[:-2]
+            values[mkey] = self._decode(int(flags), data)
+
+    def set(self, key, value, ttl=None):
+        generation = self._generation()
+        if generation is not None:
+            self._store(b'set', self._key(key, generation), value, ttl)
+
+    def delete(self, key):
+        generation = self._generation()
+        if generation is not None:
+            mkey = self._key(key, generation)
+            self._call(self._server(mkey), b'delete %s\r\n' % mkey,
+                       lambda r: r.readline())
+
+    def incr(self, key, delta=1, ttl=None):
+        generation = self._generation()
+        if generation is None:
+            return None
+        return self._incr(self._key(key, generation), delta, ttl)
+
+    def _incr(self, mkey, delta, ttl):
+        server = self._server(mkey)
+        verb = b'incr' if delta >= 0 else b'decr'
+        while True:
+            reply = self._call(server,
+                               b'%s %s %d\r\n' % (verb, mkey, abs(delta)),
+                               lambda r: r.readline().strip())
+            if reply is None:
+                return None
+            if reply != b'NOT_FOUND':
+                if not reply.isdigit():
+                    raise ValueError(f"memcached {verb.decode()}: {reply!r}")
+                return int(reply)
+            # start the counter; if another client beat us to it, retry
+            start = max(delta, 0)
+            stored = self._store(b'add', mkey, start, ttl)
+            if stored is None:
+                return None
+            if stored == b'STORED':
+                return start
+
+    def clear(self):
+        self._incr(self._generation_key, 1, 0)
+
+
+class Cache(BaseCache):
+    """The app's cache; forwards to the backend chosen in `init_app`."""
+
+    def __init__(self):
+        self.backend = LocalCache()
+        self.prefix = ''
+
+    def init_app(self, app):
+        """Pick and configure the backend from `app.config`."""
+
+        config = app.config
+        config.setdefault('CACHE_TYPE', 'local')
+        config.setdefault('CACHE_DEFAULT_TIMEOUT', 300)
+        config.setdefault('CACHE_KEY_PREFIX', 'warbler:')
+        config.setdefault('CACHE_MAX_SIZE', 10000)
+        config.setdefault('CACHE_DIR', os.path.join(tempfile.gettempdir(),
+                                                    'warbler-cache'))
+        config.setdefault('CACHE_SERVERS', ['127.0.0.1:11211'])
+        config.setdefault('CACHE_SWEEP_INTERVAL', 300)
+
+        cache_type = config['CACHE_TYPE']
+        ttl = config['CACHE_DEFAULT_TIMEOUT']
+        if cache_type == 'local':
+            self.backend = LocalCache(ttl, config['CACHE_MAX_SIZE'])
+        elif cache_type == 'file':
+            self.backend = FileCache(config['CACHE_DIR'], ttl,
+                                     config['CACHE_SWEEP_INTERVAL'])
+        elif cache_type == 'memcached':
+            self.backend = MemcachedCache(config['CACHE_SERVERS'], ttl,
+                                          prefix=config['CACHE_KEY_PREFIX'])
+        elif cache_type == 'null':
+            self.backend = NullCache(ttl)
+        else:
+            raise ValueError(f"Unknown CACHE_TYPE {cache_type!r}")
+        self.prefix = config['CACHE_KEY_PREFIX']
+
+    def get(self, key):
+        return self.backend.get(self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        self.backend.set(self.prefix + key, value, ttl)
+
+    def delete(self, key):
+        self.backend.delete(self.prefix + key)
+
+    def get_many(self, keys):
+        found = self.backend.get_many([self.prefix + key for key in keys])
+        return {key[len(self.prefix):]: value for key, value in found.items()}
+
+    def incr(self, key, delta=1, ttl=None):
+        return self.backend.incr(self.prefix + key, delta, ttl)
+
+    def clear(self):
+        self.backend.clear()
+
+
+cache = Cache()
@@ -0,0 +1,200 @@
+"""WSGI middleware that gzip/brotli-compresses text responses."""
+
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/csv',
+    'application/json',
+    'application/javascript',
+    'application/x-ndjson',
+    'image/svg+xml',
+}
+
+
+def accepted_codings(accept_encoding):
+    """Return the set of codings a client accepts (ignoring q=0)."""
+
+    codings = set()
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        name, _, q = params.replace(' ', '').partition('=')
+        if name.lower() == 'q':
+            try:
+                if float(q) <= 0:
+                    continue
+            except ValueError:
+                continue
+        codings.add(coding.strip().lower())
+    return codings
+
+
+def _header(headers, name):
+    """Case-insensitive lookup in a WSGI header list."""
+
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def _replace_header(headers, name, value):
+    """Return `headers` with `name` set to `value` (or removed if None)."""
+
+    lower = name.lower()
+    headers = [(k, v) for k, v in headers if k.lower() != lower]
+    if value is not None:
+        headers.append((name, value))
+    return headers
+
+
+class CompressionMiddleware:
+    """Compress HTML, JSON and other text responses on the way out.
+
+    Brotli is preferred when the brotli package is installed and the
+    client accepts it, otherwise gzip. Responses smaller than `min_size`
+    bytes, non-text responses and responses that already carry a
+    Content-Encoding (such as precompressed static assets) pass through
+    untouched. With `streaming` on, responses without a Content-Length are
+    compressed chunk by chunk instead of being buffered first.
+    """
+
+    def __init__(self, app, min_size=500, level=6, streaming=False):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.streaming = streaming
+
+    def _choose_encoding(self, environ):
+        codings = accepted_codings(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if brotli is not None and 'br' in codings:
+            return 'br'
+        if 'gzip' in codings:
+            return 'gzip'
+        return None
+
+    def _compressor(self, encoding):
+        """Return (compress, flush, finish) callables for `encoding`."""
+
+        if encoding == 'br':
+            # brotli quality runs 0-11; map the zlib-style 1-9 level onto it
+            comp = brotli.Compressor(quality=min(11, self.level + 2))
+            return comp.process, comp.flush, comp.finish
+
+        comp = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return (comp.compress,
+                lambda: comp.flush(zlib.Z_SYNC_FLUSH),
+                comp.flush)
+
+    def _should_compress(self, status, headers, environ):
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return False
+        if not status.startswith('200'):
+            return False
+        if _header(headers, 'Content-Encoding'):
+            return False
+        content_type = (_header(headers, 'Content-Type') or '')
+        return content_type.split(';')[0].strip() in COMPRESSIBLE_TYPES
+
+    def _compressed_headers(self, headers, encoding, length):
+        headers = _replace_header(headers, 'Content-Encoding', encoding)
+        headers = _replace_header(
+            headers, 'Content-Length',
+            str(length) if length is not None else None)
+
+        vary = _header(headers, 'Vary')
+        if not vary:
+            headers = _replace_header(headers, 'Vary', 'Accept-Encoding')
+        elif 'accept-encoding' not in vary.lower():
+            headers = _replace_header(headers, 'Vary',
+                                      f"{vary}, Accept-Encoding")
+
+        # the compressed body is a different representation
+        etag = _header(headers, 'ETag')
+        if etag and not etag.startswith('W/'):
+            headers = _replace_header(headers, 'ETag', f"W/{etag}")
+
+        return headers
+
+    def __call__(self, environ, start_response):
+        encoding = self._choose_encoding(environ)
+        if encoding is None:
+            return self.app(environ, start_response)
+
+        captured = {}
+        written = []
+
+        def capture_start_response(status, headers, exc_info=None):
+            captured.update(status=status, headers=headers, exc_info=exc_info)
+            return written.append
+
+        app_iter = self.app(environ, capture_start_response)
+        status = captured['status']
+        headers = captured['headers']
+        exc_info = captured['exc_info']
+
+        if not self._should_compress(status, headers, environ):
+            start_response(status, headers, exc_info)
+            return self._chain(written, app_iter)
+
+        if self.streaming and _header(headers, 'Content-Length') is None:
+            start_response(status,
+                           self._compressed_headers(headers, encoding, None),
+                           exc_info)
+            return self._stream(encoding, written, app_iter)
+
+        try:
+            body = b''.join(written) + b''.join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+        if len(body) < self.min_size:
+            start_response(status, headers, exc_info)
+            return [body]
+
+        compress, _, finish = self._compressor(encoding)
+        body = compress(body) + finish()
+        start_response(status,
+                       self._compressed_headers(headers, encoding, len(body)),
+                       exc_info)
+        return [body]
+
+    def _chain(self, written, app_iter):
+        try:
+            yield from written
+            yield from app_iter
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    def _stream(self, encoding, written, app_iter):
+        compress, flush, finish = self._compressor(encoding)
+        for chunk in self._chain(written, app_iter):
+            if chunk:
+                # flush per chunk so clients see data as it is produced
+                yield compress(chunk) + flush()
+        yield finish()
+
+
+def init_app(app):
+    """Wrap `app` in CompressionMiddleware, configured from `app.config`."""
+
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+    app.config.setdefault('COMPRESS_STREAMING', True)
+
+    app.wsgi_app = CompressionMiddleware(
+        app.wsgi_app,
+        min_size=app.config['COMPRESS_MIN_SIZE'],
+        level=app.config['COMPRESS_LEVEL'],
+        streaming=app.config['COMPRESS_STREAMING'],
+    )
@@ -0,0 +1,206 @@
+"""Streaming export of a user's messages, likes and follows.
+
+Rows are read with a server-side cursor (`stream_results`) in chunks of
+EXPORT_CHUNK_SIZE and encoded as they arrive, so an export holds one chunk
+in memory however big the account is. The HTTP views send the generator
+as a chunked response; `flask export-user` writes it to a file.
+
+Messages already moved to cold storage by archive.py, and likes of
+them, are read back from their partition files ahead of the live ones.
+Only the blocks holding the user's rows are read.
+"""
+
+import csv
+import io
+import json
+import time
+from datetime import datetime
+
+import archive
+from models import db, Message, Likes, Follows
+
+# rows fetched from the cursor (and encoded) at a time
+EXPORT_CHUNK_SIZE = 1000
+
+# how many rows between progress reports
+PROGRESS_EVERY = 100000
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def _messages(user_id):
+    return (db.select([Message.id, Message.text, Message.timestamp])
+            .where(Message.user_id == user_id)
+            .order_by(Message.id))
+
+
+def _likes(user_id):
+    return (db.select([Likes.message_id, Message.text, Message.user_id])
+            .select_from(Likes.__table__.join(Message.__table__))
+            .where(Likes.user_id == user_id)
+            .order_by(Likes.message_id))
+
+
+def _following(user_id):
+    return (db.select([Follows.user_being_followed_id.label('user_id')])
+            .where(Follows.user_following_id == user_id)
+            .order_by(Follows.user_being_followed_id))
+
+
+def _followers(user_id):
+    return (db.select([Follows.user_following_id.label('user_id')])
+            .where(Follows.user_being_followed_id == user_id)
+            .order_by(Follows.user_following_id))
+
+
+# dataset name -> (columns, query builder)
+DATASETS = {
+    'messages': (('id', 'text', 'timestamp'), _messages),
+    'likes': (('message_id', 'text', 'author_id'), _likes),
+    'following': (('user_id',), _following),
+    'followers': (('user_id',), _followers),
+}
+
+
+class ExportProgress:
+    """Rows and bytes written so far, and how fast."""
+
+    def __init__(self, report=None, every=PROGRESS_EVERY):
+        self.rows = 0
+        self.bytes = 0
+        self.started = time.perf_counter()
+        self._report = report
+        self._every = every
+        self._next_report = every
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def add(self, rows, data):
+        self.rows += rows
+        self.bytes += len(data)
+        if self._report and self.rows >= self._next_report:
+            self._report(self)
+            self._next_report = self.rows + self._every
+
+    def __str__(self):
+        return (f"{self.rows} rows, {self.bytes / 1e6:.1f} MB in "
+                f"{self.elapsed:.1f}s ({self.rows_per_second:.0f} rows/s)")
+
+
+def _archived_messages(user_id):
+    """Yield (id, text, timestamp) for the user's archived messages."""
+
+    for data in archive.archived_messages_of(user_id):
+        yield (data['id'], data['text'],
+               datetime.strptime(data['timestamp'], archive.TIMESTAMP_FORMAT))
+
+
+def _archived_likes(user_id):
+    """Yield (message_id, text, author_id) for archived messages liked."""
+
+    for data in archive.archived_likes_of(user_id):
+        yield data['id'], data['text'], data['user_id']
+
+
+# dataset name -> rows of it in cold storage
+ARCHIVED = {
+    'messages': _archived_messages,
+    'likes': _archived_likes,
+}
+
+
+def iter_rows(user_id, dataset, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield lists of at most `chunk_size` rows of `dataset`."""
+
+    if dataset in ARCHIVED:
+        chunk = []
+        for row in ARCHIVED[dataset](user_id):
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    columns, query = DATASETS[dataset]
+    result = db.session.execute(
+        query(user_id).execution_options(stream_results=True))
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        result.close()
+
+
+def _value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def _csv_chunks(user_id, dataset, chunk_size):
+    columns, _ = DATASETS[dataset]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(columns)
+    yield 0, buffer.getvalue()
+
+    for rows in iter_rows(user_id, dataset, chunk_size):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([_value(v) for v in row] for row in rows)
+        yield len(rows), buffer.getvalue()
+
+
+def _ndjson_chunks(user_id, datasets, chunk_size):
+    for dataset in datasets:
+        columns, _ = DATASETS[dataset]
+        for rows in iter_rows(user_id, dataset, chunk_size):
+            lines = []
+            for row in rows:
+                record = {'type': dataset}
+                record.update(zip(columns, map(_value, row)))
+                lines.append(json.dumps(record) + '\n')
+            yield len(rows), ''.join(lines)
+
+
+def export(user_id, dataset, fmt, progress=None,
+           chunk_size=EXPORT_CHUNK_SIZE):
+    """Return a generator of `dataset` encoded as `fmt`, in pieces.
+
+    `dataset` may be 'account' for every dataset, in NDJSON only, where
+    each record carries its dataset under "type". Raises ValueError for
+    unknown datasets and formats before anything is read.
+    """
+
+    if fmt == 'csv':
+        if dataset not in DATASETS:
+            raise ValueError(f"Can't export {dataset!r} as CSV")
+        chunks = _csv_chunks(user_id, dataset, chunk_size)
+    elif fmt == 'ndjson':
+        datasets = list(DATASETS) if dataset == 'account' else [dataset]
+        if not set(datasets) <= set(DATASETS):
+            raise ValueError(f"Unknown dataset {dataset!r}")
+        chunks = _ndjson_chunks(user_id, datasets, chunk_size)
+    else:
+        raise ValueError(f"Unknown export format {fmt!r}")
+
+    return _track(chunks, progress)
+
+
+def _track(chunks, progress):
+    for rows, data in chunks:
+        if progress is not None:
+            progress.add(rows, data)
+        yield data
@@ -1,7 +1,10 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileAllowed
 from wtforms import StringField, PasswordField, TextAreaField
 from wtforms.validators import DataRequired, Email, Length, Optional
 
+IMAGE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'gif', 'webp']
+
 
 class MessageForm(FlaskForm):
     """Form for adding/editing messages."""
@@ -16,6 +19,8 @@ class UserAddForm(FlaskForm):
     email = StringField('E-mail', validators=[DataRequired(), Email()])
     password = PasswordField('Password', validators=[Length(min=6)])
     image_url = StringField('(Optional) Image URL')
+    image_file = FileField('(Optional) Upload an image',
+                           validators=[FileAllowed(IMAGE_EXTENSIONS)])
 
 
 class LoginForm(FlaskForm):
@@ -31,6 +36,10 @@ class EditProfile(FlaskForm):
     username = StringField('Username:', validators=[DataRequired()])
     email = StringField('Email:', validators=[Optional(), Email()])
     image_url = StringField('(Optional) Image URL:')
+    image_file = FileField('(Optional) Upload an image:',
+                           validators=[FileAllowed(IMAGE_EXTENSIONS)])
     header_image_url = StringField('(Optional) Background URL:')
+    header_image_file = FileField('(Optional) Upload a background:',
+                                  validators=[FileAllowed(IMAGE_EXTENSIONS)])
     bio = StringField('(Optional) User Bio:')
     password = PasswordField('Verify Password:', validators=[Length(min=6)])
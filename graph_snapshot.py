@@ -0,0 +1,236 @@
+"""Memory-mapped snapshot of the follows graph.
+
+The snapshot file holds the graph twice in CSR form, as int32 arrays:
+who each user follows and who follows each user. Neighbor lists are
+sorted, so "does A follow B" is a binary search, and intersections
+(followers in common, people you follow who follow someone) are sorted
+merges. Readers memory-map the file, so every gunicorn worker shares the
+same pages and nothing is copied.
+
+`flask export-graph` writes the snapshot. The first run reads the whole
+follows table. Later runs apply the rows in graph_changes, which
+follow/unfollow append to, and delete exactly the rows they applied. A
+change committed after an export started, even one holding a lower id
+than changes already applied, is simply still there for the next run.
+The new file is renamed over the old one, and open readers switch to it
+on their next `refresh()`.
+
+Layout: a 40-byte header (magic, version, num_users, num_edges,
+highest graph_changes id applied), then out_offsets[num_users + 1],
+out_neighbors[num_edges], in_offsets[num_users + 1], in_neighbors[num_edges].
+"""
+
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+from models import db, Follows, GraphChange
+
+MAGIC = b'WGRAPH\x00\x00'
+VERSION = 1
+HEADER = struct.Struct('<8sqqqq')
+
+# graph_changes rows deleted per statement once applied
+PRUNE_CHUNK = 10000
+
+
+def _csr(sources, targets, num_users):
+    """Return (offsets, neighbors) with each node's neighbors sorted."""
+
+    order = np.lexsort((targets, sources))
+    counts = np.bincount(sources, minlength=num_users)
+    offsets = np.zeros(num_users + 1, dtype=np.int32)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets, targets[order].astype(np.int32)
+
+
+def write_snapshot(path, followers, followed, watermark=0):
+    """Write the graph with edges follower -> followed to `path`."""
+
+    followers = np.asarray(followers, dtype=np.int64)
+    followed = np.asarray(followed, dtype=np.int64)
+    num_users = int(max(followers.max(initial=-1),
+                        followed.max(initial=-1))) + 1
+    num_edges = len(followers)
+
+    out_offsets, out_neighbors = _csr(followers, followed, num_users)
+    in_offsets, in_neighbors = _csr(followed, followers, num_users)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, num_users, num_edges, watermark))
+        for array in (out_offsets, out_neighbors, in_offsets, in_neighbors):
+            f.write(array.tobytes())
+    os.replace(tmp, path)
+
+
+class GraphSnapshot:
+    """Read-only, memory-mapped view of a snapshot file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._stat = None
+        self.refresh()
+
+    def refresh(self):
+        """Remap the file if a newer snapshot has replaced it."""
+
+        stat = os.stat(self.path)
+        if self._stat and (stat.st_ino, stat.st_mtime_ns) == self._stat:
+            return False
+
+        data = np.memmap(self.path, dtype=np.uint8, mode='r')
+        magic, version, num_users, num_edges, watermark = \
+            HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{self.path} is not a graph snapshot")
+
+        def take(offset, count):
+            array = np.frombuffer(data, np.int32, count, offset)
+            return array, offset + count * 4
+
+        offset = HEADER.size
+        self.out_offsets, offset = take(offset, num_users + 1)
+        self.out_neighbors, offset = take(offset, num_edges)
+        self.in_offsets, offset = take(offset, num_users + 1)
+        self.in_neighbors, offset = take(offset, num_edges)
+
+        self.num_users = num_users
+        self.num_edges = num_edges
+        self.watermark = watermark
+        self._stat = (stat.st_ino, stat.st_mtime_ns)
+        return True
+
+    def _slice(self, offsets, neighbors, user_id):
+        if not 0 <= user_id < self.num_users:
+            return neighbors[:0]
+        return neighbors[offsets[user_id]:offsets[user_id + 1]]
+
+    def following(self, user_id):
+        """Sorted ids of the users `user_id` follows."""
+
+        return self._slice(self.out_offsets, self.out_neighbors, user_id)
+
+    def followers(self, user_id):
+        """Sorted ids of the users following `user_id`."""
+
+        return self._slice(self.in_offsets, self.in_neighbors, user_id)
+
+    def following_count(self, user_id):
+        return len(self.following(user_id))
+
+    def follower_count(self, user_id):
+        return len(self.followers(user_id))
+
+    def is_following(self, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?"""
+
+        following = self.following(follower_id)
+        i = np.searchsorted(following, followed_id)
+        return bool(i < len(following) and following[i] == followed_id)
+
+    def mutual_followers(self, user_id, other_id):
+        """Ids of users who follow both `user_id` and `other_id`."""
+
+        return np.intersect1d(self.followers(user_id),
+                              self.followers(other_id), assume_unique=True)
+
+    def followed_by_following(self, viewer_id, user_id):
+        """Ids of people `viewer_id` follows who follow `user_id`."""
+
+        return np.intersect1d(self.following(viewer_id),
+                              self.followers(user_id), assume_unique=True)
+
+    def degree_stats(self):
+        """Summary statistics of follower counts across all users."""
+
+        degrees = np.diff(self.in_offsets)
+        if not len(degrees):
+            return dict(users=0, edges=0, mean=0.0, median=0.0, p99=0.0,
+                        max=0)
+        return dict(users=self.num_users, edges=self.num_edges,
+                    mean=float(degrees.mean()),
+                    median=float(np.median(degrees)),
+                    p99=float(np.percentile(degrees, 99)),
+                    max=int(degrees.max()))
+
+
+def export_snapshot(path):
+    """Bring the snapshot at `path` up to date with the database.
+
+    Applies graph_changes on top of an existing snapshot, or reads the
+    whole follows table if there isn't one. Returns the number of edges.
+    """
+
+    # whatever commits after this is left for the next export
+    changes = (db.session
+               .query(GraphChange.id, GraphChange.follower_id,
+                      GraphChange.followed_id, GraphChange.added)
+               .order_by(GraphChange.id)
+               .all())
+    applied = [change[0] for change in changes]
+    watermark = applied[-1] if applied else 0
+
+    if os.path.exists(path):
+        snapshot = GraphSnapshot(path)
+        if not changes:
+            return snapshot.num_edges
+
+        # edges as sorted int64 keys, follower in the high 32 bits
+        counts = np.diff(snapshot.out_offsets)
+        sources = np.repeat(np.arange(snapshot.num_users, dtype=np.int64),
+                            counts)
+        keys = (sources << 32) | snapshot.out_neighbors.astype(np.int64)
+
+        # only the last change to each edge matters
+        final = {}
+        for _, follower_id, followed_id, added in changes:
+            final[(follower_id << 32) | followed_id] = added
+        added = np.array([k for k, v in final.items() if v], dtype=np.int64)
+        removed = np.array([k for k, v in final.items() if not v],
+                           dtype=np.int64)
+
+        keys = np.union1d(np.setdiff1d(keys, removed, assume_unique=True),
+                          added)
+        followers, followed = keys >> 32, keys & 0xFFFFFFFF
+        watermark = max(watermark, snapshot.watermark)
+        del snapshot
+    else:
+        # may include changes committed since they were read; applying
+        # those again next time changes nothing
+        edges = np.array(db.session.query(Follows.user_following_id,
+                                          Follows.user_being_followed_id)
+                         .all(), dtype=np.int64).reshape(-1, 2)
+        followers, followed = edges[:, 0], edges[:, 1]
+
+    write_snapshot(path, followers, followed, watermark)
+
+    # only the changes read above: later ones may hold lower ids
+    for start in range(0, len(applied), PRUNE_CHUNK):
+        (GraphChange.query
+         .filter(GraphChange.id.in_(applied[start:start + PRUNE_CHUNK]))
+         .delete(synchronize_session=False))
+    db.session.commit()
+
+    return len(followers)
+
+
+_snapshot = None
+
+
+def get_snapshot(app):
+    """Shared snapshot for this process, or None if none has been exported."""
+
+    global _snapshot
+
+    path = app.config['GRAPH_SNAPSHOT_PATH']
+    if not os.path.exists(path):
+        return None
+    if _snapshot is None or _snapshot.path != path:
+        _snapshot = GraphSnapshot(path)
+    else:
+        _snapshot.refresh()
+    return _snapshot
@@ -0,0 +1,438 @@
+"""Background jobs, queued in the database and run by local workers.
+
+Register work with `@task('name')` and queue it from a view with
+`enqueue('name', args)`. The job joins the view's transaction, so it's
+queued only if the view commits, and the view returns without waiting
+for it. Giving a `key` makes queueing idempotent: while a job with that
+key is queued or running, queueing it again returns that job. A done or
+failed job under the key is queued afresh instead.
+
+Each web process runs JOBS_WORKERS worker threads, started when it first
+queues something. With JOBS_WORKERS = 0 nothing is queued: the task
+runs on the spot in the caller's transaction and its errors propagate,
+which suits tests and scripts. `flask work-jobs` runs workers on their
+own.
+
+Workers claim the oldest due job with SELECT ... FOR UPDATE SKIP LOCKED
+on Postgres, so they never wait on each other; SQLite has no row locks,
+so there a job is claimed by an UPDATE that only succeeds while it's
+still queued. A claimed job is leased for JOBS_LEASE_SECONDS. One that
+raises is retried after JOBS_BACKOFF_SECONDS, doubling each time up to
+JOBS_MAX_BACKOFF_SECONDS, and marked failed after JOBS_MAX_ATTEMPTS. A
+job whose lease runs out (its worker died) is queued again, so tasks
+must be safe to run twice. Tasks that may outlast a lease call
+`heartbeat()` between steps to renew it; it raises LeaseLost once
+another worker has taken the job over.
+
+Finished jobs are deleted JOBS_KEEP_SECONDS after they're done; failed
+ones are kept for inspection. Queue depth and job wait and run times are
+served at /metrics.
+"""
+
+import json
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import metrics
+from models import db, Job
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# due jobs a SQLite worker tries to take per poll before giving up
+CLAIM_CANDIDATES = 10
+
+# finished jobs deleted per transaction
+PURGE_BATCH_SIZE = 1000
+
+tasks = {}
+
+# (id, attempts) of the job this thread is running
+_running = threading.local()
+
+
+class LeaseLost(Exception):
+    """The running job's lease ran out and it was claimed again."""
+
+
+def task(name):
+    """Register the decorated function to run jobs queued as `name`."""
+
+    def register(func):
+        tasks[name] = func
+        return func
+    return register
+
+
+def enqueue(name, args=None, key=None, delay=0):
+    """Queue task `name` with `args`, a JSON-able dict; return its Job.
+
+    Joins the caller's transaction; the caller commits. With
+    JOBS_WORKERS = 0, runs the task now instead and returns None.
+    """
+
+    if name not in tasks:
+        raise LookupError(f"no task named {name!r}")
+
+    if not current_app.config['JOBS_WORKERS']:
+        tasks[name](**(args or {}))
+        return None
+
+    run_at = datetime.utcnow() + timedelta(seconds=delay)
+    if key is not None:
+        existing = Job.query.filter_by(key=key).first()
+        if existing is not None and existing.status in (QUEUED, RUNNING):
+            return existing
+        if existing is not None and _requeue(existing, name, args, run_at):
+            db.session.info['jobs_queued'] = True
+            _start_workers()
+            return existing
+
+    job = Job(task=name, args=json.dumps(args or {}), key=key,
+              run_at=run_at)
+    if key is None:
+        db.session.add(job)
+        db.session.flush()
+    else:
+        try:
+            with db.session.begin_nested():
+                db.session.add(job)
+        except IntegrityError:
+            # queued by another request just now
+            return Job.query.filter_by(key=key).one()
+
+    db.session.info['jobs_queued'] = True
+    _start_workers()
+    return job
+
+
+def _requeue(job, name, args, run_at):
+    # unless it was purged or queued again meanwhile
+    requeued = (Job.query
+                .filter(Job.id == job.id, Job.status.in_([DONE, FAILED]))
+                .update(dict(task=name, args=json.dumps(args or {}),
+                             status=QUEUED, attempts=0, run_at=run_at,
+                             enqueued_at=datetime.utcnow(), started_at=None,
+                             locked_until=None, finished_at=None,
+                             last_error=None),
+                        synchronize_session='fetch'))
+    return bool(requeued)
+
+
+##############################################################################
+# Claiming and running
+
+
+def _claimable(job_id=None):
+    query = Job.query.filter(Job.status == QUEUED,
+                             Job.run_at <= datetime.utcnow())
+    if job_id is not None:
+        query = query.filter(Job.id == job_id)
+    return query.order_by(Job.run_at, Job.id)
+
+
+def _lease():
+    now = datetime.utcnow()
+    return dict(status=RUNNING, attempts=Job.attempts + 1, started_at=now,
+                locked_until=now + timedelta(
+                    seconds=current_app.config['JOBS_LEASE_SECONDS']))
+
+
+def claim(job_id=None):
+    """Mark the oldest due job (or job `job_id`) running and return it.
+
+    Returns None if there's nothing to do.
+    """
+
+    if db.engine.dialect.name == 'postgresql':
+        job = _claimable(job_id).with_for_update(skip_locked=True).first()
+        if job is None:
+            db.session.rollback()
+            return None
+        (Job.query.filter(Job.id == job.id)
+         .update(_lease(), synchronize_session=False))
+        db.session.commit()
+        return Job.query.get(job.id)
+
+    candidates = [candidate_id for (candidate_id,) in _claimable(job_id)
+                  .with_entities(Job.id).limit(CLAIM_CANDIDATES)]
+    for candidate_id in candidates:
+        taken = (Job.query
+                 .filter(Job.id == candidate_id, Job.status == QUEUED)
+                 .update(_lease(), synchronize_session=False))
+        db.session.commit()
+        if taken:
+            return Job.query.get(candidate_id)
+    db.session.rollback()
+    return None
+
+
+def backoff(attempts):
+    """Seconds to wait before retrying a job that has failed `attempts`."""
+
+    config = current_app.config
+    return min(config['JOBS_BACKOFF_SECONDS'] * 2 ** (attempts - 1),
+               config['JOBS_MAX_BACKOFF_SECONDS'])
+
+
+def run(job):
+    """Run a claimed job and record how it went; return its status."""
+
+    job_id, name, attempts = job.id, job.task, job.attempts
+    args = json.loads(job.args)
+    metrics.JOB_WAIT_SECONDS.observe(
+        max((job.started_at - job.run_at).total_seconds(), 0), name)
+
+    start = time.perf_counter()
+    _running.job = (job_id, attempts)
+    try:
+        if name not in tasks:
+            raise LookupError(f"no task named {name!r}")
+        tasks[name](**args)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        if attempts >= current_app.config['JOBS_MAX_ATTEMPTS']:
+            outcome = FAILED
+            changes = dict(status=FAILED, finished_at=datetime.utcnow())
+        else:
+            outcome = 'retry'
+            changes = dict(status=QUEUED, run_at=datetime.utcnow()
+                           + timedelta(seconds=backoff(attempts)))
+        changes.update(last_error=traceback.format_exc(), locked_until=None)
+    else:
+        outcome = DONE
+        changes = dict(status=DONE, finished_at=datetime.utcnow(),
+                       locked_until=None)
+    finally:
+        _running.job = None
+    metrics.JOB_RUN_SECONDS.observe(time.perf_counter() - start, name,
+                                    outcome)
+
+    # unless the lease ran out and another worker has it now
+    (Job.query
+     .filter(Job.id == job_id, Job.status == RUNNING,
+             Job.attempts == attempts)
+     .update(changes, synchronize_session=False))
+    db.session.commit()
+    return changes['status']
+
+
+def heartbeat():
+    """Renew the lease of the job this thread is running, and commit.
+
+    Raises LeaseLost if it has been claimed again meanwhile. Does nothing
+    outside a job, e.g. when JOBS_WORKERS = 0 runs tasks on the spot.
+    """
+
+    running = getattr(_running, 'job', None)
+    if running is None:
+        return
+    job_id, attempts = running
+    renewed = (Job.query
+               .filter(Job.id == job_id, Job.status == RUNNING,
+                       Job.attempts == attempts)
+               .update(dict(locked_until=_lease()['locked_until']),
+                       synchronize_session=False))
+    db.session.commit()
+    if not renewed:
+        raise LeaseLost(f"job {job_id} was claimed again")
+
+
+def run_pending():
+    """Run due jobs in this thread until there are none; return how many."""
+
+    count = 0
+    while True:
+        job = claim()
+        if job is None:
+            return count
+        run(job)
+        count += 1
+
+
+def maintain():
+    """Requeue jobs whose lease ran out and delete old finished ones.
+
+    Returns (requeued, deleted).
+    """
+
+    now = datetime.utcnow()
+    requeued = (Job.query
+                .filter(Job.status == RUNNING, Job.locked_until < now)
+                .update(dict(status=QUEUED, locked_until=None),
+                        synchronize_session=False))
+    db.session.commit()
+
+    cutoff = now - timedelta(seconds=current_app.config['JOBS_KEEP_SECONDS'])
+    deleted = 0
+    while True:
+        ids = [job_id for (job_id,) in (db.session
+               .query(Job.id)
+               .filter(Job.status == DONE, Job.finished_at < cutoff)
+               .limit(PURGE_BATCH_SIZE))]
+        if not ids:
+            return requeued, deleted
+        Job.query.filter(Job.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        deleted += len(ids)
+
+
+def counts():
+    """[[[task, status], jobs]] of jobs not yet done, for /metrics."""
+
+    if not has_app_context():
+        return []
+    rows = (db.session
+            .query(Job.task, Job.status, db.func.count())
+            .filter(Job.status.in_([QUEUED, RUNNING, FAILED]))
+            .group_by(Job.task, Job.status))
+    return [[[name, status], count] for name, status, count in rows]
+
+
+##############################################################################
+# Workers
+
+
+class Worker:
+    """Threads running `app`'s jobs until stopped."""
+
+    def __init__(self, app, threads):
+        self.app = app
+        self.stopping = threading.Event()
+        self.wake = threading.Event()
+        self.threads = [threading.Thread(target=self._work, daemon=True,
+                                         name=f'jobs-{i}')
+                        for i in range(threads)]
+        self._next_maintenance = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Stop once the jobs being run are done."""
+
+        self.stopping.set()
+        self.wake.set()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def _maintenance_due(self):
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next_maintenance:
+                return False
+            self._next_maintenance = (
+                now + self.app.config['JOBS_MAINTAIN_SECONDS'])
+            return True
+
+    def _work(self):
+        poll = self.app.config['JOBS_POLL_SECONDS']
+        with self.app.app_context():
+            while not self.stopping.is_set():
+                try:
+                    if self._maintenance_due():
+                        maintain()
+                    job = claim()
+                    if job is not None:
+                        run(job)
+                        continue
+                except Exception:
+                    # e.g. the database is down; try again after a poll
+                    db.session.rollback()
+                    self.app.logger.exception("background job worker")
+                finally:
+                    metrics.maybe_flush()
+                self.wake.wait(poll)
+                self.wake.clear()
+            db.session.remove()
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def _start_workers():
+    global _worker
+
+    with _worker_lock:
+        if _worker is None:
+            _worker = Worker(current_app._get_current_object(),
+                             current_app.config['JOBS_WORKERS']).start()
+
+
+def _wake_workers(session):
+    # jobs just committed; don't leave them until the next poll
+    if session.info.pop('jobs_queued', False) and _worker is not None:
+        _worker.wake.set()
+
+
+def _until_interrupted(worker):
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+def _work_process(config, threads):
+    from app import create_app
+
+    _until_interrupted(Worker(create_app(config), threads).start())
+
+
+def work(threads, processes=1):
+    """Run workers in this process (and `processes` - 1 more) until ^C.
+
+    Jobs being run when interrupted are finished first.
+    """
+
+    from app import portable_config
+
+    app = current_app._get_current_object()
+    config = portable_config(app)
+    children = [multiprocessing.Process(target=_work_process,
+                                        args=(config, threads))
+                for _ in range(processes - 1)]
+    for child in children:
+        child.start()
+
+    _until_interrupted(Worker(app, threads).start())
+    for child in children:
+        # ^C in a terminal reaches them too
+        child.join(app.config['JOBS_POLL_SECONDS'] + 1)
+        if child.is_alive():
+            child.terminate()
+            child.join()
+
+
+def init_app(app):
+    """Read the job settings and report queue depth at /metrics."""
+
+    app.config.setdefault('JOBS_WORKERS',
+                          int(os.environ.get('JOBS_WORKERS', 2)))
+    app.config.setdefault('JOBS_POLL_SECONDS', 1)
+    app.config.setdefault('JOBS_LEASE_SECONDS', 5 * 60)
+    app.config.setdefault('JOBS_MAX_ATTEMPTS', 5)
+    app.config.setdefault('JOBS_BACKOFF_SECONDS', 10)
+    app.config.setdefault('JOBS_MAX_BACKOFF_SECONDS', 60 * 60)
+    app.config.setdefault('JOBS_KEEP_SECONDS', 24 * 60 * 60)
+    app.config.setdefault('JOBS_MAINTAIN_SECONDS', 60)
+
+    metrics.JOBS.read = counts
+    if not event.contains(Session, 'after_commit', _wake_workers):
+        event.listen(Session, 'after_commit', _wake_workers)
@@ -0,0 +1,146 @@
+"""Denormalized like counts on messages.
+
+messages.like_count is what pages show, so displaying a count costs
+nothing per message. `record_like()` changes it inside the caller's
+transaction as a single atomic `like_count = like_count + delta` UPDATE.
+
+A very popular message makes every like wait on the same row lock. With
+LIKE_COUNT_SHARDS set above zero, changes are instead added to one of that
+many like_count_shards rows picked at random, and `flask fold-like-counts`
+(run from cron) moves them into messages.like_count. Counts then lag by up
+to one fold.
+
+`flask reconcile-like-counts` recounts every message from the likes
+table, allowing for unfolded shard deltas, and repairs any drift. Run it
+once after adding the like_count column to an existing database.
+"""
+
+import random
+
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Message, Likes, LikeCountShard
+
+# shard rows folded per transaction
+FOLD_BATCH_SIZE = 10000
+
+# messages recounted per transaction when reconciling
+RECONCILE_BATCH_SIZE = 10000
+
+
+def _plus(count, delta):
+    # never below zero: a like may be taken back that was never counted
+    return db.case([(count + delta < 0, 0)], else_=count + delta)
+
+
+def record_like(message_id, delta=1):
+    """Add `delta` to the like count of `message_id`.
+
+    Joins the caller's transaction; the caller commits.
+    """
+
+    shards = current_app.config['LIKE_COUNT_SHARDS']
+    if not shards:
+        db.session.execute(
+            Message.__table__.update()
+            .where(Message.id == message_id)
+            .values(like_count=_plus(Message.like_count, delta)))
+        return
+
+    table = LikeCountShard.__table__
+    shard = random.randrange(shards)
+    match = (table.c.message_id == message_id) & (table.c.shard == shard)
+    update = table.update().where(match).values(delta=table.c.delta + delta)
+
+    if db.session.execute(update).rowcount:
+        return
+
+    try:
+        with db.session.begin_nested():
+            db.session.execute(table.insert().values(
+                message_id=message_id, shard=shard, delta=delta))
+    except IntegrityError:
+        # another request created the row first
+        db.session.execute(update)
+
+
+def fold_shards(batch_size=FOLD_BATCH_SIZE):
+    """Move shard deltas into messages.like_count.
+
+    Each delta is subtracted from its shard rather than the row being
+    deleted, so likes recorded while folding aren't lost. Returns the
+    number of messages updated.
+    """
+
+    table = LikeCountShard.__table__
+    messages = Message.__table__
+    updated = 0
+
+    while True:
+        rows = (db.session
+                .query(LikeCountShard.message_id, LikeCountShard.shard,
+                       LikeCountShard.delta)
+                .filter(LikeCountShard.delta != 0)
+                .limit(batch_size)
+                .all())
+        if not rows:
+            break
+
+        db.session.execute(
+            table.update()
+            .where((table.c.message_id == db.bindparam('m'))
+                   & (table.c.shard == db.bindparam('s')))
+            .values(delta=table.c.delta - db.bindparam('d')),
+            [dict(m=m, s=s, d=d) for m, s, d in rows])
+
+        totals = {}
+        for message_id, _, delta in rows:
+            totals[message_id] = totals.get(message_id, 0) + delta
+
+        db.session.execute(
+            messages.update()
+            .where(messages.c.id == db.bindparam('message_id'))
+            .values(like_count=_plus(messages.c.like_count,
+                                    db.bindparam('delta'))),
+            [dict(message_id=m, delta=d) for m, d in totals.items()])
+        db.session.commit()
+        updated += len(totals)
+
+    db.session.execute(table.delete().where(table.c.delta == 0))
+    db.session.commit()
+    return updated
+
+
+def reconcile(batch_size=RECONCILE_BATCH_SIZE):
+    """Recount likes for every message and fix wrong counts.
+
+    Returns the number of messages whose count was repaired.
+    """
+
+    liked = (db.select([db.func.count()])
+             .where(Likes.message_id == Message.id)
+             .as_scalar())
+    unfolded = (db.select([db.func.coalesce(db.func.sum(LikeCountShard.delta),
+                                            0)])
+                .where(LikeCountShard.message_id == Message.id)
+                .as_scalar())
+    expected = liked - unfolded
+
+    max_id = db.session.query(db.func.max(Message.id)).scalar() or 0
+    repaired = 0
+    for start in range(0, max_id + 1, batch_size):
+        repaired += (Message.query
+                     .filter(Message.id >= start,
+                             Message.id < start + batch_size,
+                             Message.like_count != expected)
+                     .update({Message.like_count: expected},
+                             synchronize_session=False))
+        db.session.commit()
+    return repaired
+
+
+def init_app(app):
+    """Read LIKE_COUNT_SHARDS (0 updates messages.like_count directly)."""
+
+    app.config.setdefault('LIKE_COUNT_SHARDS', 0)
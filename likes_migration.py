@@ -0,0 +1,304 @@
+"""Move likes to a compact table keyed on (user_id, message_id).
+
+likes used to have a surrogate id primary key and nullable user_id and
+message_id columns with nothing unique, so double likes piled up as
+duplicate rows. `flask migrate-likes` moves an existing database to the
+schema of models.Likes while the app keeps serving:
+
+1. `prepare()` creates likes_compact with the new schema and installs
+   triggers on likes that mirror every like and unlike into it.
+2. `copy()` copies likes over in batches of MIGRATE_BATCH_SIZE rows by
+   id, each in its own short transaction, dropping duplicate and
+   half-empty rows. Each batch share-locks the rows it reads, so an
+   unlike can't land between the copy and the trigger.
+3. `swap()` drops the triggers and the old table and renames
+   likes_compact to likes, in one transaction that gives up after
+   SWAP_LOCK_TIMEOUT rather than queue the app behind it.
+4. `like_counts.reconcile()` recounts messages.like_count, which still
+   counted the duplicate rows that were dropped.
+
+Copied likes get the migration's start as created_at; when they were
+really made was never recorded. Deploy the new Likes model straight after
+the swap: the old code reads and writes likes.id.
+"""
+
+import statistics
+import time
+from datetime import datetime
+
+from sqlalchemy import (MetaData, Table, Column, ForeignKey, Index, Integer,
+                        DateTime, PrimaryKeyConstraint, and_, bindparam,
+                        func, inspect, literal, select)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql import column, table
+
+import like_counts
+from models import db
+
+# old likes rows read per transaction
+MIGRATE_BATCH_SIZE = 10000
+
+# (user_id, message_id) lookups timed before and after
+LATENCY_SAMPLES = 200
+
+SWAP_LOCK_TIMEOUT = '5s'
+
+_metadata = MetaData()
+
+# stand-ins so the foreign keys below resolve
+Table('users', _metadata, Column('id', Integer, primary_key=True))
+Table('messages', _metadata, Column('id', Integer, primary_key=True))
+
+legacy = Table(
+    'likes', _metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer),
+    Column('message_id', Integer),
+)
+
+# named as they'll be once this is likes, where names can't clash
+compact = Table(
+    'likes_compact', _metadata,
+    Column('user_id', Integer,
+           ForeignKey('users.id', ondelete='cascade',
+                      name='likes_user_id_fkey'),
+           nullable=False),
+    Column('message_id', Integer,
+           ForeignKey('messages.id', ondelete='cascade',
+                      name='likes_message_id_fkey'),
+           nullable=False),
+    Column('created_at', DateTime, nullable=False,
+           server_default=func.current_timestamp()),
+    PrimaryKeyConstraint('user_id', 'message_id', name='likes_compact_pkey'),
+    Index('ix_likes_compact_message_id', 'message_id'),
+)
+
+# either version of the table, for measuring
+likes = table('likes', column('user_id'), column('message_id'))
+
+_SQLITE_TRIGGERS = [
+    """CREATE TRIGGER likes_compact_insert AFTER INSERT ON likes
+       WHEN NEW.user_id IS NOT NULL AND NEW.message_id IS NOT NULL
+       BEGIN
+           INSERT OR IGNORE INTO likes_compact (user_id, message_id)
+           VALUES (NEW.user_id, NEW.message_id);
+       END""",
+    # unliking one of several duplicates leaves the like in place
+    """CREATE TRIGGER likes_compact_delete AFTER DELETE ON likes
+       BEGIN
+           DELETE FROM likes_compact
+           WHERE user_id = OLD.user_id AND message_id = OLD.message_id
+             AND NOT EXISTS (SELECT 1 FROM likes
+                             WHERE user_id = OLD.user_id
+                               AND message_id = OLD.message_id);
+       END""",
+]
+
+_POSTGRES_TRIGGERS = [
+    """CREATE FUNCTION likes_compact_sync() RETURNS trigger AS $$
+       BEGIN
+           IF TG_OP = 'INSERT' THEN
+               IF NEW.user_id IS NOT NULL
+                       AND NEW.message_id IS NOT NULL THEN
+                   INSERT INTO likes_compact (user_id, message_id, created_at)
+                   VALUES (NEW.user_id, NEW.message_id,
+                           now() AT TIME ZONE 'utc')
+                   ON CONFLICT DO NOTHING;
+               END IF;
+           ELSE
+               DELETE FROM likes_compact
+               WHERE user_id = OLD.user_id AND message_id = OLD.message_id
+                 AND NOT EXISTS (SELECT 1 FROM likes
+                                 WHERE user_id = OLD.user_id
+                                   AND message_id = OLD.message_id);
+           END IF;
+           RETURN NULL;
+       END
+       $$ LANGUAGE plpgsql""",
+    """CREATE TRIGGER likes_compact_sync AFTER INSERT OR DELETE ON likes
+       FOR EACH ROW EXECUTE PROCEDURE likes_compact_sync()""",
+]
+
+
+def _postgres(conn):
+    return conn.dialect.name == 'postgresql'
+
+
+def needs_migration():
+    """Does likes still have its surrogate id?"""
+
+    return any(col['name'] == 'id'
+               for col in inspect(db.engine).get_columns('likes'))
+
+
+def _drop_triggers(conn):
+    if _postgres(conn):
+        conn.execute('DROP TRIGGER IF EXISTS likes_compact_sync ON likes')
+        conn.execute('DROP FUNCTION IF EXISTS likes_compact_sync()')
+    else:
+        conn.execute('DROP TRIGGER IF EXISTS likes_compact_insert')
+        conn.execute('DROP TRIGGER IF EXISTS likes_compact_delete')
+
+
+def prepare():
+    """Create an empty likes_compact and start mirroring writes into it.
+
+    Starts over if an earlier run was interrupted.
+    """
+
+    with db.engine.begin() as conn:
+        _drop_triggers(conn)
+        compact.drop(conn, checkfirst=True)
+        compact.create(conn)
+        for trigger in (_POSTGRES_TRIGGERS if _postgres(conn)
+                        else _SQLITE_TRIGGERS):
+            conn.execute(trigger)
+
+
+def copy(created_at, batch_size=None, report=None):
+    """Copy every like into likes_compact, once each.
+
+    Returns the number of old rows read; `report(rows read, last id)` is
+    called after each batch.
+    """
+
+    batch_size = batch_size or MIGRATE_BATCH_SIZE
+    last_id = 0
+    read = 0
+    while True:
+        with db.engine.begin() as conn:
+            batch = (select([legacy.c.id])
+                     .where(legacy.c.id > last_id)
+                     .order_by(legacy.c.id)
+                     .limit(batch_size)
+                     .alias())
+            upper, count = conn.execute(
+                select([func.max(batch.c.id), func.count()])).first()
+            if not count:
+                return read
+
+            rows = (select([legacy.c.user_id, legacy.c.message_id,
+                            literal(created_at, DateTime)])
+                    .where(and_(legacy.c.id > last_id,
+                                legacy.c.id <= upper,
+                                legacy.c.user_id.isnot(None),
+                                legacy.c.message_id.isnot(None)))
+                    .with_for_update(read=True))
+            columns = ['user_id', 'message_id', 'created_at']
+            if _postgres(conn):
+                insert = (postgresql.insert(compact)
+                          .from_select(columns, rows)
+                          .on_conflict_do_nothing())
+            else:
+                insert = (compact.insert().prefix_with('OR IGNORE')
+                          .from_select(columns, rows))
+            conn.execute(insert)
+
+        last_id = upper
+        read += count
+        if report:
+            report(read, last_id)
+
+
+def swap():
+    """Replace likes with likes_compact."""
+
+    with db.engine.begin() as conn:
+        if _postgres(conn):
+            conn.execute(f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT}'")
+        _drop_triggers(conn)
+        conn.execute('DROP TABLE likes')
+        conn.execute('ALTER TABLE likes_compact RENAME TO likes')
+        if _postgres(conn):
+            conn.execute('ALTER INDEX ix_likes_compact_message_id '
+                         'RENAME TO ix_likes_message_id')
+            conn.execute('ALTER TABLE likes '
+                         'RENAME CONSTRAINT likes_compact_pkey TO likes_pkey')
+        else:
+            # SQLite can't rename indexes
+            conn.execute('DROP INDEX ix_likes_compact_message_id')
+            conn.execute('CREATE INDEX ix_likes_message_id '
+                         'ON likes (message_id)')
+
+
+##############################################################################
+# Measuring
+
+
+def table_bytes(name):
+    """Disk used by table `name` and its indexes, or None if unknown."""
+
+    with db.engine.connect() as conn:
+        if _postgres(conn):
+            return conn.execute('SELECT pg_total_relation_size(%s)',
+                                (name,)).scalar()
+        try:
+            return conn.execute(
+                "SELECT sum(pgsize) FROM dbstat WHERE name IN "
+                "(SELECT name FROM sqlite_master WHERE tbl_name = ?)",
+                (name,)).scalar()
+        except OperationalError:
+            # SQLite built without the dbstat table
+            return None
+
+
+def sample_pairs(count=LATENCY_SAMPLES):
+    """Random (user_id, message_id) pairs that are liked."""
+
+    with db.engine.connect() as conn:
+        return conn.execute(
+            select([likes.c.user_id, likes.c.message_id])
+            .where(and_(likes.c.user_id.isnot(None),
+                        likes.c.message_id.isnot(None)))
+            .order_by(func.random())
+            .limit(count)).fetchall()
+
+
+def lookup_ms(pairs):
+    """Median milliseconds to check whether a user likes a message."""
+
+    if not pairs:
+        return None
+    query = (select([func.count()]).select_from(likes)
+             .where(and_(likes.c.user_id == bindparam('user_id'),
+                         likes.c.message_id == bindparam('message_id'))))
+    timings = []
+    with db.engine.connect() as conn:
+        for user_id, message_id in pairs:
+            start = time.perf_counter()
+            conn.execute(query, user_id=user_id,
+                         message_id=message_id).scalar()
+            timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def measure(pairs):
+    """{'rows', 'bytes', 'lookup_ms'} of likes as it is now."""
+
+    with db.engine.connect() as conn:
+        rows = conn.execute(select([func.count()]).select_from(likes)).scalar()
+    return dict(rows=rows, bytes=table_bytes('likes'),
+                lookup_ms=lookup_ms(pairs))
+
+
+def migrate(batch_size=None, report=None):
+    """Run every step; return {'before': measure(), 'after': measure(),
+    'repaired': like counts fixed}.
+
+    Returns None if likes is migrated already. `report` is passed to
+    `copy()`.
+    """
+
+    if not needs_migration():
+        return None
+
+    pairs = sample_pairs()
+    before = measure(pairs)
+    started_at = datetime.utcnow()
+    prepare()
+    copy(started_at, batch_size, report)
+    swap()
+    after = measure(pairs)
+    return dict(before=before, after=after,
+                repaired=like_counts.reconcile())
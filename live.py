@@ -0,0 +1,202 @@
+"""Live timeline updates over Server-Sent Events.
+
+`messages_add()` publishes each new warble on its author's channel. Every
+open /timeline/stream connection subscribes to the channels of the users
+it follows and relays what arrives as SSE events.
+
+The broker is chosen with the LIVE_BROKER config key:
+
+- 'local': in-process pub/sub. Only subscribers in the same worker see an
+  event, so use it with a single worker.
+- 'postgres': events go through Postgres NOTIFY. Each worker runs one
+  LISTEN connection and fans out to its local subscribers, so every
+  worker sees every event.
+
+Every open stream holds its connection for as long as the page is open,
+so it pins a whole worker under gunicorn's default sync workers. Live
+updates are therefore off unless LIVE_UPDATES is set, which should only
+be done with greenlet workers, where each connection costs a greenlet
+rather than an OS thread:
+
+    gunicorn -k gevent --worker-connections 5000 app:app
+"""
+
+import json
+import queue
+import select
+import threading
+
+from sqlalchemy import text
+
+from models import db
+
+# events buffered per connection before a slow client starts missing some
+SUBSCRIBER_QUEUE_SIZE = 100
+
+NOTIFY_CHANNEL = 'warbler_live'
+
+
+class Subscription:
+    """Events for one connection, from any of its channels."""
+
+    def __init__(self, broker, channels):
+        self.broker = broker
+        self.channels = set(channels)
+        self.queue = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+
+    def get(self, timeout):
+        """Next (channel, data) event, or None after `timeout` seconds."""
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """In-process pub/sub between the requests of one worker."""
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channels):
+        """Return a Subscription receiving events on `channels`."""
+
+        subscription = Subscription(self, channels)
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._subscribers.get(channel)
+                if subscribers:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[channel]
+
+    def subscriber_count(self):
+        with self._lock:
+            return len({subscription
+                        for subscriptions in self._subscribers.values()
+                        for subscription in subscriptions})
+
+    def publish(self, channel, data):
+        """Send `data` (JSON-serializable) to subscribers of `channel`."""
+
+        self.deliver(channel, data)
+
+    def deliver(self, channel, data):
+        """Hand an event to this worker's subscribers of `channel`."""
+
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait((channel, data))
+            except queue.Full:
+                # drop events for clients that can't keep up
+                pass
+
+
+class PostgresBroker(LocalBroker):
+    """Pub/sub across workers (and hosts) over Postgres LISTEN/NOTIFY.
+
+    Payloads must stay under Postgres' 8000 byte NOTIFY limit.
+    """
+
+    def __init__(self, engine):
+        super().__init__()
+        self.engine = engine
+        self._listener = None
+
+    def publish(self, channel, data):
+        payload = json.dumps(dict(channel=channel, data=data))
+        with self.engine.connect() as conn:
+            conn.execute(text("SELECT pg_notify(:name, :payload)")
+                         .execution_options(autocommit=True),
+                         name=NOTIFY_CHANNEL, payload=payload)
+
+    def subscribe(self, channels):
+        # start listening lazily so it happens after gunicorn forks
+        if self._listener is None or not self._listener.is_alive():
+            self._listener = threading.Thread(target=self._listen,
+                                              daemon=True)
+            self._listener.start()
+        return super().subscribe(channels)
+
+    def _listen(self):
+        conn = self.engine.raw_connection()
+        try:
+            dbapi_conn = conn.connection
+            dbapi_conn.set_session(autocommit=True)
+            with dbapi_conn.cursor() as cur:
+                cur.execute(f"LISTEN {NOTIFY_CHANNEL}")
+            while True:
+                if select.select([dbapi_conn], [], [], 5) == ([], [], []):
+                    continue
+                dbapi_conn.poll()
+                while dbapi_conn.notifies:
+                    event = json.loads(dbapi_conn.notifies.pop(0).payload)
+                    self.deliver(event['channel'], event['data'])
+        finally:
+            conn.close()
+
+
+def author_channel(user_id):
+    return f"user:{user_id}"
+
+
+def format_event(event, data):
+    """Encode an SSE event; multi-line data goes on several data: lines."""
+
+    lines = ''.join(f"data: {line}\n" for line in data.split('\n'))
+    return f"event: {event}\n{lines}\n"
+
+
+def event_stream(subscription, heartbeat):
+    """Yield SSE text for `subscription` until the client goes away.
+
+    A comment is sent every `heartbeat` seconds without events so proxies
+    keep the connection open and dead clients are noticed.
+    """
+
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            event = subscription.get(heartbeat)
+            if event is None:
+                yield ": keep-alive\n\n"
+                continue
+            _, data = event
+            yield format_event('warble', data['html'])
+    finally:
+        subscription.close()
+
+
+broker = LocalBroker()
+
+
+def init_app(app):
+    """Read LIVE_UPDATES and pick the broker from LIVE_BROKER ('local' or
+    'postgres')."""
+
+    global broker
+
+    app.config.setdefault('LIVE_UPDATES', False)
+    app.config.setdefault('LIVE_BROKER', 'local')
+    app.config.setdefault('LIVE_HEARTBEAT_SECONDS', 15)
+
+    if app.config['LIVE_BROKER'] == 'postgres':
+        with app.app_context():
+            broker = PostgresBroker(db.engine)
+    elif app.config['LIVE_BROKER'] == 'local':
+        broker = LocalBroker()
+    else:
+        raise ValueError(f"Unknown LIVE_BROKER {app.config['LIVE_BROKER']!r}")
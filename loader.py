@@ -0,0 +1,168 @@
+"""Request-scoped batch loaders.
+
+Walking `user.following` or calling `g.user.is_following(...)` once per
+card makes a page's query count grow with its length. A Loader instead
+collects keys (`prime`) and fetches every pending key with a single `IN`
+query the first time any of them is needed, remembering the results
+until the request ends. Views prime the keys a page will need; templates
+then read from the `loaders` global without further queries.
+
+    loaders.users.load_many(ids)           users by id
+    loaders.messages.load_many(ids)        messages by id
+    loaders.following_of(user_id)          users `user_id` follows
+    loaders.followers_of(user_id)          users following `user_id`
+    loaders.liked_by(user_id)              messages `user_id` likes
+    loaders.is_following(a, b)             does a follow b?
+    loaders.has_liked(user_id, message_id)
+"""
+
+from flask import g
+from werkzeug.local import LocalProxy
+
+from models import db, User, Message, Follows, Likes
+
+
+class Loader:
+    """Batches and memoizes lookups of one kind of value.
+
+    `batch_fn` takes a set of keys and returns a dict of the values it
+    found; keys it leaves out load as `default`.
+    """
+
+    def __init__(self, batch_fn, default=None):
+        self.batch_fn = batch_fn
+        self.default = default
+        self.round_trips = 0
+        self._cache = {}
+        self._pending = set()
+
+    def prime(self, keys):
+        """Queue `keys` to be fetched with the next batch."""
+
+        self._pending.update(key for key in keys if key not in self._cache)
+
+    def load(self, key):
+        self.prime([key])
+        self._dispatch()
+        return self._cache[key]
+
+    def load_many(self, keys):
+        keys = list(keys)
+        self.prime(keys)
+        self._dispatch()
+        return [self._cache[key] for key in keys]
+
+    def _dispatch(self):
+        if not self._pending:
+            return
+        found = self.batch_fn(self._pending)
+        for key in self._pending:
+            self._cache[key] = found.get(key, self.default)
+        self._pending.clear()
+        self.round_trips += 1
+
+
+def _users(ids):
+    return {user.id: user for user in User.query.filter(User.id.in_(ids))}
+
+
+def _messages(ids):
+    return {msg.id: msg for msg in Message.query.filter(Message.id.in_(ids))}
+
+
+def _pairs(left, right, pairs):
+    """{(a, b): True} for the (a, b) rows among `pairs` in the table."""
+
+    lefts = {a for a, _ in pairs}
+    rights = {b for _, b in pairs}
+    rows = (db.session
+            .query(left, right)
+            .filter(left.in_(lefts), right.in_(rights)))
+    return {pair: True for pair in rows if pair in pairs}
+
+
+def _grouped(key_column, value_column, keys):
+    found = {key: [] for key in keys}
+    for key, value in (db.session
+                       .query(key_column, value_column)
+                       .filter(key_column.in_(keys))
+                       .order_by(value_column)):
+        found[key].append(value)
+    return found
+
+
+class RequestLoaders:
+    """The loaders for one request."""
+
+    def __init__(self):
+        self.users = Loader(_users)
+        self.messages = Loader(_messages)
+        self.follows = Loader(
+            lambda pairs: _pairs(Follows.user_following_id,
+                                 Follows.user_being_followed_id, pairs),
+            default=False)
+        self.likes = Loader(
+            lambda pairs: _pairs(Likes.user_id, Likes.message_id, pairs),
+            default=False)
+        self.following_ids = Loader(
+            lambda ids: _grouped(Follows.user_following_id,
+                                 Follows.user_being_followed_id, ids),
+            default=[])
+        self.follower_ids = Loader(
+            lambda ids: _grouped(Follows.user_being_followed_id,
+                                 Follows.user_following_id, ids),
+            default=[])
+        self.liked_ids = Loader(
+            lambda ids: _grouped(Likes.user_id, Likes.message_id, ids),
+            default=[])
+
+    @property
+    def round_trips(self):
+        return sum(loader.round_trips for loader in vars(self).values())
+
+    def _users_seen_by(self, ids, viewer_id):
+        users = [user for user in self.users.load_many(ids) if user]
+        if viewer_id is not None:
+            self.follows.prime((viewer_id, user.id) for user in users)
+        return users
+
+    def following_of(self, user_id, viewer_id=None):
+        """Users `user_id` follows; primes `viewer_id`'s follow state."""
+
+        return self._users_seen_by(self.following_ids.load(user_id),
+                                   viewer_id)
+
+    def followers_of(self, user_id, viewer_id=None):
+        """Users following `user_id`; primes `viewer_id`'s follow state."""
+
+        return self._users_seen_by(self.follower_ids.load(user_id),
+                                   viewer_id)
+
+    def liked_by(self, user_id):
+        """Messages `user_id` has liked."""
+
+        ids = dict.fromkeys(self.liked_ids.load(user_id))
+        return [msg for msg in self.messages.load_many(ids) if msg]
+
+    def is_following(self, follower_id, followed_id):
+        return self.follows.load((follower_id, followed_id))
+
+    def has_liked(self, user_id, message_id):
+        return self.likes.load((user_id, message_id))
+
+
+def get_loaders():
+    """This request's RequestLoaders, created on first use."""
+
+    if 'loaders' not in g:
+        g.loaders = RequestLoaders()
+    return g.loaders
+
+
+loaders = LocalProxy(get_loaders)
+
+
+def init_app(app):
+    """Make `loaders` available to templates."""
+
+    app.jinja_env.globals['loaders'] = loaders
@@ -0,0 +1,467 @@
+"""Runtime metrics, served in Prometheus text format at /metrics.
+
+Metrics are recorded in plain per-process dicts, so recording one costs a
+lock and a dict update (about a microsecond; see
+benchmarks/bench_metrics.py). What's recorded:
+
+- request latency per endpoint and status
+- requests in progress
+- database queries per endpoint
+- template render time per template
+- bcrypt hashing and checking time
+- background jobs waiting, and their wait and run times (see jobs.py)
+
+With several gunicorn workers, set METRICS_DIR to a directory that is
+emptied before the server starts. Each worker writes its values there at
+most every METRICS_FLUSH_SECONDS (and just before answering /metrics),
+and /metrics adds up every worker's file. A worker removes its file when
+it starts (in case a dead worker had its pid) and when it exits, which
+Prometheus sees as a counter reset; gauges in files left by workers that
+were killed only count while the pid is alive. Without METRICS_DIR,
+/metrics shows only the worker that answers it. Sampled gauges (e.g. jobs
+waiting in the database) are read fresh by whichever worker answers
+/metrics instead.
+
+/metrics answers only addresses in METRICS_ALLOWED_IPS (networks are
+fine; loopback by default) and requests carrying METRICS_TOKEN as an
+`Authorization: Bearer` header; anyone else gets a 404.
+"""
+
+import atexit
+import hmac
+import ipaddress
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import Response, abort, current_app, request, g, \
+    template_rendered, before_render_template
+
+# latency buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric:
+    """Values of one metric, per combination of label values."""
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def samples(self):
+        """[[label values, value]] pairs, JSON-friendly."""
+
+        with self._lock:
+            return [[list(labels), value]
+                    for labels, value in self._values.items()]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, amount=1, *labels):
+        self.inc(-amount, *labels)
+
+
+class Sampled(Metric):
+    """A gauge read from `read()` when metrics are served.
+
+    For values that belong to no one worker, like the depth of a queue
+    kept in the database. `read` returns [[label values, value]] pairs.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, help, labelnames=(), read=None):
+        super().__init__(name, help, labelnames)
+        self.read = read
+
+    def samples(self):
+        return []
+
+
+class Histogram(Metric):
+    """Bucketed observations. Each value is [bucket counts..., sum]."""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        # bucket counts aren't cumulative until exposition
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+
+REGISTRY = []
+
+REQUEST_SECONDS = Histogram(
+    'warbler_request_duration_seconds', "Request latency.",
+    ('endpoint', 'status'))
+REQUESTS_IN_PROGRESS = Gauge(
+    'warbler_requests_in_progress', "Requests being handled right now.")
+DB_QUERIES = Counter(
+    'warbler_db_queries_total', "Database queries, by endpoint.",
+    ('endpoint',))
+TEMPLATE_SECONDS = Histogram(
+    'warbler_template_render_seconds', "Template render time.",
+    ('template',))
+BCRYPT_SECONDS = Histogram(
+    'warbler_bcrypt_seconds', "Time spent hashing or checking passwords.",
+    ('operation',), buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.0))
+JOBS = Sampled(
+    'warbler_jobs', "Background jobs not yet done, by task and status.",
+    ('task', 'status'))
+JOB_WAIT_SECONDS = Histogram(
+    'warbler_job_wait_seconds', "Time from a job being due to it starting.",
+    ('task',))
+JOB_RUN_SECONDS = Histogram(
+    'warbler_job_run_seconds', "Time spent running jobs, by outcome.",
+    ('task', 'outcome'))
+
+
+##############################################################################
+# Aggregating workers
+
+
+def snapshot():
+    """This process's values of every metric."""
+
+    return {metric.name: metric.samples() for metric in REGISTRY}
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _snapshot_path(directory):
+    return os.path.join(directory, f"metrics-{os.getpid()}.json")
+
+
+def write_snapshot(directory):
+    """Save this process's values where other workers can read them."""
+
+    path = _snapshot_path(directory)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(snapshot(), f)
+    os.replace(tmp, path)
+
+
+def remove_snapshot(directory):
+    """Remove this process's file, e.g. one left by a dead worker."""
+
+    try:
+        os.remove(_snapshot_path(directory))
+    except FileNotFoundError:
+        pass
+
+
+def collect(directory=None):
+    """{metric name: {label values: value}} summed over every worker."""
+
+    if directory is None:
+        snapshots = [(os.getpid(), snapshot())]
+    else:
+        snapshots = []
+        for name in os.listdir(directory):
+            if not (name.startswith('metrics-') and name.endswith('.json')):
+                continue
+            pid = int(name[len('metrics-'):-len('.json')])
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    snapshots.append((pid, json.load(f)))
+            except (OSError, ValueError):
+                continue
+
+    totals = {metric.name: {} for metric in REGISTRY}
+    types = {metric.name: metric.type for metric in REGISTRY}
+    for pid, values in snapshots:
+        for name, samples in values.items():
+            if name not in totals:
+                continue
+            if types[name] == 'gauge' and not _pid_alive(pid):
+                continue
+            merged = totals[name]
+            for labels, value in samples:
+                labels = tuple(labels)
+                if isinstance(value, list):
+                    old = merged.get(labels, [0] * len(value))
+                    merged[labels] = [a + b for a, b in zip(old, value)]
+                else:
+                    merged[labels] = merged.get(labels, 0) + value
+
+    for metric in REGISTRY:
+        if isinstance(metric, Sampled) and metric.read:
+            totals[metric.name] = {tuple(labels): value
+                                   for labels, value in metric.read()}
+    return totals
+
+
+##############################################################################
+# Exposition
+
+
+def _escape(value):
+    return (str(value).replace('\\', r'\\').replace('\n', r'\n')
+            .replace('"', r'\"'))
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def exposition(totals):
+    """Render collected totals in the Prometheus text format."""
+
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for labels, value in sorted(totals[metric.name].items()):
+            if metric.type != 'histogram':
+                lines.append(f"{metric.name}"
+                             f"{_labels(metric.labelnames, labels)} "
+                             f"{_number(value)}")
+                continue
+
+            cumulative = 0
+            bounds = metric.buckets + (float('inf'),)
+            for bound, count in zip(bounds, value[:-1]):
+                cumulative += count
+                le = _labels(metric.labelnames, labels,
+                             [('le', _number(bound))])
+                lines.append(f"{metric.name}_bucket{le} {cumulative}")
+            plain = _labels(metric.labelnames, labels)
+            lines.append(f"{metric.name}_sum{plain} {_number(value[-1])}")
+            lines.append(f"{metric.name}_count{plain} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+
+##############################################################################
+# Flask and SQLAlchemy hooks
+
+
+class _Flusher:
+    """Writes this worker's snapshot at most every `interval` seconds."""
+
+    def __init__(self, directory, interval):
+        self.directory = directory
+        self.interval = interval
+        self._next = 0
+
+    def remove(self):
+        if self.directory is not None:
+            remove_snapshot(self.directory)
+
+    def maybe_flush(self, force=False):
+        if self.directory is None:
+            return
+        now = time.monotonic()
+        if force or now >= self._next:
+            self._next = now + self.interval
+            write_snapshot(self.directory)
+
+
+_flusher = _Flusher(None, 0)
+
+
+def _endpoint():
+    return request.endpoint or 'none'
+
+
+def _before_request():
+    g._metrics_start = time.perf_counter()
+    g._metrics_queries = 0
+    REQUESTS_IN_PROGRESS.inc()
+
+
+def _after_request(response):
+    REQUEST_SECONDS.observe(time.perf_counter() - g._metrics_start,
+                            _endpoint(), str(response.status_code))
+    g._metrics_recorded = True
+    return response
+
+
+def _teardown_request(exc):
+    # popped, since an app context pushed around several requests (by a
+    # script or test) shares one g between them
+    start = g.pop('_metrics_start', None)
+    if start is None:
+        return
+    if not g.pop('_metrics_recorded', False):
+        # an unhandled exception skipped after_request
+        REQUEST_SECONDS.observe(time.perf_counter() - start,
+                                _endpoint(), '500')
+    queries = g.pop('_metrics_queries', 0)
+    if queries:
+        DB_QUERIES.inc(queries, _endpoint())
+    REQUESTS_IN_PROGRESS.dec()
+    _flusher.maybe_flush()
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    # queries made outside a request (CLI, background threads) aren't
+    # attributed to an endpoint
+    if g and '_metrics_queries' in g:
+        g._metrics_queries += 1
+
+
+def count_queries():
+    """Start counting queries made in this app context.
+
+    For app contexts doing a request's work elsewhere (see parallel.py);
+    hand `counted_queries()` to the request with `add_queries`.
+    """
+
+    g._metrics_queries = 0
+
+
+def counted_queries():
+    """Stop counting and return the queries made since `count_queries`."""
+
+    return g.pop('_metrics_queries', 0)
+
+
+def add_queries(count):
+    """Attribute `count` queries made elsewhere to the current request."""
+
+    if '_metrics_queries' in g:
+        g._metrics_queries += count
+
+
+def _before_render(app, template, context):
+    g._metrics_render_start = time.perf_counter()
+
+
+def _rendered(app, template, context):
+    start = g.pop('_metrics_render_start', None)
+    if start is not None:
+        TEMPLATE_SECONDS.observe(time.perf_counter() - start,
+                                 template.name or 'string')
+
+
+def maybe_flush():
+    """Save this worker's values if METRICS_FLUSH_SECONDS have passed.
+
+    For threads that do work outside requests.
+    """
+
+    _flusher.maybe_flush()
+
+
+def _allowed():
+    config = current_app.config
+    token = config['METRICS_TOKEN']
+    if token and hmac.compare_digest(
+            request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return True
+    try:
+        address = ipaddress.ip_address(request.remote_addr or '')
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network)
+               for network in config['METRICS_ALLOWED_IPS'])
+
+
+def serve_metrics():
+    """The /metrics view."""
+
+    if not _allowed():
+        abort(404)
+    _flusher.maybe_flush(force=True)
+    return Response(exposition(collect(_flusher.directory)),
+                    content_type=CONTENT_TYPE)
+
+
+def init_app(app):
+    """Record request metrics and serve them at /metrics."""
+
+    global _flusher
+
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    app.config.setdefault('METRICS_DIR', os.environ.get('METRICS_DIR'))
+    app.config.setdefault('METRICS_FLUSH_SECONDS', 5)
+    app.config.setdefault('METRICS_ALLOWED_IPS', ['127.0.0.1', '::1'])
+    app.config.setdefault('METRICS_TOKEN', os.environ.get('METRICS_TOKEN'))
+
+    directory = app.config['METRICS_DIR']
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    _flusher = _Flusher(directory, app.config['METRICS_FLUSH_SECONDS'])
+    _flusher.remove()
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+    if not event.contains(Engine, 'before_cursor_execute', _count_query):
+        event.listen(Engine, 'before_cursor_execute', _count_query)
+
+    app.add_url_rule('/metrics', 'metrics', serve_metrics)
+
+
+def _remove_snapshot():
+    # looked up when called, so it's whichever flusher init_app set up last
+    _flusher.remove()
+
+
+os.register_at_fork(after_in_child=_remove_snapshot)
+atexit.register(_remove_snapshot)
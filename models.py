@@ -1,13 +1,21 @@
 """SQLAlchemy models for Warbler."""
 
+import os
+import secrets
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.pool import Pool
+
+from metrics import BCRYPT_SECONDS
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+# rows removed per transaction when deleting an account
+DELETE_BATCH_SIZE = 10000
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -26,25 +34,128 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    __table_args__ = (
+        # the primary key serves followers; this serves who a user follows
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes'
 
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=db.func.current_timestamp(),
+    )
+
+    __table_args__ = (
+        # the primary key serves a user's likes; this serves a message's
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
+
+class GraphChange(db.Model):
+    """A follow or unfollow not yet applied to the graph snapshot."""
+
+    __tablename__ = 'graph_changes'
+
     id = db.Column(
         db.Integer,
-        primary_key=True
+        primary_key=True,
+    )
+
+    follower_id = db.Column(
+        db.Integer,
+        nullable=False,
     )
 
+    followed_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    added = db.Column(
+        db.Boolean,
+        nullable=False,
+    )
+
+
+class FollowSuggestions(db.Model):
+    """Precomputed who-to-follow suggestions, best first."""
+
+    __tablename__ = 'follow_suggestions'
+
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
-    message_id = db.Column(
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    suggested_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+
+class UserDeletion(db.Model):
+    """Progress record for a chunked account deletion."""
+
+    __tablename__ = 'user_deletions'
+
+    id = db.Column(
         db.Integer,
-        db.ForeignKey('messages.id', ondelete='cascade')
+        primary_key=True,
+    )
+
+    # no foreign key: the record outlives the user it describes
+    user_id = db.Column(
+        db.Integer,
+        nullable=False,
+        index=True,
+    )
+
+    messages_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    started_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
     )
 
 
@@ -117,6 +228,17 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    def suggestions(self):
+        """Users suggested for this user to follow, best first."""
+
+        return (User
+                .query
+                .join(FollowSuggestions,
+                      FollowSuggestions.suggested_user_id == User.id)
+                .filter(FollowSuggestions.user_id == self.id)
+                .order_by(FollowSuggestions.rank)
+                .all())
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
@@ -138,7 +260,10 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        from flask_bcrypt import generate_password_hash
+
+        with BCRYPT_SECONDS.time('hash'):
+            hashed_pwd = generate_password_hash(password).decode('UTF-8')
 
         user = User(
             username=username,
@@ -161,15 +286,144 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = (cls.query
+                .filter(cls.username == username, cls.not_deleting())
+                .first())
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            from flask_bcrypt import check_password_hash
+
+            with BCRYPT_SECONDS.time('check'):
+                is_auth = check_password_hash(user.password, password)
             if is_auth:
                 return user
 
         return False
 
+    @classmethod
+    def not_deleting(cls):
+        """Filter clause leaving out users whose deletion has started."""
+
+        return ~db.exists().where((UserDeletion.user_id == cls.id)
+                                  & UserDeletion.finished_at.is_(None))
+
+    @classmethod
+    def start_deletion(cls, user_id):
+        """Mark user `user_id` as being deleted, ahead of `bulk_delete`.
+
+        From then on they can't log in and their username and email are
+        free for someone else. Joins the caller's transaction; the caller
+        commits. Returns the UserDeletion record.
+        """
+
+        record = (UserDeletion
+                  .query
+                  .filter_by(user_id=user_id, finished_at=None)
+                  .first())
+        if not record:
+            record = UserDeletion(user_id=user_id, messages_deleted=0)
+            db.session.add(record)
+
+        # can't be an email address, and can't be guessed as a username
+        placeholder = f"deleted:{user_id}:{secrets.token_hex(8)}"
+        (cls.query
+         .filter(cls.id == user_id)
+         .update(dict(username=placeholder, email=placeholder)))
+        return record
+
+    @classmethod
+    def bulk_delete(cls, user_id, batch_size=DELETE_BATCH_SIZE,
+                    before_chunk=None):
+        """Delete user `user_id` and everything they own with set-based SQL.
+
+        Messages (and the likes on them) are removed in chunks of
+        `batch_size`, committing after each chunk so no single transaction
+        holds a heavy account's rows. Progress is kept in a UserDeletion
+        record, so an interrupted deletion can be resumed by calling this
+        again with the same id. `before_chunk()`, if given, is called
+        before each chunk and may raise to stop.
+
+        Returns the UserDeletion record.
+        """
+
+        # detach any loaded copy so it isn't refreshed against a gone row
+        loaded = db.session.identity_map.get(identity_key(cls, user_id))
+        if loaded is not None:
+            db.session.expunge(loaded)
+
+        record = (UserDeletion
+                  .query
+                  .filter_by(user_id=user_id, finished_at=None)
+                  .first())
+        if not record:
+            record = UserDeletion(user_id=user_id, messages_deleted=0)
+            db.session.add(record)
+            db.session.commit()
+
+        while True:
+            if before_chunk:
+                before_chunk()
+            ids = [msg_id for (msg_id,) in (db.session
+                                            .query(Message.id)
+                                            .filter(Message.user_id == user_id)
+                                            .limit(batch_size))]
+            if not ids:
+                break
+
+            (Likes.query
+             .filter(Likes.message_id.in_(ids))
+             .delete(synchronize_session=False))
+            for model in (TrendingBucket, TrendingMessage, LikeCountShard,
+                          SearchPosting, MessageTag, MessageMention):
+                (model.query
+                 .filter(model.message_id.in_(ids))
+                 .delete(synchronize_session=False))
+            (Message.query
+             .filter(Message.id.in_(ids))
+             .delete(synchronize_session=False))
+            record.messages_deleted += len(ids)
+            db.session.commit()
+
+        # take the user's likes off the counts of other people's messages
+        removed = (db.select([db.func.count()])
+                   .where((Likes.message_id == Message.id)
+                          & (Likes.user_id == user_id))
+                   .as_scalar())
+        (Message.query
+         .filter(Message.id.in_(db.session.query(Likes.message_id)
+                                .filter(Likes.user_id == user_id)))
+         .update({Message.like_count: Message.like_count - removed},
+                 synchronize_session=False))
+        (Likes.query
+         .filter(Likes.user_id == user_id)
+         .delete(synchronize_session=False))
+        (ArchivedLike.query
+         .filter(ArchivedLike.user_id == user_id)
+         .delete(synchronize_session=False))
+        user_follows = Follows.query.filter(
+            (Follows.user_following_id == user_id)
+            | (Follows.user_being_followed_id == user_id))
+        db.session.execute(GraphChange.__table__.insert().from_select(
+            ['follower_id', 'followed_id', 'added'],
+            user_follows.with_entities(Follows.user_following_id,
+                                       Follows.user_being_followed_id,
+                                       db.false())))
+        user_follows.delete(synchronize_session=False)
+        (MessageMention.query
+         .filter(MessageMention.user_id == user_id)
+         .delete(synchronize_session=False))
+        (FollowSuggestions.query
+         .filter((FollowSuggestions.user_id == user_id)
+                 | (FollowSuggestions.suggested_user_id == user_id))
+         .delete(synchronize_session=False))
+        (cls.query
+         .filter(cls.id == user_id)
+         .delete(synchronize_session=False))
+        record.finished_at = datetime.utcnow()
+        db.session.commit()
+
+        return record
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -189,7 +443,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -198,8 +452,415 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # kept in step with `likes` by like_counts.py
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
+    __table_args__ = (
+        # timelines read a user's newest messages first
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
+
+class MessagePartition(db.Model):
+    """A month of messages moved out of `messages` into cold storage."""
+
+    __tablename__ = 'message_partitions'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # e.g. "2017_01"
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    starts_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    ends_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    path = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    row_count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    archived_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class ArchivedMessageRoute(db.Model):
+    """Which cold partition an archived message id lives in."""
+
+    __tablename__ = 'archived_message_routes'
+
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    partition_id = db.Column(
+        db.Integer,
+        db.ForeignKey('message_partitions.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # where the gzip member holding the message starts in the partition file
+    offset = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+    # the message's author, kept for exports
+    user_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    partition = db.relationship('MessagePartition')
+
+    __table_args__ = (
+        # a user's archived messages, for exports
+        db.Index('ix_archived_message_routes_user_id',
+                 'user_id', 'message_id'),
+    )
+
+
+class ArchivedLike(db.Model):
+    """A like on a message that has been archived.
+
+    The message's partition line lists who liked it; this serves the
+    other direction, what a user liked, for exports.
+    """
+
+    __tablename__ = 'archived_likes'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('archived_message_routes.message_id',
+                      ondelete='cascade'),
+        primary_key=True,
+    )
+
+
+class TrendingBucket(db.Model):
+    """Likes a message received during one time bucket."""
+
+    __tablename__ = 'trending_buckets'
+
+    bucket = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    likes = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class LikeCountShard(db.Model):
+    """Like count changes not yet folded into messages.like_count.
+
+    Spreading a hot message's changes over several rows keeps concurrent
+    likes from queueing on one row lock.
+    """
+
+    __tablename__ = 'like_count_shards'
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    shard = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    delta = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class TrendingMessage(db.Model):
+    """Precomputed top messages over the trending window, best first."""
+
+    __tablename__ = 'trending_messages'
+
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    likes = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    message = db.relationship('Message')
+
+
+class SearchPosting(db.Model):
+    """One term of a message's text, for full-text search (see search.py)."""
+
+    __tablename__ = 'search_postings'
+
+    term = db.Column(
+        db.String(40),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # times the term appears in the message
+    weight = db.Column(
+        db.SmallInteger,
+        nullable=False,
+        default=1,
+    )
+
+    __table_args__ = (
+        # removing a message's postings
+        db.Index('ix_search_postings_message_id', 'message_id'),
+    )
+
+
+class MessageTag(db.Model):
+    """A #tag used in a message (see tags.py)."""
+
+    __tablename__ = 'message_tags'
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # lowercased, without the '#'
+    tag = db.Column(
+        db.String(50),
+        primary_key=True,
+    )
+
+    # the message's, copied so tag timelines never read `messages` to sort
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        # tag timelines read a tag's newest messages first
+        db.Index('ix_message_tags_tag_timestamp',
+                 'tag', 'timestamp', 'message_id'),
+    )
+
+
+class MessageMention(db.Model):
+    """A user @mentioned in a message (see tags.py)."""
+
+    __tablename__ = 'message_mentions'
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        # mention timelines read a user's newest mentions first
+        db.Index('ix_message_mentions_user_id_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+    )
+
+
+class ShardBucket(db.Model):
+    """Which shard holds the messages and likes of one bucket of users.
+
+    See sharding.py.
+    """
+
+    __tablename__ = 'shard_buckets'
+
+    bucket = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    shard = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # set while the bucket is being moved to another shard
+    read_only = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+    )
+
+
+class Job(db.Model):
+    """A piece of deferred work for the background workers.
+
+    See jobs.py.
+    """
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # the name it was registered under with @jobs.task
+    task = db.Column(
+        db.String(50),
+        nullable=False,
+    )
+
+    # JSON object of keyword arguments
+    args = db.Column(
+        db.Text,
+        nullable=False,
+        default='{}',
+    )
+
+    # at most one kept job per key
+    key = db.Column(
+        db.String(100),
+        unique=True,
+    )
+
+    # queued, running, done or failed
+    status = db.Column(
+        db.String(10),
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # not run before this; pushed back after each failed attempt
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    enqueued_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    started_at = db.Column(
+        db.DateTime,
+    )
+
+    # a running job still running after this is presumed lost
+    locked_until = db.Column(
+        db.DateTime,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    __table_args__ = (
+        # workers take the oldest due job of a status
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at', 'id'),
+    )
+
+
+@event.listens_for(Pool, 'connect')
+def _remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def _refuse_inherited_connection(dbapi_connection, connection_record,
+                                 connection_proxy):
+    """Never use a pooled connection opened by the process we forked from.
+
+    Raising DisconnectionError makes the pool invalidate the connection
+    and open a fresh one.
+    """
+
+    pid = os.getpid()
+    if connection_record.info.get('pid', pid) != pid:
+        raise exc.DisconnectionError(
+            f"connection belongs to pid {connection_record.info['pid']}, "
+            f"not {pid}")
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,218 @@
+"""Load shedding when the database falls behind.
+
+Each worker tracks how many requests it is handling and a moving average
+of the time its requests' database queries take; queries from job
+threads and commands don't count. Past either threshold it is
+overloaded, and:
+
+- pages wrapped in `@stale_while_overloaded` (timelines and profiles) are
+  served from the last good copy, marked stale with a `Warning: 110`
+  header. Copies are per viewer, so rendering each one again would shed
+  nothing; instead a worker refreshes at most STALE_MAX_REFRESHES of
+  them at a time in the background, and only copies older than
+  STALE_REFRESH_SECONDS;
+- views wrapped in `@shed_when_overloaded` (searches and other work that
+  can wait) answer 503 with a Retry-After header.
+
+Without a stored copy a page is rendered as usual. Thresholds come from
+the config:
+
+- OVERLOAD_MAX_IN_FLIGHT: concurrent requests per worker (0 disables)
+- OVERLOAD_MAX_DB_SECONDS: average query time (0 disables)
+- OVERLOAD_RETRY_AFTER: seconds clients are asked to wait
+- STALE_PAGE_SECONDS: how long last good copies are kept
+- STALE_REFRESH_SECONDS: how old a copy must be to be refreshed
+- STALE_MAX_REFRESHES: refreshes running at once per worker
+"""
+
+import threading
+import time
+from functools import wraps
+
+from flask import (Response, current_app, has_request_context, request,
+                   session, g)
+
+from cache import cache
+
+# weight of the newest query in the moving average
+DB_SECONDS_WEIGHT = 0.1
+
+# header marking a page served from a stored copy
+STALE_WARNING = '110 - "Response is Stale"'
+
+pages = cache.namespace('stale-pages')
+
+
+class LoadTracker:
+    """Requests in flight and average query time in this worker."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.db_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def finished(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def record_query(self, seconds):
+        with self._lock:
+            self.db_seconds += DB_SECONDS_WEIGHT * (seconds - self.db_seconds)
+
+    def overloaded(self, max_in_flight, max_db_seconds):
+        return bool((max_in_flight and self.in_flight > max_in_flight)
+                    or (max_db_seconds and self.db_seconds > max_db_seconds))
+
+    def reset(self):
+        with self._lock:
+            self.in_flight = 0
+            self.db_seconds = 0.0
+
+
+tracker = LoadTracker()
+
+
+def overloaded():
+    """Should this request be shed or served stale?"""
+
+    config = current_app.config
+    return tracker.overloaded(config['OVERLOAD_MAX_IN_FLIGHT'],
+                              config['OVERLOAD_MAX_DB_SECONDS'])
+
+
+def shed_when_overloaded(view):
+    """Answer 503 instead of running `view` while overloaded."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if overloaded():
+            retry = current_app.config['OVERLOAD_RETRY_AFTER']
+            return Response("Warbler is very busy right now; please try "
+                            "again shortly.", 503,
+                            {'Retry-After': str(retry)},
+                            mimetype='text/plain')
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+##############################################################################
+# Stale pages
+
+# page keys with a refresh running in this worker
+_refreshing = {}
+_refreshing_lock = threading.Lock()
+
+_REVALIDATE = 'warbler.revalidate'
+
+
+def _page_key():
+    viewer = g.user.id if g.get('user') else '-'
+    return f"{viewer}:{request.full_path}"
+
+
+def _refresh(app, environ, key):
+    try:
+        with app.request_context(environ):
+            app.full_dispatch_request()
+    finally:
+        with _refreshing_lock:
+            _refreshing.pop(key, None)
+
+
+def _start_refresh(key):
+    with _refreshing_lock:
+        if (key in _refreshing or len(_refreshing)
+                >= current_app.config['STALE_MAX_REFRESHES']):
+            return
+        environ = dict(request.environ)
+        environ[_REVALIDATE] = True
+        thread = threading.Thread(
+            target=_refresh, daemon=True,
+            args=(current_app._get_current_object(), environ, key))
+        _refreshing[key] = thread
+    thread.start()
+
+
+def stale_while_overloaded(view):
+    """Keep the last good copy of a GET page to serve while overloaded.
+
+    Copies are kept per viewer and URL.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != 'GET':
+            return view(*args, **kwargs)
+
+        key = _page_key()
+        if overloaded() and not request.environ.get(_REVALIDATE):
+            stored = pages.get(key)
+            if stored is not None:
+                body, content_type, stored_at = stored
+                if (time.time() - stored_at
+                        >= current_app.config['STALE_REFRESH_SECONDS']):
+                    _start_refresh(key)
+                return Response(body, 200, {'Warning': STALE_WARNING},
+                                content_type=content_type)
+
+        # flashed messages are shown once; don't replay them later
+        has_flashes = bool(session.get('_flashes'))
+        resp = current_app.make_response(view(*args, **kwargs))
+        if resp.status_code == 200 and not has_flashes and \
+                not resp.is_streamed:
+            pages.set(key, (resp.get_data(), resp.content_type, time.time()),
+                      current_app.config['STALE_PAGE_SECONDS'])
+        return resp
+
+    return wrapper
+
+
+##############################################################################
+# Hooks
+
+
+def _before_request():
+    tracker.started()
+    g._overload_counted = True
+
+
+def _teardown_request(exc):
+    if g.get('_overload_counted'):
+        tracker.finished()
+
+
+def _before_query(conn, cursor, statement, parameters, context, executemany):
+    # a long job or import says nothing about how requests are doing
+    if has_request_context():
+        conn.info['overload_query_start'] = time.perf_counter()
+
+
+def _after_query(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop('overload_query_start', None)
+    if start is not None:
+        tracker.record_query(time.perf_counter() - start)
+
+
+def init_app(app):
+    """Track load and read the overload thresholds."""
+
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    app.config.setdefault('OVERLOAD_MAX_IN_FLIGHT', 64)
+    app.config.setdefault('OVERLOAD_MAX_DB_SECONDS', 0.5)
+    app.config.setdefault('OVERLOAD_RETRY_AFTER', 10)
+    app.config.setdefault('STALE_PAGE_SECONDS', 60 * 60)
+    app.config.setdefault('STALE_REFRESH_SECONDS', 30)
+    app.config.setdefault('STALE_MAX_REFRESHES', 1)
+
+    app.before_request(_before_request)
+    app.teardown_request(_teardown_request)
+    if not event.contains(Engine, 'before_cursor_execute', _before_query):
+        event.listen(Engine, 'before_cursor_execute', _before_query)
+        event.listen(Engine, 'after_cursor_execute', _after_query)
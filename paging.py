@@ -0,0 +1,59 @@
+"""Keyset paging for timelines.
+
+Timelines are ordered newest first by (timestamp, id). Instead of an
+OFFSET, which makes the database read and discard every earlier row, the
+next page asks for rows strictly older than the last one shown. With an
+index on the filter columns plus (timestamp, id) each page is a single
+index range scan, however deep the reader goes.
+"""
+
+import base64
+import json
+from datetime import datetime
+
+
+def encode_cursor(timestamp, row_id):
+    data = [timestamp.isoformat(), row_id]
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """(timestamp, id) from a cursor; ValueError if it's malformed."""
+
+    try:
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(
+            cursor.encode()))
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("invalid page cursor")
+
+
+def keyset_page(query, timestamp_column, id_column, before=None, limit=100):
+    """One page of a single-entity `query`, newest first.
+
+    Rows are ordered by `timestamp_column` then `id_column`, which may
+    belong to a joined index table rather than the entity itself.
+    `before` is the previous page's cursor. Returns (entities, cursor);
+    the cursor is None on the last page. Raises ValueError for a
+    malformed cursor.
+    """
+
+    if before:
+        timestamp, row_id = decode_cursor(before)
+        # the plain range test comes first so an index on the
+        # timestamp can serve it; the OR alone would defeat the index
+        query = query.filter(
+            timestamp_column <= timestamp,
+            (timestamp_column < timestamp) | (id_column < row_id))
+
+    rows = (query
+            .add_columns(timestamp_column, id_column)
+            .order_by(timestamp_column.desc(), id_column.desc())
+            .limit(limit + 1)
+            .all())
+
+    cursor = None
+    if len(rows) > limit:
+        _, timestamp, row_id = rows[limit - 1]
+        cursor = encode_cursor(timestamp, row_id)
+    return [entity for entity, _, _ in rows[:limit]], cursor
@@ -0,0 +1,100 @@
+"""Run a request's independent database reads concurrently.
+
+The pinned Flask 1.0 / SQLAlchemy 1.2 stack has no async views or async
+engine. The equivalent here is a gevent worker (`gunicorn -k gevent`) with
+psycopg2 made cooperative by psycogreen: a worker then keeps serving other
+requests while one waits on Postgres, and `gather` can overlap a page's
+independent queries in greenlets.
+
+PARALLEL_READS picks how `gather` runs its callables:
+
+- 'auto' (default): greenlets when gevent has patched the process, else
+  one after another.
+- 'greenlets', 'threads' or 'off' to force a mode.
+
+Each callable runs in its own app context, and so its own session and
+connection. It should return plain values or fully loaded objects;
+lazy relationships on returned objects can't be loaded afterwards. Their
+queries count toward the request's in /metrics; anything else they put
+on `g` stays in their own context.
+
+`gather` leaves the request's own session alone. A session in the middle
+of a transaction keeps its connection while it waits, and then each
+request holds one connection while waiting for N more; a few concurrent
+requests can take the whole pool and wait on each other until the
+checkout timeout. So views commit before calling it, which gives the
+connection back, and don't use objects they loaded earlier inside the
+callables: committing expires them, and reloading them there would use
+the request's session from another thread.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+import metrics
+
+try:
+    import gevent
+    from gevent import monkey
+except ImportError:
+    gevent = None
+
+_executor = None
+
+
+def _gevent_patched():
+    return gevent is not None and monkey.is_module_patched('socket')
+
+
+def gather(*fns):
+    """Call each of `fns` and return their results, in order."""
+
+    mode = current_app.config['PARALLEL_READS']
+    if mode == 'auto':
+        mode = 'greenlets' if _gevent_patched() else 'off'
+
+    if mode == 'off' or len(fns) < 2:
+        return [fn() for fn in fns]
+
+    if mode not in ('greenlets', 'threads'):
+        raise ValueError(f"Unknown PARALLEL_READS {mode!r}")
+
+    app = current_app._get_current_object()
+    queries = []
+
+    def call(fn):
+        with app.app_context():
+            metrics.count_queries()
+            try:
+                return fn()
+            finally:
+                queries.append(metrics.counted_queries())
+
+    try:
+        if mode == 'greenlets':
+            jobs = [gevent.spawn(call, fn) for fn in fns]
+            gevent.joinall(jobs, raise_error=True)
+            return [job.value for job in jobs]
+        return list(_thread_pool(app).map(call, fns))
+    finally:
+        metrics.add_queries(sum(queries))
+
+
+def _thread_pool(app):
+    global _executor
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(app.config['PARALLEL_READ_THREADS'])
+    return _executor
+
+
+def init_app(app):
+    """Read PARALLEL_READS and make psycopg2 gevent-friendly if needed."""
+
+    app.config.setdefault('PARALLEL_READS', 'auto')
+    app.config.setdefault('PARALLEL_READ_THREADS', 8)
+
+    if _gevent_patched():
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
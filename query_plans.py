@@ -0,0 +1,140 @@
+"""Capture and inspect the query plans behind the app's routes.
+
+`captured_queries()` records every statement the app sends while it's
+active. `explain()` asks the database how it would run one, with
+parameter values and costs normalized away so the text only changes when
+the plan's shape does. On Postgres, SELECTs are run under EXPLAIN ANALYZE
+(the actual row counts are dropped too), with seq scans disabled so that
+a seq scan only appears when no index can serve the query, however small
+the tables are.
+
+test_query_plans.py uses these to check each route's plans and compare
+them with the snapshots in plan_snapshots/.
+"""
+
+import re
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+_NUMBER = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+# IN lists vary in length with the data; (?, ?, ?) and
+# (%(id_1)s, %(id_2)s) both become (...)
+_IN_LIST = re.compile(r'\bIN \((?:\?|%\(\w+\)s)(?:, (?:\?|%\(\w+\)s))*\)')
+_ACTUAL = re.compile(r' \(actual [^)]*\)| \(never executed\)')
+# EXPLAIN ANALYZE lines that vary from run to run
+_RUNTIME_DETAIL = re.compile(
+    r'^\s*(Rows Removed|Heap Fetches|Buckets|Sort Method|Memory Usage|'
+    r'Heap Blocks|Worker|Planning|Execution)')
+
+_SQLITE_SCAN = re.compile(r'\bSCAN (?:TABLE )?(\w+)')
+_SQLITE_INDEX = re.compile(r'\bUSING (?:COVERING )?INDEX (\w+)')
+_PG_SEQ_SCAN = re.compile(r'\bSeq Scan on (\w+)')
+_PG_INDEX = re.compile(r'\b(?:Index (?:Only )?Scan(?: Backward)? using|'
+                       r'Bitmap Index Scan on) (\w+)')
+
+
+@contextmanager
+def captured_queries():
+    """Collect the (statement, parameters) sent while in this block."""
+
+    queries = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if executemany:
+            parameters = parameters[0]
+        queries.append((statement, parameters))
+
+    event.listen(Engine, 'before_cursor_execute', record)
+    try:
+        yield queries
+    finally:
+        event.remove(Engine, 'before_cursor_execute', record)
+
+
+def normalize(text):
+    """`text` with literal values replaced, so plans compare across runs."""
+
+    text = _IN_LIST.sub('IN (...)', text)
+    return _NUMBER.sub('N', _STRING.sub('?', text))
+
+
+def _sqlite_plan(cursor, statement, parameters):
+    cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+    depth = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in cursor.fetchall():
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append('  ' * depth[node_id] + detail)
+    return lines
+
+
+def _postgres_plan(cursor, statement, parameters):
+    if statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+        options = 'ANALYZE, COSTS OFF, TIMING OFF, SUMMARY OFF'
+    else:
+        options = 'COSTS OFF'
+    cursor.execute('SET LOCAL enable_seqscan = off')
+    cursor.execute(f'EXPLAIN ({options}) ' + statement, parameters)
+    return [_ACTUAL.sub('', line) for (line,) in cursor.fetchall()
+            if not _RUNTIME_DETAIL.match(line)]
+
+
+def explain(engine, statement, parameters):
+    """The normalized plan of one statement, as a list of lines.
+
+    Runs in a transaction that is rolled back, so nothing is changed.
+    """
+
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        if engine.dialect.name == 'postgresql':
+            lines = _postgres_plan(cursor, statement, parameters)
+        else:
+            lines = _sqlite_plan(cursor, statement, parameters)
+        cursor.close()
+    finally:
+        conn.rollback()
+        conn.close()
+    return [normalize(line) for line in lines]
+
+
+def explain_all(engine, queries):
+    """[(normalized SQL, plan lines)] for each distinct explainable query."""
+
+    plans = []
+    seen = set()
+    for statement, parameters in queries:
+        sql = ' '.join(statement.split())
+        if not sql.upper().startswith(EXPLAINABLE) or sql in seen:
+            continue
+        seen.add(sql)
+        plans.append((normalize(sql),
+                      explain(engine, statement, parameters)))
+    return plans
+
+
+def format_plans(plans):
+    """Plans as snapshot text."""
+
+    blocks = []
+    for sql, lines in plans:
+        blocks.append('\n'.join([sql] + ['    ' + line for line in lines]))
+    return '\n\n'.join(blocks) + '\n'
+
+
+def full_scans(lines, dialect):
+    """Tables the plan reads in full."""
+
+    pattern = _PG_SEQ_SCAN if dialect == 'postgresql' else _SQLITE_SCAN
+    return {match for line in lines for match in pattern.findall(line)}
+
+
+def indexes_used(lines, dialect):
+    pattern = _PG_INDEX if dialect == 'postgresql' else _SQLITE_INDEX
+    return {match for line in lines for match in pattern.findall(line)}
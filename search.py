@@ -0,0 +1,156 @@
+"""Full-text search over messages.
+
+search_postings is an inverted index: one row per distinct term of each
+message, keyed by (term, message_id). Looking a term up is a range scan
+of the primary key, so a search reads only the postings of its own terms
+instead of every message's text. `index_messages` and `unindex_messages`
+keep it current inside the caller's transaction; messages_add and
+messages_destroy call them. `flask reindex-messages` rebuilds the index,
+e.g. after a bulk import. Archived messages aren't searchable.
+
+The same table works on Postgres and SQLite, so there is one code path
+rather than separate tsvector and FTS5 versions.
+
+Results come best first: a message scores the summed weights (times
+each appears) of the query's terms in it, and ties go to the most
+recently posted. A page ends with an opaque cursor holding its last
+score and id; the next page is aggregated, sorted and cut to size from
+the postings alone, and only its own rows are joined to messages.
+"""
+
+import base64
+import json
+import re
+from collections import Counter, namedtuple
+
+from sqlalchemy import func
+
+from models import db, Message, SearchPosting
+
+MAX_TERM_LENGTH = SearchPosting.term.type.length
+
+# terms of a query beyond this many are ignored
+MAX_QUERY_TERMS = 8
+
+PAGE_SIZE = 20
+
+# messages indexed per transaction when reindexing
+REINDEX_BATCH_SIZE = 5000
+
+_WORD = re.compile(r'\w+')
+
+SearchPage = namedtuple('SearchPage', 'results cursor')
+SearchResult = namedtuple('SearchResult', 'message score')
+
+
+def terms(text):
+    """{term: occurrences} for the words of `text`."""
+
+    return Counter(word for word in _WORD.findall(text.lower())
+                   if 1 < len(word) <= MAX_TERM_LENGTH)
+
+
+def _postings(messages):
+    return [dict(term=term, message_id=msg.id, weight=min(count, 32767))
+            for msg in messages
+            for term, count in terms(msg.text).items()]
+
+
+def index_messages(messages):
+    """Add postings for `messages`, which must have ids.
+
+    Joins the caller's transaction; the caller commits.
+    """
+
+    rows = _postings(messages)
+    if rows:
+        db.session.execute(SearchPosting.__table__.insert(), rows)
+
+
+def unindex_messages(message_ids):
+    """Remove the postings of `message_ids`. The caller commits."""
+
+    (SearchPosting.query
+     .filter(SearchPosting.message_id.in_(list(message_ids)))
+     .delete(synchronize_session=False))
+
+
+def reindex(batch_size=REINDEX_BATCH_SIZE):
+    """Rebuild every message's postings. Returns the messages indexed."""
+
+    indexed = 0
+    last_id = 0
+    while True:
+        msgs = (Message.query
+                .filter(Message.id > last_id)
+                .order_by(Message.id)
+                .limit(batch_size)
+                .all())
+        if not msgs:
+            break
+
+        ids = [msg.id for msg in msgs]
+        unindex_messages(ids)
+        index_messages(msgs)
+        db.session.commit()
+
+        indexed += len(msgs)
+        last_id = ids[-1]
+        db.session.expunge_all()
+
+    return indexed
+
+
+def encode_cursor(result):
+    data = [result.score, result.message.id]
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """(score, id) from a cursor; ValueError if malformed."""
+
+    try:
+        score, message_id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode()))
+        return int(score), int(message_id)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("invalid search cursor")
+
+
+def search(query, cursor=None, limit=PAGE_SIZE):
+    """A SearchPage of messages matching any term of `query`.
+
+    Pass the previous page's cursor to get the next page; the last page's
+    cursor is None. Raises ValueError for a malformed cursor.
+    """
+
+    after = decode_cursor(cursor) if cursor else None
+    wanted = list(terms(query))[:MAX_QUERY_TERMS]
+    if not wanted:
+        return SearchPage([], None)
+
+    score = func.sum(SearchPosting.weight)
+    matches = (db.session
+               .query(SearchPosting.message_id, score.label('score'))
+               .filter(SearchPosting.term.in_(wanted))
+               .group_by(SearchPosting.message_id))
+    if after:
+        after_score, after_id = after
+        matches = matches.having(
+            (score < after_score)
+            | ((score == after_score)
+               & (SearchPosting.message_id < after_id)))
+    page = (matches
+            .order_by(score.desc(), SearchPosting.message_id.desc())
+            .limit(limit + 1)
+            .subquery())
+
+    rows = (db.session
+            .query(Message, page.c.score)
+            .join(page, page.c.message_id == Message.id)
+            .order_by(page.c.score.desc(), Message.id.desc())
+            .all())
+
+    results = [SearchResult(msg, int(score)) for msg, score in rows[:limit]]
+    next_cursor = encode_cursor(results[-1]) if len(rows) > limit else None
+    return SearchPage(results, next_cursor)
@@ -0,0 +1,395 @@
+"""Messages and likes spread over several databases by user.
+
+SHARD_DATABASE_URLS lists the shard databases; each becomes a
+Flask-SQLAlchemy bind named shard0, shard1, ... Users, follows and
+everything else stay on the primary database.
+
+Users are hashed into NUM_BUCKETS buckets (user_id % NUM_BUCKETS), and
+shard_buckets on the primary database says which shard holds each bucket,
+so shards can be added by moving whole buckets instead of rehashing every
+user. A user's messages, and the likes they give, live on their bucket's
+shard. Message ids stay unique across shards: each shard counts its own,
+and an id is that count * MAX_SHARDS + the shard's number, so ids never
+collide and survive a move.
+
+`timeline(user_ids)` queries every shard holding one of the users
+concurrently (see parallel.py) and merges their newest messages.
+
+`flask init-shards` creates the shard tables, assigns buckets and copies
+existing messages and likes off the primary database. `flask
+rebalance-shards` evens out buckets over the configured shards (e.g.
+after adding one), moving their rows. While a bucket moves its users'
+writes raise ShardMoving.
+
+This is the routing layer only: the views still read and write the
+primary database's messages and likes tables.
+"""
+
+import heapq
+import time
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import (MetaData, Table, Column, Index, Integer, BigInteger,
+                        String, DateTime, select, and_, or_)
+
+from models import db, Message, Likes, ShardBucket
+import paging
+import parallel
+
+NUM_BUCKETS = 256
+
+# ids leave room for this many shards
+MAX_SHARDS = 64
+
+# rows copied per round trip when moving a bucket
+MOVE_BATCH_SIZE = 5000
+
+shard_metadata = MetaData()
+
+messages = Table(
+    'messages', shard_metadata,
+    Column('id', BigInteger, primary_key=True, autoincrement=False),
+    Column('text', String(140), nullable=False),
+    Column('timestamp', DateTime, nullable=False),
+    Column('user_id', Integer, nullable=False),
+    Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+)
+
+likes = Table(
+    'likes', shard_metadata,
+    Column('user_id', Integer, primary_key=True),
+    Column('message_id', BigInteger, primary_key=True),
+)
+
+# the last message number this shard handed out
+counters = Table(
+    'shard_counters', shard_metadata,
+    Column('name', String(20), primary_key=True),
+    Column('value', BigInteger, nullable=False),
+)
+
+
+class ShardMoving(Exception):
+    """The user's bucket is being moved to another shard; retry soon."""
+
+
+def shard_count():
+    return len(current_app.config['SHARD_DATABASE_URLS'])
+
+
+def engine(shard):
+    return db.get_engine(current_app, bind=f'shard{shard}')
+
+
+def bucket_for(user_id):
+    return user_id % NUM_BUCKETS
+
+
+##############################################################################
+# Routing
+
+_bucket_map = (0, {})
+
+
+def bucket_map(refresh=False):
+    """{bucket: (shard, read_only)}, re-read every SHARD_MAP_SECONDS."""
+
+    global _bucket_map
+
+    now = time.monotonic()
+    expires, buckets = _bucket_map
+    if refresh or now >= expires or not buckets:
+        rows = db.session.query(ShardBucket.bucket, ShardBucket.shard,
+                                ShardBucket.read_only)
+        buckets = {bucket: (shard, read_only)
+                   for bucket, shard, read_only in rows}
+        _bucket_map = (now + current_app.config['SHARD_MAP_SECONDS'],
+                       buckets)
+    return buckets
+
+
+def shard_for(user_id, writing=False):
+    """The shard holding `user_id`'s messages and likes."""
+
+    try:
+        shard, read_only = bucket_map()[bucket_for(user_id)]
+    except KeyError:
+        raise LookupError("shards aren't set up; run `flask init-shards`")
+    if writing and read_only:
+        raise ShardMoving(f"user #{user_id}'s data is moving shards")
+    return shard
+
+
+##############################################################################
+# Writes
+
+
+def _next_id(conn, shard):
+    match = counters.c.name == 'messages'
+    conn.execute(counters.update().where(match)
+                 .values(value=counters.c.value + 1))
+    count = conn.execute(select([counters.c.value]).where(match)).scalar()
+    return count * MAX_SHARDS + shard
+
+
+def add_message(user_id, text, timestamp=None):
+    """Store a message on its author's shard; return its id."""
+
+    shard = shard_for(user_id, writing=True)
+    with engine(shard).begin() as conn:
+        message_id = _next_id(conn, shard)
+        conn.execute(messages.insert().values(
+            id=message_id, text=text, user_id=user_id,
+            timestamp=timestamp or datetime.utcnow()))
+    return message_id
+
+
+def add_like(user_id, message_id):
+    with engine(shard_for(user_id, writing=True)).begin() as conn:
+        conn.execute(likes.insert().values(user_id=user_id,
+                                           message_id=message_id))
+
+
+def remove_like(user_id, message_id):
+    with engine(shard_for(user_id, writing=True)).begin() as conn:
+        conn.execute(likes.delete().where(
+            (likes.c.user_id == user_id) & (likes.c.message_id == message_id)))
+
+
+##############################################################################
+# Reads
+
+
+def liked_ids(user_id):
+    """Ids of the messages `user_id` has liked."""
+
+    with engine(shard_for(user_id)).connect() as conn:
+        return [message_id for (message_id,) in conn.execute(
+            select([likes.c.message_id]).where(likes.c.user_id == user_id))]
+
+
+def find_message(message_id):
+    """The message with this id, or None.
+
+    The shard that numbered it is asked first; a message that has since
+    moved (or was copied from the primary database) is looked for on the
+    others.
+    """
+
+    shards = list(range(shard_count()))
+    home = message_id % MAX_SHARDS
+    if home in shards:
+        shards.remove(home)
+        shards.insert(0, home)
+
+    for shard in shards:
+        with engine(shard).connect() as conn:
+            row = conn.execute(messages.select()
+                               .where(messages.c.id == message_id)).first()
+        if row is not None:
+            return row
+    return None
+
+
+def _newest(shard, user_ids, after, limit):
+    query = messages.select().where(messages.c.user_id.in_(user_ids))
+    if after:
+        timestamp, message_id = after
+        query = query.where(and_(
+            messages.c.timestamp <= timestamp,
+            or_(messages.c.timestamp < timestamp,
+                messages.c.id < message_id)))
+    query = (query
+             .order_by(messages.c.timestamp.desc(), messages.c.id.desc())
+             .limit(limit))
+    with engine(shard).connect() as conn:
+        return conn.execute(query).fetchall()
+
+
+def timeline(user_ids, before=None, limit=100):
+    """(messages by `user_ids`, next cursor), newest first, from every shard.
+
+    Takes and returns the same cursors as `paging.keyset_page`.
+    """
+
+    after = paging.decode_cursor(before) if before else None
+
+    by_shard = {}
+    for user_id in user_ids:
+        by_shard.setdefault(shard_for(user_id), []).append(user_id)
+
+    pages = parallel.gather(*[
+        lambda shard=shard, ids=ids: _newest(shard, ids, after, limit + 1)
+        for shard, ids in by_shard.items()])
+    rows = list(heapq.merge(*pages, key=lambda row: (row.timestamp, row.id),
+                            reverse=True))
+
+    cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        cursor = paging.encode_cursor(last.timestamp, last.id)
+    return rows[:limit], cursor
+
+
+##############################################################################
+# Setting up and moving buckets
+
+
+def _in_bucket(column, bucket):
+    return column % NUM_BUCKETS == bucket
+
+
+def _copy(rows, table, conn):
+    batch = []
+    for row in rows:
+        batch.append(dict(row))
+        if len(batch) == MOVE_BATCH_SIZE:
+            conn.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        conn.execute(table.insert(), batch)
+
+
+def init_shards(copy_primary=True):
+    """Create shard tables and give every bucket a shard.
+
+    With `copy_primary`, messages and likes already on the primary
+    database are copied to their users' shards. Returns the number of
+    messages copied.
+    """
+
+    count = shard_count()
+    if not count:
+        raise ValueError("SHARD_DATABASE_URLS is empty")
+
+    max_id = (db.session.query(db.func.max(Message.id)).scalar() or 0
+              if copy_primary else 0)
+    for shard in range(count):
+        shard_metadata.create_all(engine(shard))
+        with engine(shard).begin() as conn:
+            if conn.execute(select([counters.c.value])).first() is None:
+                # new ids start above every copied one
+                conn.execute(counters.insert().values(
+                    name='messages', value=max_id // MAX_SHARDS))
+
+    assigned = {bucket for (bucket,) in db.session.query(ShardBucket.bucket)}
+    db.session.add_all(ShardBucket(bucket=bucket, shard=bucket % count)
+                       for bucket in range(NUM_BUCKETS)
+                       if bucket not in assigned)
+    db.session.commit()
+
+    if not copy_primary:
+        return 0
+
+    copied = 0
+    primary = db.session.connection()
+    for bucket, (shard, _) in bucket_map(refresh=True).items():
+        with engine(shard).begin() as conn:
+            conn.execute(messages.delete().where(
+                _in_bucket(messages.c.user_id, bucket)))
+            conn.execute(likes.delete().where(
+                _in_bucket(likes.c.user_id, bucket)))
+            rows = primary.execute(
+                select([Message.id, Message.text, Message.timestamp,
+                        Message.user_id])
+                .where(_in_bucket(Message.user_id, bucket))).fetchall()
+            _copy(rows, messages, conn)
+            _copy(primary.execute(
+                select([Likes.user_id, Likes.message_id])
+                .where(_in_bucket(Likes.user_id, bucket))), likes, conn)
+        copied += len(rows)
+    return copied
+
+
+def move_bucket(bucket, to_shard, wait=None):
+    """Move a bucket's messages and likes to `to_shard`.
+
+    The bucket is made read-only and, after `wait` seconds (by default
+    SHARD_MAP_SECONDS, so every worker has seen that), copied, switched
+    over and deleted from its old shard. Safe to rerun if interrupted.
+    Returns the number of messages moved.
+    """
+
+    row = ShardBucket.query.get(bucket)
+    from_shard = row.shard
+    if from_shard == to_shard:
+        return 0
+
+    row.read_only = True
+    db.session.commit()
+    time.sleep(current_app.config['SHARD_MAP_SECONDS']
+               if wait is None else wait)
+
+    moved = 0
+    with engine(from_shard).connect() as source, \
+            engine(to_shard).begin() as dest:
+        # clear any partial copy from an interrupted move
+        dest.execute(messages.delete().where(
+            _in_bucket(messages.c.user_id, bucket)))
+        dest.execute(likes.delete().where(
+            _in_bucket(likes.c.user_id, bucket)))
+
+        rows = source.execute(messages.select().where(
+            _in_bucket(messages.c.user_id, bucket))).fetchall()
+        _copy(rows, messages, dest)
+        _copy(source.execute(likes.select().where(
+            _in_bucket(likes.c.user_id, bucket))), likes, dest)
+        moved = len(rows)
+
+    row.shard = to_shard
+    row.read_only = False
+    db.session.commit()
+
+    with engine(from_shard).begin() as conn:
+        conn.execute(messages.delete().where(
+            _in_bucket(messages.c.user_id, bucket)))
+        conn.execute(likes.delete().where(
+            _in_bucket(likes.c.user_id, bucket)))
+
+    bucket_map(refresh=True)
+    return moved
+
+
+def rebalance(wait=None, report=None):
+    """Move buckets until every shard holds an even share.
+
+    Only buckets on over-full shards move. Returns the number of buckets
+    moved; `report(bucket, from_shard, to_shard, messages)` is called
+    after each.
+    """
+
+    count = shard_count()
+    held = {shard: [] for shard in range(count)}
+    for bucket, (shard, _) in sorted(bucket_map(refresh=True).items()):
+        held.setdefault(shard, []).append(bucket)
+
+    # shards beyond the configured count are drained entirely
+    quota = {shard: NUM_BUCKETS // count + (shard < NUM_BUCKETS % count)
+             for shard in range(count)}
+    spare = [bucket for shard, buckets in sorted(held.items())
+             for bucket in buckets[quota.get(shard, 0):]]
+
+    moves = 0
+    for shard in range(count):
+        while len(held[shard]) < quota[shard] and spare:
+            bucket = spare.pop()
+            from_shard = bucket_map()[bucket][0]
+            moved = move_bucket(bucket, shard, wait)
+            held[shard].append(bucket)
+            moves += 1
+            if report:
+                report(bucket, from_shard, shard, moved)
+    return moves
+
+
+def init_app(app):
+    """Turn SHARD_DATABASE_URLS into binds."""
+
+    app.config.setdefault('SHARD_DATABASE_URLS', [])
+    app.config.setdefault('SHARD_MAP_SECONDS', 5)
+
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    for shard, url in enumerate(app.config['SHARD_DATABASE_URLS']):
+        binds[f'shard{shard}'] = url
+    app.config['SQLALCHEMY_BINDS'] = binds
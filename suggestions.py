@@ -0,0 +1,137 @@
+"""Who-to-follow suggestions computed from the follows graph.
+
+The graph is loaded into a sparse adjacency matrix A, where A[i, j] = 1
+when user i follows user j. For a batch of users, (A @ A)[i, j] counts the
+people i follows who follow j. Each candidate's score is that count plus a
+bonus for overall popularity (log follower count, scaled to at most
+POPULARITY_WEIGHT). People i already follows, and i themself, are never
+suggested.
+
+The top SUGGESTIONS_PER_USER candidates for every user are written to the
+follow_suggestions table by `flask compute-suggestions`, so the home page
+needs a single indexed lookup to show them.
+"""
+
+import numpy as np
+from scipy import sparse
+
+from models import db, Follows, FollowSuggestions
+
+SUGGESTIONS_PER_USER = 5
+
+# a candidate's popularity bonus is at most this many mutual follows
+POPULARITY_WEIGHT = 0.5
+
+# users whose suggestions are computed together
+BATCH_SIZE = 10000
+
+# rows per INSERT when saving suggestions
+SAVE_CHUNK = 10000
+
+
+def follow_matrix(follower_ids, followed_ids, num_users):
+    """Return the CSR adjacency matrix for the given follow edges."""
+
+    data = np.ones(len(follower_ids), dtype=np.float32)
+    return sparse.csr_matrix((data, (follower_ids, followed_ids)),
+                             shape=(num_users, num_users))
+
+
+def compute_suggestions(adjacency, user_ids=None, k=SUGGESTIONS_PER_USER,
+                        batch_size=BATCH_SIZE):
+    """Yield (user, rank, suggested, score) arrays, one set per batch.
+
+    `adjacency` is a CSR matrix from `follow_matrix`. Only users in
+    `user_ids` are computed if it is given; otherwise everyone who follows
+    somebody is.
+    """
+
+    in_degree = np.asarray(adjacency.sum(axis=0)).ravel()
+    popularity = np.log1p(in_degree)
+    if popularity.max() > 0:
+        popularity *= POPULARITY_WEIGHT / popularity.max()
+
+    if user_ids is None:
+        user_ids = np.flatnonzero(np.diff(adjacency.indptr))
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        rows = adjacency[batch]
+
+        # friends of friends, minus those already followed
+        scores = rows @ adjacency
+        scores = (scores - scores.multiply(rows)).tocoo()
+
+        row, col, mutual = scores.row, scores.col, scores.data
+        keep = (mutual > 0) & (col != batch[row])
+        row, col = row[keep], col[keep]
+        score = mutual[keep] + popularity[col]
+
+        # sort by user, then best score first, and keep the top k of each
+        order = np.lexsort((-score, row))
+        row, col, score = row[order], col[order], score[order]
+        starts = np.flatnonzero(np.r_[True, row[1:] != row[:-1]])
+        counts = np.diff(np.r_[starts, len(row)])
+        rank = np.arange(len(row)) - np.repeat(starts, counts)
+        top = rank < k
+
+        yield batch[row[top]], rank[top], col[top], score[top]
+
+
+def load_follow_matrix():
+    """Read the follows table into a CSR adjacency matrix."""
+
+    result = db.session.execute(
+        db.select([Follows.user_following_id,
+                   Follows.user_being_followed_id]))
+    edges = np.array(result.fetchall(), dtype=np.int64).reshape(-1, 2)
+    num_users = int(edges.max()) + 1 if len(edges) else 1
+    return follow_matrix(edges[:, 0], edges[:, 1], num_users)
+
+
+def save_suggestions(batches, user_ids=None):
+    """Replace stored suggestions with those in `batches`.
+
+    Only rows for `user_ids` are replaced if it is given. Everything happens
+    in one transaction, so readers see either the old or the new set.
+    """
+
+    table = FollowSuggestions.__table__
+    delete = table.delete()
+    if user_ids is not None:
+        delete = delete.where(table.c.user_id.in_([int(u) for u in user_ids]))
+    db.session.execute(delete)
+
+    saved = 0
+    for users, ranks, suggested, scores in batches:
+        for start in range(0, len(users), SAVE_CHUNK):
+            end = start + SAVE_CHUNK
+            db.session.execute(table.insert(), [
+                dict(user_id=u, rank=r, suggested_user_id=s, score=sc)
+                for u, r, s, sc in zip(users[start:end].tolist(),
+                                       ranks[start:end].tolist(),
+                                       suggested[start:end].tolist(),
+                                       scores[start:end].tolist())
+            ])
+        saved += len(users)
+
+    db.session.commit()
+    return saved
+
+
+def refresh_suggestions(user_ids=None):
+    """Recompute and store suggestions; returns the number of rows saved.
+
+    Only `user_ids` are refreshed if it is given; each of them loses their
+    old suggestions, even if they get no new ones.
+    """
+
+    adjacency = load_follow_matrix()
+    computed = None
+    if user_ids is not None:
+        user_ids = [int(u) for u in user_ids]
+        # anyone past the matrix is in no follows at all: nothing to suggest
+        computed = [u for u in user_ids if 0 <= u < adjacency.shape[0]]
+    return save_suggestions(compute_suggestions(adjacency, computed),
+                            user_ids)
@@ -0,0 +1,145 @@
+"""#tags and @mentions.
+
+A message's tags and mentions are parsed once, when it's written, into
+message_tags and message_mentions. Each row carries the message's
+timestamp, and both tables are indexed by (tag or user, timestamp,
+message_id), so /tags/<tag> and /users/<id>/mentions page through an
+index range scan with `paging.keyset_page` instead of scanning message
+text. Mentions of usernames that don't exist are dropped.
+
+`flask backfill-tags` indexes messages written before this existed, or
+loaded by `flask import-messages`.
+"""
+
+import re
+
+from markupsafe import Markup, escape
+
+from models import db, User, Message, MessageTag, MessageMention
+import paging
+
+MAX_TAG_LENGTH = MessageTag.tag.type.length
+
+TAG = re.compile(r'(?<!\w)#(\w+)')
+MENTION = re.compile(r'(?<![\w@])@(\w+)')
+
+# messages indexed per transaction when backfilling
+BACKFILL_BATCH_SIZE = 5000
+
+PAGE_SIZE = 50
+
+
+def parse(text):
+    """(set of tags, set of mentioned usernames) in `text`."""
+
+    tags = {tag.lower() for tag in TAG.findall(text)
+            if len(tag) <= MAX_TAG_LENGTH}
+    return tags, set(MENTION.findall(text))
+
+
+def index_messages(messages):
+    """Record the tags and mentions of `messages`, which must have ids.
+
+    Joins the caller's transaction; the caller commits.
+    """
+
+    tag_rows, mentioned = [], {}
+    for msg in messages:
+        tags, usernames = parse(msg.text)
+        tag_rows.extend(dict(message_id=msg.id, tag=tag,
+                             timestamp=msg.timestamp)
+                        for tag in tags)
+        for username in usernames:
+            mentioned.setdefault(username, []).append(msg)
+
+    mention_rows = []
+    if mentioned:
+        for user_id, username in (db.session
+                                  .query(User.id, User.username)
+                                  .filter(User.username.in_(mentioned))):
+            mention_rows.extend(dict(message_id=msg.id, user_id=user_id,
+                                     timestamp=msg.timestamp)
+                                for msg in mentioned[username])
+
+    if tag_rows:
+        db.session.execute(MessageTag.__table__.insert(), tag_rows)
+    if mention_rows:
+        db.session.execute(MessageMention.__table__.insert(), mention_rows)
+
+
+def unindex_messages(message_ids):
+    """Forget the tags and mentions of `message_ids`. The caller commits."""
+
+    message_ids = list(message_ids)
+    for model in (MessageTag, MessageMention):
+        (model.query
+         .filter(model.message_id.in_(message_ids))
+         .delete(synchronize_session=False))
+
+
+def backfill(batch_size=BACKFILL_BATCH_SIZE):
+    """Re-parse every message's tags and mentions.
+
+    Returns the number of messages indexed.
+    """
+
+    indexed = 0
+    last_id = 0
+    while True:
+        msgs = (Message.query
+                .filter(Message.id > last_id)
+                .order_by(Message.id)
+                .limit(batch_size)
+                .all())
+        if not msgs:
+            break
+
+        ids = [msg.id for msg in msgs]
+        unindex_messages(ids)
+        index_messages(msgs)
+        db.session.commit()
+
+        indexed += len(msgs)
+        last_id = ids[-1]
+        db.session.expunge_all()
+
+    return indexed
+
+
+def tag_timeline(tag, before=None, limit=PAGE_SIZE):
+    """(messages tagged `tag`, next page cursor), newest first."""
+
+    query = (Message.query
+             .join(MessageTag, MessageTag.message_id == Message.id)
+             .filter(MessageTag.tag == tag.lower()))
+    return paging.keyset_page(query, MessageTag.timestamp,
+                              MessageTag.message_id, before, limit)
+
+
+def mention_timeline(user_id, before=None, limit=PAGE_SIZE):
+    """(messages mentioning `user_id`, next page cursor), newest first."""
+
+    query = (Message.query
+             .join(MessageMention, MessageMention.message_id == Message.id)
+             .filter(MessageMention.user_id == user_id))
+    return paging.keyset_page(query, MessageMention.timestamp,
+                              MessageMention.message_id, before, limit)
+
+
+def link_tags(text):
+    """`text`, escaped, with each #tag linked to its timeline."""
+
+    parts, last = [], 0
+    for match in TAG.finditer(text):
+        parts.append(escape(text[last:match.start()]))
+        parts.append(Markup('<a href="/tags/{}">#{}</a>')
+                     .format(match[1].lower(), match[1]))
+        last = match.end()
+    parts.append(escape(text[last:]))
+    return Markup('').join(parts)
+
+
+def init_app(app):
+    """Add the `link_tags` template filter."""
+
+    app.jinja_env.filters['link_tags'] = link_tags
@@ -0,0 +1,85 @@
+"""App factory tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_app_factory.py
+
+
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase, mock
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+import models
+from app import create_app, portable_config, CURR_USER_KEY
+
+
+class CreateAppTests(TestCase):
+
+    def setUp(self):
+        self.db_app = models.db.app
+
+    def tearDown(self):
+        # connect_db points the shared db at the newest app
+        models.db.app = self.db_app
+
+    def test_config_overrides(self):
+        app = create_app({'SECRET_KEY': 'other', 'TESTING': True})
+        self.assertEqual(app.config['SECRET_KEY'], 'other')
+        self.assertTrue(app.testing)
+        self.assertIn('warbler.homepage', app.view_functions)
+        self.assertIn('export-graph', app.cli.commands)
+
+    def test_apps_are_independent(self):
+        first = create_app({'SECRET_KEY': 'first'})
+        second = create_app({'SECRET_KEY': 'second'})
+        self.assertIsNot(first, second)
+        self.assertEqual(first.config['SECRET_KEY'], 'first')
+
+    def test_portable_config(self):
+        """Can another process start from this app's config?"""
+
+        app = create_app({'SECRET_KEY': 'parent', 'UNPICKLABLE': lambda: 1})
+        config = portable_config(app)
+        self.assertEqual(config['SECRET_KEY'], 'parent')
+        self.assertNotIn('UNPICKLABLE', config)
+        self.assertEqual(create_app(config).config['SECRET_KEY'], 'parent')
+
+    def test_import_has_no_side_effects(self):
+        """Does importing app leave the app and heavy modules uncreated?"""
+
+        code = ("import sys, app; "
+                "print('app' in vars(app), 'forms' in sys.modules, "
+                "'numpy' in sys.modules)")
+        out = subprocess.check_output([sys.executable, '-c', code],
+                                      cwd=os.path.dirname(__file__) or '.')
+        self.assertEqual(out.split(), [b'False', b'False', b'False'])
+
+    def test_default_app(self):
+        import app as app_module
+
+        self.assertIs(app_module.app, app_module.app)
+        self.assertEqual(CURR_USER_KEY, 'curr_user')
+
+
+class ForkSafetyTests(TestCase):
+
+    def test_inherited_connection_replaced(self):
+        """Is a pooled connection from another pid never handed out?"""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine(f"sqlite:///{tmp}/fork.db",
+                                   poolclass=QueuePool)
+            with engine.connect() as conn:
+                parent = conn.connection.connection
+
+            with mock.patch('models.os.getpid', return_value=-1):
+                with engine.connect() as conn:
+                    child = conn.connection.connection
+
+            self.assertIsNot(child, parent)
+            engine.dispose()
@@ -0,0 +1,117 @@
+"""Cold message archive tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_archive.py
+
+
+from app import app
+import gzip
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from models import (db, User, Message, Likes, MessagePartition,
+                    ArchivedMessageRoute, ArchivedLike)
+import archive
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+db.create_all()
+
+
+class ArchiveTests(TestCase):
+
+    def setUp(self):
+        ArchivedLike.query.delete()
+        ArchivedMessageRoute.query.delete()
+        MessagePartition.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.dir = tempfile.mkdtemp()
+
+        self.u1 = User(email="test@test.com", username="testuser",
+                       password="HASHED_PASSWORD")
+        self.u2 = User(email="test2@test.com", username="testuser2",
+                       password="HASHED_PASSWORD")
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+
+        self.old = [Message(text=f"old {i}", user_id=self.u1.id,
+                            timestamp=datetime(2017, 1 + i, 15))
+                    for i in range(2)]
+        self.new = Message(text="new", user_id=self.u1.id,
+                           timestamp=datetime(2017, 6, 1))
+        db.session.add_all(self.old + [self.new])
+        db.session.commit()
+
+        db.session.add(Likes(user_id=self.u2.id, message_id=self.old[0].id))
+        db.session.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_archive_messages(self):
+        """Are whole months before the cutoff moved to cold partitions?"""
+
+        old_ids = [m.id for m in self.old]
+        partitions = archive.archive_messages(datetime(2017, 6, 20), self.dir)
+
+        self.assertEqual([p.name for p in partitions], ['2017_01', '2017_02'])
+        self.assertTrue(all(os.path.isfile(p.path) for p in partitions))
+        self.assertEqual(Message.query.count(), 1)
+        self.assertEqual(Likes.query.count(), 0)
+
+        msg = archive.find_archived_message(old_ids[0])
+        self.assertEqual(msg.text, "old 0")
+        self.assertEqual(msg.timestamp, datetime(2017, 1, 15))
+        self.assertEqual(msg.user.username, "testuser")
+        self.assertEqual(msg.liked_by, [self.u2.id])
+        self.assertIsNone(archive.find_archived_message(self.new.id))
+
+    def test_show_archived(self):
+        """Does /messages/<id> still work for archived messages?"""
+
+        old_id = self.old[1].id
+        archive.archive_messages(datetime(2017, 6, 1), self.dir)
+
+        resp = app.test_client().get(f'/messages/{old_id}')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('old 1', resp.get_data(as_text=True))
+
+        resp = app.test_client().get('/messages/999999')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_lookup_reads_one_block(self):
+        """Is each message found in its own gzip member?"""
+
+        march = [Message(text=f"march {i}", user_id=self.u1.id,
+                         timestamp=datetime(2017, 3, 1 + i))
+                 for i in range(5)]
+        db.session.add_all(march)
+        db.session.commit()
+        ids = [m.id for m in march]
+
+        block_size = archive.ARCHIVE_BLOCK_SIZE
+        archive.ARCHIVE_BLOCK_SIZE = 2
+        try:
+            partition = archive.archive_messages(datetime(2017, 4, 1),
+                                                 self.dir)[-1]
+        finally:
+            archive.ARCHIVE_BLOCK_SIZE = block_size
+
+        offsets = [ArchivedMessageRoute.query.get(i).offset for i in ids]
+        self.assertEqual(len(set(offsets)), 3)
+        self.assertEqual(offsets[0], 0)
+        self.assertEqual(offsets[0], offsets[1])
+        for i, msg_id in enumerate(ids):
+            self.assertEqual(archive.find_archived_message(msg_id).text,
+                             f"march {i}")
+
+        # still one ordinary gzip file
+        with gzip.open(partition.path, 'rt') as f:
+            self.assertEqual(len(f.readlines()), 5)
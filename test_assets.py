@@ -0,0 +1,90 @@
+"""Static asset build tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from app import app
+import assets
+
+
+class BuildAssetsTests(TestCase):
+
+    def setUp(self):
+        """Copy static/ somewhere we can build into."""
+
+        self.tmp = tempfile.mkdtemp()
+        self.static = os.path.join(self.tmp, 'static')
+        shutil.copytree(app.static_folder, self.static,
+                        ignore=shutil.ignore_patterns(assets.DIST_DIR))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_build_assets(self):
+        """Are assets fingerprinted, compressed and cross-referenced?"""
+
+        manifest = assets.build_assets(self.static)
+        dist = os.path.join(self.static, assets.DIST_DIR)
+
+        css = manifest['stylesheets/style.css']
+        self.assertRegex(css, r'^stylesheets/style\.[0-9a-f]{12}\.css$')
+        self.assertTrue(os.path.isfile(os.path.join(dist, css)))
+        self.assertTrue(os.path.isfile(
+            os.path.join(dist, manifest['images/warbler-hero.jpg'])))
+
+        # stylesheet points at the fingerprinted background image
+        with gzip.open(os.path.join(dist, css + '.gz')) as f:
+            text = f.read().decode('utf-8')
+        self.assertIn(f"/static/dist/{manifest['images/nav-bg.png']}", text)
+        self.assertNotIn('url("/static/images/nav-bg.png")', text)
+
+        # images aren't worth gzipping
+        self.assertFalse(os.path.isfile(os.path.join(
+            dist, manifest['images/default-pic.png'] + '.gz')))
+
+    def test_asset_url(self):
+        """Does asset_url map static paths and leave others alone?"""
+
+        manifest = {'images/default-pic.png': 'images/default-pic.abc.png'}
+        assets._manifest.update(manifest)
+        try:
+            self.assertEqual(assets.asset_url('/static/images/default-pic.png'),
+                             '/static/dist/images/default-pic.abc.png')
+            self.assertEqual(assets.asset_url('images/warbler-logo.png'),
+                             '/static/images/warbler-logo.png')
+            self.assertEqual(assets.asset_url('https://example.com/a.jpg'),
+                             'https://example.com/a.jpg')
+        finally:
+            assets._manifest.clear()
+
+    def test_serve_precompressed(self):
+        """Is the .gz copy served only to clients that accept gzip?"""
+
+        manifest = assets.build_assets(self.static)
+        css = manifest['stylesheets/style.css']
+        static_folder = app.static_folder
+        app.static_folder = self.static
+        client = app.test_client()
+        url = f'/static/dist/{css}'
+        try:
+            resp = client.get(url,
+                              headers={'Accept-Encoding': 'gzip, deflate'})
+            self.assertEqual(resp.headers.get('Content-Encoding'), 'gzip')
+            self.assertIn(b'nav-bg', gzip.decompress(resp.get_data()))
+            resp.close()
+
+            for refused in ('gzip;q=0', 'br;q=0, gzip;q=0.0', 'identity'):
+                resp = client.get(url, headers={'Accept-Encoding': refused})
+                self.assertNotIn('Content-Encoding', resp.headers)
+                self.assertIn(b'nav-bg', resp.get_data())
+                resp.close()
+        finally:
+            app.static_folder = static_folder
@@ -0,0 +1,75 @@
+"""Author card cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_author_cache.py
+
+
+from app import app
+import os
+from unittest import TestCase
+
+from models import db, User, Message
+from author_cache import AuthorCardCache
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+db.create_all(app=app)
+
+
+class AuthorCardCacheTests(TestCase):
+
+    def setUp(self):
+        """Create three users and an empty cache."""
+
+        Message.query.delete()
+        User.query.delete()
+
+        self.users = [
+            User(email=f"test{i}@test.com", username=f"testuser{i}",
+                 password="HASHED_PASSWORD", image_url=f"/img/{i}.png")
+            for i in range(3)
+        ]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+        self.ids = [u.id for u in self.users]
+        self.cache = AuthorCardCache(max_size=2, ttl=60)
+
+    def test_get_many(self):
+        """Are cards loaded on a miss and served from cache afterwards?"""
+
+        cards = self.cache.get_many(self.ids[:2])
+        self.assertEqual(cards[self.ids[0]].username, "testuser0")
+        self.assertEqual(cards[self.ids[1]].image_url, "/img/1.png")
+        self.assertEqual(self.cache.misses, 2)
+
+        self.cache.get_many(self.ids[:2])
+        self.assertEqual(self.cache.hits, 2)
+        self.assertEqual(self.cache.hit_rate, 0.5)
+
+    def test_eviction(self):
+        """Does the cache stay within max_size, dropping the oldest card?"""
+
+        self.cache.get_many(self.ids[:2])
+        self.cache.get_many(self.ids[2:])
+        self.assertEqual(self.cache.stats()['size'], 2)
+
+        self.cache.get_many([self.ids[0]])
+        self.assertEqual(self.cache.misses, 4)
+
+    def test_invalidate_and_ttl(self):
+        """Are invalidated or expired cards reloaded?"""
+
+        self.cache.get_many([self.ids[0]])
+        self.users[0].username = "renamed"
+        db.session.commit()
+
+        self.cache.invalidate(self.ids[0])
+        cards = self.cache.get_many([self.ids[0]])
+        self.assertEqual(cards[self.ids[0]].username, "renamed")
+
+        self.cache.ttl = -1
+        self.cache.get_many([self.ids[1]])
+        self.cache.get_many([self.ids[1]])
+        self.assertEqual(self.cache.hits, 0)
@@ -0,0 +1,152 @@
+"""Uploaded image tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_avatars.py
+
+
+from app import app, CURR_USER_KEY
+import os
+import shutil
+import tempfile
+from io import BytesIO
+from unittest import TestCase
+
+from PIL import Image
+
+from models import db, User, Message, Likes, Follows
+import avatars
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+def make_image(size=(800, 600), fmt='PNG'):
+    buffer = BytesIO()
+    Image.new('RGB', size, (200, 40, 40)).save(buffer, fmt)
+    buffer.seek(0)
+    return buffer
+
+
+class AvatarTests(TestCase):
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.upload_dir = tempfile.mkdtemp()
+        app.config['UPLOAD_DIR'] = self.upload_dir
+        app.config['AVATAR_WORKERS'] = 0
+
+        user = User.signup("testuser", "test@test.com", "testuser", None)
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        shutil.rmtree(self.upload_dir)
+
+    def edit_profile(self, **files):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            data = dict(username="testuser", email="test@test.com",
+                        password="testuser")
+            data.update(files)
+            return client.post('/users/profile', data=data,
+                               content_type='multipart/form-data')
+
+    def test_upload_makes_every_size(self):
+        """Does an uploaded avatar get stored in every size and format?"""
+
+        resp = self.edit_profile(image_file=(make_image(), 'me.png'),
+                                 header_image_file=(make_image(), 'bg.png'))
+        self.assertEqual(resp.status_code, 302)
+
+        user = User.query.get(self.user_id)
+        self.assertRegex(user.image_url, r'^/media/\w+-avatar-profile\.jpg$')
+        self.assertRegex(user.header_image_url,
+                         r'^/media/\w+-header-profile\.jpg$')
+
+        for kind, sizes in avatars.SIZES.items():
+            for size, box in sizes.items():
+                url = avatars.image_url(getattr(
+                    user, 'image_url' if kind == 'avatar'
+                    else 'header_image_url'), size)
+                path = os.path.join(self.upload_dir, url[len('/media/'):])
+                for ext in ('.jpg', '.webp'):
+                    with Image.open(path[:-len('.jpg')] + ext) as img:
+                        self.assertEqual(img.size, box)
+
+    def test_bad_upload_is_refused(self):
+        """Are files that aren't images turned away?"""
+
+        resp = self.edit_profile(image_file=(BytesIO(b'not an image'),
+                                             'me.png'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"an image we can read", resp.data)
+
+        resp = self.edit_profile(image_file=(make_image(), 'me.exe'))
+        self.assertEqual(resp.status_code, 200)
+
+        user = User.query.get(self.user_id)
+        self.assertEqual(user.image_url, User.image_url.default.arg)
+        self.assertEqual(os.listdir(self.upload_dir), [])
+
+    def test_too_many_pixels_refused(self):
+        """Are images over MAX_PIXELS refused, not just warned about?"""
+
+        # under the 2 * MAX_PIXELS where Pillow itself gives up
+        big = BytesIO()
+        Image.new('1', (8000, 6000)).save(big, 'PNG')
+        big.seek(0)
+
+        with self.assertRaisesRegex(ValueError, "an image we can read"):
+            with app.app_context():
+                avatars.save_upload(big, 'avatar')
+        self.assertEqual(os.listdir(self.upload_dir), [])
+
+    def test_image_url(self):
+        """Are uploads resized and other images left alone?"""
+
+        url = '/media/0123456789abcdef0123-avatar-profile.jpg'
+        with app.test_request_context():
+            self.assertEqual(avatars.image_url(url, 'timeline'),
+                             '/media/0123456789abcdef0123-avatar-timeline.jpg')
+            self.assertEqual(avatars.image_url('http://x.test/a.png', 'card'),
+                             'http://x.test/a.png')
+
+    def test_serve_webp_when_accepted(self):
+        """Does /media/ pick WebP for browsers that accept it?"""
+
+        self.edit_profile(image_file=(make_image(), 'me.png'))
+        url = avatars.image_url(User.query.get(self.user_id).image_url,
+                                'timeline')
+
+        with app.test_client() as client:
+            resp = client.get(url, headers={'Accept': 'image/webp,*/*'})
+            self.assertEqual(resp.mimetype, 'image/webp')
+            self.assertEqual(resp.headers['Vary'], 'Accept')
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+
+            resp = client.get(url, headers={'Accept': 'image/*'})
+            self.assertEqual(resp.mimetype, 'image/jpeg')
+
+            resp = client.get('/media/missing.jpg')
+            self.assertEqual(resp.status_code, 404)
+
+    def test_originals_not_served(self):
+        """Are originals, metadata and all, kept out of /media/?"""
+
+        self.edit_profile(image_file=(make_image(), 'me.png'))
+        url = User.query.get(self.user_id).image_url
+        digest = url[len('/media/'):].split('-')[0]
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.upload_dir, 'originals', digest)))
+
+        resp = app.test_client().get(f'/media/originals/{digest}')
+        self.assertEqual(resp.status_code, 404)
@@ -0,0 +1,147 @@
+"""Bulk message import tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bulk_import.py
+
+
+from app import app
+import io
+import json
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Likes, Follows
+import bulk_import
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+db.create_all()
+
+
+class BulkImportTests(TestCase):
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.user = User(email="test@test.com", username="testuser",
+                         password="HASHED_PASSWORD")
+        db.session.add(self.user)
+        db.session.commit()
+        self.user_id = self.user.id
+
+    def ndjson(self, records):
+        return io.StringIO(''.join(
+            (r if isinstance(r, str) else json.dumps(r)) + '\n'
+            for r in records))
+
+    def test_validate(self):
+        user_id, text, timestamp = bulk_import.validate(
+            dict(user_id='3', text='hi', timestamp='2017-01-02T03:04:05Z'))
+        self.assertEqual((user_id, text), (3, 'hi'))
+        self.assertEqual(timestamp, datetime(2017, 1, 2, 3, 4, 5))
+
+        # stored as naive UTC
+        _, _, timestamp = bulk_import.validate(dict(
+            user_id='3', text='hi', timestamp='2017-01-02T03:04:05+05:00'))
+        self.assertEqual(timestamp, datetime(2017, 1, 1, 22, 4, 5))
+
+        for record, error in [
+            ('{not json', "not a JSON object"),
+            (dict(text='hi'), "missing or invalid user_id"),
+            (dict(user_id=1, text=' '), "missing text"),
+            (dict(user_id=1, text='x' * 141), "longer than 140"),
+            (dict(user_id=1, text='hi', timestamp='soon'),
+             "invalid timestamp"),
+        ]:
+            with self.assertRaisesRegex(ValueError, error):
+                bulk_import.validate(record)
+
+    def test_import_with_dead_letters(self):
+        """Do good rows load, per batch, while bad ones are set aside?"""
+
+        source = self.ndjson(
+            [dict(user_id=self.user_id, text=f"imported {i}",
+                  timestamp='2017-01-01T00:00:00') for i in range(7)]
+            + ['{broken', dict(user_id=self.user_id + 999, text='ghost')])
+        dead = io.StringIO()
+
+        stats = bulk_import.import_messages(source, 'ndjson', dead,
+                                            batch_size=3)
+
+        self.assertEqual((stats.loaded, stats.rejected), (7, 2))
+        self.assertEqual(Message.query.filter_by(user_id=self.user_id)
+                         .count(), 7)
+
+        letters = [json.loads(line) for line in dead.getvalue().splitlines()]
+        self.assertEqual([(letter['line'], letter['error'])
+                          for letter in letters],
+                         [(8, "not a JSON object"), (9, "unknown user_id")])
+        self.assertEqual(letters[1]['record']['text'], 'ghost')
+
+    def test_failed_batch_dead_letters_each_row_once(self):
+        """Are rows rejected before a batch fails only dead-lettered once?"""
+
+        batch = [(1, dict(user_id=self.user_id, text='fine')),
+                 (2, dict(user_id=self.user_id)),
+                 (3, dict(user_id=self.user_id + 999, text='ghost'))]
+
+        def fail(rows):
+            raise RuntimeError("disk full")
+
+        copy_rows = bulk_import._copy_rows
+        insert_rows = bulk_import._insert_rows
+        bulk_import._copy_rows = bulk_import._insert_rows = fail
+        try:
+            loaded, dead = bulk_import.load_batch(batch)
+        finally:
+            bulk_import._copy_rows = copy_rows
+            bulk_import._insert_rows = insert_rows
+
+        self.assertEqual(loaded, 0)
+        self.assertEqual(sorted((letter['line'], letter['error'])
+                                for letter in dead),
+                         [(1, "batch failed: disk full"),
+                          (2, "missing text"), (3, "unknown user_id")])
+
+    def test_csv(self):
+        source = io.StringIO("user_id,text,timestamp\n"
+                             f"{self.user_id},\"hello, csv\",\n"
+                             f"{self.user_id},,\n")
+        dead = io.StringIO()
+
+        stats = bulk_import.import_messages(source, 'csv', dead)
+
+        self.assertEqual((stats.loaded, stats.rejected), (1, 1))
+        self.assertEqual(Message.query.one().text, "hello, csv")
+        self.assertEqual(json.loads(dead.getvalue())['line'], 3)
+
+    def test_parallel_workers(self):
+        source = self.ndjson([dict(user_id=self.user_id, text=f"w {i}")
+                              for i in range(50)])
+        with app.app_context():
+            stats = bulk_import.import_messages(source, 'ndjson',
+                                                io.StringIO(), workers=2,
+                                                batch_size=10)
+        self.assertEqual(stats.loaded, 50)
+        self.assertEqual(Message.query.count(), 50)
+
+    def test_cli(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'messages.ndjson')
+            with open(path, 'w') as f:
+                f.write(json.dumps(dict(user_id=self.user_id, text='cli')))
+                f.write('\n{bad\n')
+
+            result = app.test_cli_runner().invoke(
+                args=['import-messages', path, '--workers', '1'])
+
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn('imported 1 loaded, 1 rejected', result.output)
+            with open(path + '.rejected.ndjson') as f:
+                self.assertEqual(json.loads(f.read())['line'], 2)
@@ -0,0 +1,276 @@
+"""Cache backend tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+import fcntl
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+from time import time
+from unittest import TestCase
+
+from flask import Flask
+
+from cache import Cache, LocalCache, FileCache, MemcachedCache
+
+
+class MemcachedStandIn(socketserver.ThreadingTCPServer):
+    """Just enough of a memcached server to test the client against."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), MemcachedHandler)
+        self.data = {}
+        self.lock = threading.Lock()
+
+
+class MemcachedHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        data = self.server.data
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd, *args = line.split()
+            with self.server.lock:
+                if cmd == b'get':
+                    for key in args:
+                        if key in data and (not data[key][2]
+                                            or data[key][2] > time()):
+                            flags, value, _ = data[key]
+                            self.wfile.write(b'VALUE %s %d %d\r\n%s\r\n' % (
+                                key, flags, len(value), value))
+                    self.wfile.write(b'END\r\n')
+                elif cmd in (b'set', b'add'):
+                    key, flags, exptime, length = args
+                    value = self.rfile.read(int(length) + 2)[:-2]
+                    if cmd == b'add' and key in data:
+                        self.wfile.write(b'NOT_STORED\r\n')
+                        continue
+                    expires = time() + int(exptime) if int(exptime) else 0
+                    data[key] = (int(flags), value, expires)
+                    self.wfile.write(b'STORED\r\n')
+                elif cmd == b'delete':
+                    found = data.pop(args[0], None)
+                    self.wfile.write(b'DELETED\r\n' if found
+                                     else b'NOT_FOUND\r\n')
+                elif cmd in (b'incr', b'decr'):
+                    if not args[1].isdigit():
+                        self.wfile.write(b'CLIENT_ERROR invalid numeric '
+                                         b'delta argument\r\n')
+                        continue
+                    if args[0] not in data:
+                        self.wfile.write(b'NOT_FOUND\r\n')
+                        continue
+                    flags, value, expires = data[args[0]]
+                    delta = int(args[1]) if cmd == b'incr' else -int(args[1])
+                    value = str(max(int(value) + delta, 0)).encode()
+                    data[args[0]] = (flags, value, expires)
+                    self.wfile.write(value + b'\r\n')
+
+
+class BackendTests:
+    """Behaviour every backend must share; mixed into a TestCase below."""
+
+    def test_get_set_delete(self):
+        self.assertIsNone(self.cache.get('missing'))
+        self.cache.set('a', {'user': 1})
+        self.assertEqual(self.cache.get('a'), {'user': 1})
+        self.cache.delete('a')
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_get_many(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', [2])
+        self.assertEqual(self.cache.get_many(['a', 'b', 'c']),
+                         {'a': 1, 'b': [2]})
+
+    def test_ttl(self):
+        self.cache.set('gone', 1, ttl=-1)
+        self.cache.set('kept', 1, ttl=0)
+        self.assertIsNone(self.cache.get('gone'))
+        self.assertEqual(self.cache.get('kept'), 1)
+
+    def test_incr(self):
+        self.assertEqual(self.cache.incr('n'), 1)
+        self.assertEqual(self.cache.incr('n', 5), 6)
+        self.assertEqual(self.cache.get('n'), 6)
+
+    def test_namespace(self):
+        timelines = self.cache.namespace('timeline')
+        timelines.set('1', 'page')
+        self.assertEqual(timelines.get_many(['1']), {'1': 'page'})
+        self.assertIsNone(self.cache.get('1'))
+
+        timelines.invalidate()
+        self.assertIsNone(timelines.get('1'))
+
+
+class LocalCacheTests(BackendTests, TestCase):
+
+    def setUp(self):
+        self.cache = LocalCache(max_size=3)
+
+    def test_eviction(self):
+        for key in 'abcd':
+            self.cache.set(key, key)
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('d'), 'd')
+
+
+class FileCacheTests(BackendTests, TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = FileCache(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_shared_between_instances(self):
+        self.cache.set('a', 1)
+        self.assertEqual(FileCache(self.dir).get('a'), 1)
+
+    def test_sweep(self):
+        """Are expired entries and abandoned files deleted?"""
+
+        self.cache.set('kept', 1, ttl=0)
+        self.cache.set('gone', 1, ttl=-1)
+        self.cache.incr('counter')
+        self.cache.incr('held')
+        stale = time() - 3600
+        tmp = os.path.join(self.dir, 'crashed.tmp')
+        open(tmp, 'w').close()
+        for path in (tmp, self.cache._path('counter') + '.lock',
+                     self.cache._path('held') + '.lock'):
+            os.utime(path, (stale, stale))
+
+        with open(self.cache._path('held') + '.lock') as held:
+            fcntl.flock(held, fcntl.LOCK_EX)
+            self.assertEqual(self.cache.sweep(), 3)
+
+        self.assertEqual(sorted(os.listdir(self.dir)), sorted([
+            FileCache.SWEPT,
+            self.cache._path('kept')[-40:],
+            self.cache._path('counter')[-40:],
+            self.cache._path('held')[-40:],
+            self.cache._path('held')[-40:] + '.lock',
+        ]))
+        self.assertEqual(self.cache.incr('counter'), 2)
+
+    def test_set_sweeps_now_and_then(self):
+        self.cache.set('gone', 1, ttl=-1)
+        self.assertFalse(os.path.exists(self.cache._path('gone')))
+        self.cache.set('gone', 1, ttl=-1)
+        self.assertTrue(os.path.exists(self.cache._path('gone')))
+
+
+class MemcachedCacheTests(BackendTests, TestCase):
+
+    def setUp(self):
+        self.server = MemcachedStandIn()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.server_address
+        self.cache = MemcachedCache([f"{host}:{port}"])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_long_keys(self):
+        key = 'x y' * 200
+        self.cache.set(key, 'v')
+        self.assertEqual(self.cache.get(key), 'v')
+
+    def test_decr(self):
+        """Do negative deltas decrement, stopping at 0 as memcached does?"""
+
+        self.assertEqual(self.cache.incr('n', 5), 5)
+        self.assertEqual(self.cache.incr('n', -2), 3)
+        self.assertEqual(self.cache.incr('n', -10), 0)
+        self.assertEqual(self.cache.incr('new', -1), 0)
+
+    def test_clear_leaves_other_prefixes(self):
+        """Does clear drop only this prefix's keys from a shared server?"""
+
+        host, port = self.server.server_address
+        mine = MemcachedCache([f"{host}:{port}"], prefix='mine:')
+        theirs = MemcachedCache([f"{host}:{port}"], prefix='theirs:')
+        mine.set('mine:a', 1)
+        theirs.set('theirs:a', 2)
+
+        mine.clear()
+        self.assertIsNone(mine.get('mine:a'))
+        self.assertEqual(theirs.get('theirs:a'), 2)
+        mine.set('mine:a', 3)
+        self.assertEqual(mine.get('mine:a'), 3)
+
+    def test_server_down(self):
+        """Is an unreachable server treated as a miss, not an error?"""
+
+        host, port = self.server.server_address
+        self.server.server_close()
+        cache = MemcachedCache([f"{host}:{port}"])
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get_many(['a']), {})
+        cache.set('a', 1)
+        cache.delete('a')
+        self.assertIsNone(cache.incr('n'))
+        cache.clear()
+
+    def test_threads_get_their_own_replies(self):
+        """Can threads share the client without reading others' replies?"""
+
+        errors = []
+
+        def hammer(n):
+            try:
+                for i in range(50):
+                    self.cache.set(f'{n}:{i}', [n, i])
+                    if self.cache.get(f'{n}:{i}') != [n, i]:
+                        errors.append((n, i))
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=hammer, args=(n,))
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+class CacheConfigTests(TestCase):
+
+    def test_init_app(self):
+        """Is the backend chosen from the Flask config?"""
+
+        app = Flask(__name__)
+        app.config['CACHE_TYPE'] = 'null'
+        cache = Cache()
+        cache.init_app(app)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+        app.config['CACHE_TYPE'] = 'bogus'
+        with self.assertRaises(ValueError):
+            cache.init_app(app)
+
+    def test_prefix(self):
+        app = Flask(__name__)
+        app.config['CACHE_KEY_PREFIX'] = 'test:'
+        cache = Cache()
+        cache.init_app(app)
+        cache.set('a', 1)
+        self.assertEqual(cache.backend.get('test:a'), 1)
+        self.assertEqual(cache.get_many(['a']), {'a': 1})
@@ -0,0 +1,83 @@
+"""Response compression middleware tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_compression.py
+
+
+import gzip
+from unittest import TestCase
+
+from flask import Flask, Response
+
+from compression import CompressionMiddleware
+
+PAGE = "<li>warble</li>" * 200
+
+
+def make_app(**options):
+    """Small app with HTML, tiny, streamed and precompressed routes."""
+
+    app = Flask(__name__)
+
+    @app.route('/page')
+    def page():
+        return PAGE
+
+    @app.route('/tiny')
+    def tiny():
+        return "<p>hi</p>"
+
+    @app.route('/stream')
+    def stream():
+        return Response((PAGE for _ in range(3)), mimetype='text/html')
+
+    @app.route('/precompressed')
+    def precompressed():
+        resp = Response(gzip.compress(PAGE.encode()), mimetype='text/css')
+        resp.headers['Content-Encoding'] = 'gzip'
+        return resp
+
+    app.wsgi_app = CompressionMiddleware(app.wsgi_app, **options)
+    return app
+
+
+class CompressionMiddlewareTests(TestCase):
+
+    def setUp(self):
+        self.client = make_app(min_size=500, streaming=True).test_client()
+
+    def test_gzip(self):
+        """Is HTML gzipped for clients that accept it?"""
+
+        resp = self.client.get('/page', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(int(resp.headers['Content-Length']), len(resp.data))
+        self.assertEqual(gzip.decompress(resp.data).decode(), PAGE)
+
+    def test_passthrough(self):
+        """Are tiny, unrequested and already-encoded responses left alone?"""
+
+        resp = self.client.get('/page')
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.get_data(as_text=True), PAGE)
+
+        resp = self.client.get('/page', headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+        resp = self.client.get('/tiny', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.data, b"<p>hi</p>")
+
+        resp = self.client.get('/precompressed',
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(gzip.decompress(resp.data).decode(), PAGE)
+
+    def test_streaming(self):
+        """Are streamed responses compressed without a Content-Length?"""
+
+        resp = self.client.get('/stream', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', resp.headers)
+        self.assertEqual(gzip.decompress(resp.data).decode(), PAGE * 3)
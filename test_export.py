@@ -0,0 +1,189 @@
+"""Streaming data export tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_export.py
+
+
+from app import app, CURR_USER_KEY
+import csv
+import io
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from models import (db, User, Message, Likes, Follows, MessagePartition,
+                    ArchivedMessageRoute, ArchivedLike)
+import archive
+import export
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class ExportTests(TestCase):
+
+    def setUp(self):
+        ArchivedLike.query.delete()
+        ArchivedMessageRoute.query.delete()
+        MessagePartition.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.u1 = User(email="test@test.com", username="testuser",
+                       password="HASHED_PASSWORD")
+        self.u2 = User(email="test2@test.com", username="testuser2",
+                       password="HASHED_PASSWORD")
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+
+        self.msgs = [Message(text=f"warble, {i}", user_id=self.u1.id,
+                             timestamp=datetime(2017, 6, 1 + i))
+                     for i in range(5)]
+        other = Message(text="other", user_id=self.u2.id,
+                        timestamp=datetime(2017, 6, 1))
+        db.session.add_all(self.msgs + [other])
+        db.session.commit()
+
+        db.session.add(Likes(user_id=self.u1.id, message_id=other.id))
+        db.session.add(Follows(user_following_id=self.u1.id,
+                               user_being_followed_id=self.u2.id))
+        db.session.commit()
+
+        self.u1_id = self.u1.id
+        self.u2_id = self.u2.id
+        self.other_id = other.id
+
+    def test_csv_chunks(self):
+        """Is CSV produced a chunk at a time, with progress counted?"""
+
+        progress = export.ExportProgress()
+        chunks = list(export.export(self.u1_id, 'messages', 'csv', progress,
+                                    chunk_size=2))
+
+        # header, then 2 + 2 + 1 rows
+        self.assertEqual(len(chunks), 4)
+        rows = list(csv.reader(io.StringIO(''.join(chunks))))
+        self.assertEqual(rows[0], ['id', 'text', 'timestamp'])
+        self.assertEqual([r[1] for r in rows[1:]],
+                         [f"warble, {i}" for i in range(5)])
+        self.assertEqual(rows[1][2], '2017-06-01T00:00:00')
+        self.assertEqual(progress.rows, 5)
+        self.assertEqual(progress.bytes, len(''.join(chunks)))
+
+    def test_ndjson_account(self):
+        data = ''.join(export.export(self.u1_id, 'account', 'ndjson'))
+        records = [json.loads(line) for line in data.splitlines()]
+
+        self.assertEqual([r['type'] for r in records],
+                         ['messages'] * 5 + ['likes', 'following'])
+        self.assertEqual(records[5], dict(type='likes',
+                                          message_id=self.other_id,
+                                          text='other',
+                                          author_id=self.u2_id))
+
+    def test_bad_requests(self):
+        """Are unknown datasets and formats refused up front?"""
+
+        for dataset, fmt in [('account', 'csv'), ('bogus', 'ndjson'),
+                             ('messages', 'xml')]:
+            with self.assertRaises(ValueError):
+                export.export(self.u1_id, dataset, fmt)
+
+    def test_archived_messages(self):
+        """Are messages in cold storage exported too?"""
+
+        directory = tempfile.mkdtemp()
+        chunk_size = archive.ROUTE_CHUNK_SIZE
+        archive.ROUTE_CHUNK_SIZE = 2
+        try:
+            archive.archive_messages(datetime(2017, 7, 1), directory)
+            self.assertEqual(Message.query.count(), 0)
+            db.session.expunge_all()
+
+            data = ''.join(export.export(self.u1_id, 'messages', 'ndjson'))
+            # routes are streamed as rows, not loaded as objects
+            self.assertFalse([obj for obj in db.session.identity_map.values()
+                              if isinstance(obj, ArchivedMessageRoute)])
+        finally:
+            archive.ROUTE_CHUNK_SIZE = chunk_size
+            shutil.rmtree(directory)
+
+        records = [json.loads(line) for line in data.splitlines()]
+        self.assertEqual([r['text'] for r in records],
+                         [f"warble, {i}" for i in range(5)])
+        self.assertEqual(records[0]['timestamp'], '2017-06-01T00:00:00')
+
+    def test_archived_likes_read_only_their_blocks(self):
+        """Are archived likes exported, reading only the blocks needed?"""
+
+        directory = tempfile.mkdtemp()
+        block_size = archive.ARCHIVE_BLOCK_SIZE
+        read_block = archive._read_block
+        blocks = []
+
+        def counting(path, offset):
+            blocks.append(offset)
+            return read_block(path, offset)
+
+        archive.ARCHIVE_BLOCK_SIZE = 1
+        archive._read_block = counting
+        try:
+            archive.archive_messages(datetime(2017, 7, 1), directory)
+            likes = ''.join(export.export(self.u1_id, 'likes', 'ndjson'))
+            self.assertEqual(len(blocks), 1)
+            del blocks[:]
+            list(export.export(self.u1_id, 'messages', 'ndjson'))
+            self.assertEqual(len(blocks), 5)
+        finally:
+            archive.ARCHIVE_BLOCK_SIZE = block_size
+            archive._read_block = read_block
+            shutil.rmtree(directory)
+
+        self.assertEqual([json.loads(line) for line in likes.splitlines()],
+                         [dict(type='likes', message_id=self.other_id,
+                               text="other", author_id=self.u2_id)])
+
+    def test_progress_reports(self):
+        reports = []
+        progress = export.ExportProgress(report=reports.append, every=2)
+        list(export.export(self.u1_id, 'messages', 'ndjson', progress,
+                           chunk_size=1))
+        self.assertEqual(len(reports), 2)
+        self.assertIn("5 rows", str(progress))
+
+    def test_view(self):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get(f'/users/{self.u1_id}/export/following.csv')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'text/csv')
+            self.assertIn('attachment', resp.headers['Content-Disposition'])
+            self.assertEqual(resp.get_data(as_text=True).split(),
+                             ['user_id', str(self.u2_id)])
+
+            resp = client.get(f'/users/{self.u1_id}/export/messages.xml')
+            self.assertEqual(resp.status_code, 404)
+
+            # only your own data
+            resp = client.get(f'/users/{self.u2_id}/export/messages.csv')
+            self.assertEqual(resp.status_code, 302)
+
+    def test_cli(self):
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['export-user', str(self.u1_id),
+                                     '--dataset', 'followers',
+                                     '--format', 'csv'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('user_id', result.output)
+        self.assertIn('exported 0 rows', result.output)
@@ -0,0 +1,114 @@
+"""Follows graph snapshot tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_graph_snapshot.py
+
+
+from app import app
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Follows, GraphChange
+from graph_snapshot import GraphSnapshot, write_snapshot, export_snapshot
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+db.create_all(app=app)
+
+
+class GraphSnapshotTests(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'follows.graph')
+
+        # 1 -> 2, 1 -> 3, 2 -> 3, 4 -> 3, 4 -> 2
+        write_snapshot(self.path, [1, 1, 2, 4, 4], [3, 2, 3, 3, 2])
+        self.graph = GraphSnapshot(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_queries(self):
+        """Do membership, neighbor and intersection queries work?"""
+
+        self.assertEqual(list(self.graph.following(1)), [2, 3])
+        self.assertEqual(list(self.graph.followers(3)), [1, 2, 4])
+        self.assertTrue(self.graph.is_following(4, 2))
+        self.assertFalse(self.graph.is_following(2, 4))
+        self.assertFalse(self.graph.is_following(99, 1))
+        self.assertEqual(list(self.graph.mutual_followers(2, 3)), [1, 4])
+        self.assertEqual(list(self.graph.followed_by_following(1, 3)), [2])
+        self.assertEqual(self.graph.follower_count(3), 3)
+        self.assertEqual(self.graph.degree_stats()['max'], 3)
+
+    def test_refresh(self):
+        """Does an open reader pick up a replaced snapshot?"""
+
+        self.assertFalse(self.graph.refresh())
+        write_snapshot(self.path, [2], [1])
+        self.assertTrue(self.graph.refresh())
+        self.assertEqual(list(self.graph.followers(1)), [2])
+        self.assertEqual(self.graph.num_edges, 1)
+
+
+class ExportSnapshotTests(TestCase):
+
+    def setUp(self):
+        GraphChange.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.users = [User(email=f"test{i}@test.com", username=f"testuser{i}",
+                           password="HASHED_PASSWORD") for i in range(3)]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'follows.graph')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_incremental_export(self):
+        """Are logged follow changes applied to an existing snapshot?"""
+
+        u0, u1, u2 = [u.id for u in self.users]
+        db.session.add(Follows(user_following_id=u0,
+                               user_being_followed_id=u1))
+        db.session.commit()
+        self.assertEqual(export_snapshot(self.path), 1)
+
+        db.session.add_all([
+            GraphChange(follower_id=u0, followed_id=u2, added=True),
+            GraphChange(follower_id=u0, followed_id=u1, added=False),
+            GraphChange(follower_id=u1, followed_id=u2, added=True),
+        ])
+        db.session.commit()
+        self.assertEqual(export_snapshot(self.path), 2)
+
+        graph = GraphSnapshot(self.path)
+        self.assertEqual(list(graph.following(u0)), [u2])
+        self.assertEqual(list(graph.followers(u2)), [u0, u1])
+        self.assertEqual(GraphChange.query.count(), 0)
+
+    def test_late_commit_with_lower_id(self):
+        """Is a change committed after a higher id was exported applied?"""
+
+        u0, u1, u2 = [u.id for u in self.users]
+        export_snapshot(self.path)
+        db.session.add(GraphChange(id=10, follower_id=u0, followed_id=u1,
+                                   added=True))
+        db.session.commit()
+        self.assertEqual(export_snapshot(self.path), 1)
+
+        # its transaction took id 5 but committed only now
+        db.session.add(GraphChange(id=5, follower_id=u1, followed_id=u2,
+                                   added=True))
+        db.session.commit()
+        self.assertEqual(export_snapshot(self.path), 2)
+        self.assertTrue(GraphSnapshot(self.path).is_following(u1, u2))
+        self.assertEqual(GraphChange.query.count(), 0)
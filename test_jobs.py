@@ -0,0 +1,292 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+from app import app, CURR_USER_KEY
+import os
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Likes, Follows, UserDeletion, Job
+import jobs
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+calls = []
+
+
+@jobs.task('test-record')
+def record(value):
+    calls.append(value)
+
+
+@jobs.task('test-fail')
+def fail():
+    raise ValueError("not today")
+
+
+@jobs.task('test-heartbeat')
+def beat():
+    # nearly out of time, then renewed
+    Job.query.update(dict(locked_until=datetime.utcnow()))
+    db.session.commit()
+    jobs.heartbeat()
+    calls.append(Job.query.one().locked_until
+                 > datetime.utcnow() + timedelta(seconds=30))
+
+    # as another worker would, once the lease had run out
+    Job.query.update(dict(attempts=Job.attempts + 1))
+    db.session.commit()
+    jobs.heartbeat()
+    calls.append("still going")
+
+
+class JobTests(TestCase):
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        Job.query.delete()
+        db.session.commit()
+        del calls[:]
+
+        self.config = dict(app.config)
+        app.config['JOBS_WORKERS'] = 2
+        # a worker without threads, so queued jobs wait for run_pending()
+        self.worker = jobs._worker
+        jobs._worker = jobs.Worker(app, 0)
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config.update(self.config)
+        jobs._worker = self.worker
+        self.ctx.pop()
+
+    def make_due(self):
+        Job.query.update(dict(run_at=datetime.utcnow()))
+        db.session.commit()
+
+    def test_queued_with_the_callers_transaction(self):
+        """Is a job queued only once the caller commits, then run?"""
+
+        jobs.enqueue('test-record', dict(value=1))
+        db.session.rollback()
+        self.assertEqual(Job.query.count(), 0)
+
+        job = jobs.enqueue('test-record', dict(value=2))
+        db.session.commit()
+        self.assertEqual(job.status, jobs.QUEUED)
+        self.assertEqual(calls, [])
+
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(calls, [2])
+        job = Job.query.get(job.id)
+        self.assertEqual((job.status, job.attempts), (jobs.DONE, 1))
+        self.assertIsNotNone(job.finished_at)
+
+        with self.assertRaises(LookupError):
+            jobs.enqueue('no-such-task')
+
+    def test_idempotency_key(self):
+        """Is a job queued twice under one key only queued (and run) once?"""
+
+        first = jobs.enqueue('test-record', dict(value=1), key='once')
+        db.session.commit()
+        second = jobs.enqueue('test-record', dict(value=1), key='once')
+        db.session.commit()
+
+        self.assertEqual(first.id, second.id)
+        jobs.run_pending()
+        self.assertEqual(calls, [1])
+        self.assertEqual(Job.query.count(), 1)
+
+    def test_key_reused_once_finished(self):
+        """Is a key whose job is done or failed queued again?"""
+
+        app.config['JOBS_MAX_ATTEMPTS'] = 1
+        job_id = jobs.enqueue('test-fail', key='again').id
+        db.session.commit()
+        jobs.run_pending()
+        self.assertEqual(Job.query.get(job_id).status, jobs.FAILED)
+
+        job = jobs.enqueue('test-record', dict(value=1), key='again')
+        db.session.commit()
+        self.assertEqual((job.id, job.status, job.attempts, job.last_error),
+                         (job_id, jobs.QUEUED, 0, None))
+        jobs.run_pending()
+        self.assertEqual(Job.query.get(job_id).status, jobs.DONE)
+
+        jobs.enqueue('test-record', dict(value=2), key='again')
+        db.session.commit()
+        jobs.run_pending()
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(Job.query.count(), 1)
+
+    def test_retries_with_backoff(self):
+        """Are failing jobs retried later and later, then given up on?"""
+
+        app.config['JOBS_MAX_ATTEMPTS'] = 3
+        app.config['JOBS_BACKOFF_SECONDS'] = 10
+        job_id = jobs.enqueue('test-fail').id
+        db.session.commit()
+
+        for attempt, wait in ((1, 10), (2, 20)):
+            before = datetime.utcnow()
+            self.assertEqual(jobs.run_pending(), 1)
+            job = Job.query.get(job_id)
+            self.assertEqual((job.status, job.attempts),
+                             (jobs.QUEUED, attempt))
+            self.assertGreaterEqual(job.run_at,
+                                    before + timedelta(seconds=wait))
+            self.assertIn("ValueError: not today", job.last_error)
+
+            # not due yet
+            self.assertEqual(jobs.run_pending(), 0)
+            self.make_due()
+
+        jobs.run_pending()
+        job = Job.query.get(job_id)
+        self.assertEqual((job.status, job.attempts), (jobs.FAILED, 3))
+
+        app.config['JOBS_MAX_BACKOFF_SECONDS'] = 15
+        self.assertEqual(jobs.backoff(5), 15)
+
+    def test_lost_jobs_requeued_and_old_ones_purged(self):
+        """Are jobs of dead workers rerun, and finished ones deleted?"""
+
+        job_id = jobs.enqueue('test-record', dict(value=1)).id
+        db.session.commit()
+        stale = jobs.claim()
+        # as another worker's session would, keep its copy as claimed
+        db.session.expunge(stale)
+        Job.query.update(dict(locked_until=datetime.utcnow()
+                              - timedelta(seconds=1)))
+        db.session.commit()
+
+        self.assertEqual(jobs.maintain(), (1, 0))
+        jobs.run_pending()
+        self.assertEqual(calls, [1])
+
+        # the first worker finishing late doesn't undo the rerun
+        self.assertEqual(stale.attempts, 1)
+        jobs.run(stale)
+        job = Job.query.get(job_id)
+        self.assertEqual((job.status, job.attempts), (jobs.DONE, 2))
+
+        Job.query.update(dict(finished_at=datetime.utcnow()
+                              - timedelta(days=2)))
+        db.session.commit()
+        self.assertEqual(jobs.maintain(), (0, 1))
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_heartbeat(self):
+        """Do long jobs renew their lease, and stop once it's taken over?"""
+
+        app.config['JOBS_LEASE_SECONDS'] = 60
+        job_id = jobs.enqueue('test-heartbeat').id
+        db.session.commit()
+        jobs.run_pending()
+
+        self.assertEqual(calls, [True])
+        job = Job.query.get(job_id)
+        # left to the worker that has it now
+        self.assertEqual((job.status, job.attempts), (jobs.RUNNING, 2))
+
+        # outside a job there's nothing to renew
+        jobs.heartbeat()
+
+    def test_worker_threads(self):
+        """Do worker threads run committed jobs in the background?"""
+
+        app.config['JOBS_POLL_SECONDS'] = 0.05
+        jobs._worker = jobs.Worker(app, 2).start()
+        try:
+            for value in range(5):
+                jobs.enqueue('test-record', dict(value=value))
+            db.session.commit()
+
+            deadline = time.monotonic() + 10
+            while (Job.query.filter_by(status=jobs.DONE).count() < 5
+                   and time.monotonic() < deadline):
+                db.session.commit()
+                time.sleep(0.05)
+        finally:
+            jobs._worker.stop(10)
+
+        self.assertEqual(sorted(calls), list(range(5)))
+
+    def test_inline(self):
+        """With no worker threads, do jobs run as they're queued?"""
+
+        app.config['JOBS_WORKERS'] = 0
+        self.assertIsNone(jobs.enqueue('test-record', dict(value='now')))
+        self.assertEqual(calls, ['now'])
+        self.assertEqual(Job.query.count(), 0)
+        with self.assertRaises(ValueError):
+            jobs.enqueue('test-fail')
+
+    def test_metrics(self):
+        """Are waiting jobs and job timings served at /metrics?"""
+
+        jobs.enqueue('test-record', dict(value=1))
+        jobs.enqueue('test-fail')
+        db.session.commit()
+        jobs.run_pending()
+        jobs.enqueue('test-record', dict(value=2))
+        db.session.commit()
+
+        text = app.test_client().get('/metrics').get_data(as_text=True)
+        self.assertIn('warbler_jobs{task="test-record",status="queued"} 1',
+                      text)
+        self.assertIn('warbler_jobs{task="test-fail",status="queued"} 1',
+                      text)
+        self.assertIn('warbler_job_run_seconds_count'
+                      '{task="test-fail",outcome="retry"}', text)
+        self.assertIn('warbler_job_wait_seconds_count{task="test-record"}',
+                      text)
+
+    def test_delete_user_deferred(self):
+        """Does deleting an account return before the account is gone?"""
+
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        user = User.signup("leaving", "leaving@test.com", "password", None)
+        db.session.commit()
+        user_id = user.id
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            resp = client.post('/users/delete')
+        self.assertEqual(resp.status_code, 302)
+        self.assertIsNotNone(User.query.get(user_id))
+        self.assertEqual(Job.query.one().key, f'delete-user:{user_id}')
+
+        # gone as far as anyone can tell, though its rows are still there
+        self.assertFalse(User.authenticate("leaving", "password"))
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            resp = client.get('/users/profile')
+        self.assertEqual(resp.status_code, 302)
+        db.session.add(User(email="leaving@test.com", username="leaving",
+                            password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        jobs.run_pending()
+        db.session.expire_all()
+        self.assertIsNone(User.query.get(user_id))
+        self.assertIsNotNone(User.query.filter_by(username="leaving").first())
+
+        UserDeletion.query.filter_by(user_id=user_id).delete()
+        db.session.commit()
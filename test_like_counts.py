@@ -0,0 +1,137 @@
+"""Like count tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_like_counts.py
+
+
+from app import app, CURR_USER_KEY
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Likes, Follows, LikeCountShard
+import like_counts
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class LikeCountTests(TestCase):
+
+    def setUp(self):
+        LikeCountShard.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.author = User(email="test@test.com", username="author",
+                           password="HASHED_PASSWORD")
+        self.fans = [User(email=f"fan{i}@test.com", username=f"fan{i}",
+                          password="HASHED_PASSWORD") for i in range(3)]
+        db.session.add_all([self.author] + self.fans)
+        db.session.commit()
+
+        self.msg = Message(text="likeable", user_id=self.author.id)
+        db.session.add(self.msg)
+        db.session.commit()
+
+        self.msg_id = self.msg.id
+        self.fan_ids = [fan.id for fan in self.fans]
+
+    def tearDown(self):
+        app.config['LIKE_COUNT_SHARDS'] = 0
+
+    def count(self):
+        return (db.session.query(Message.like_count)
+                .filter_by(id=self.msg_id).scalar())
+
+    def like(self, user_id, path='add_like'):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            client.post(f'/users/{path}/{self.msg_id}')
+
+    def test_like_and_unlike(self):
+        """Do the views keep like_count in step with likes?"""
+
+        for fan_id in self.fan_ids:
+            self.like(fan_id)
+        self.assertEqual(self.count(), 3)
+
+        self.like(self.fan_ids[0], 'remove_like')
+        self.assertEqual(self.count(), 2)
+
+        # unliking something you never liked changes nothing
+        self.like(self.fan_ids[0], 'remove_like')
+        self.assertEqual(self.count(), 2)
+
+    def test_uncounted_like_removed(self):
+        """Does unliking a like that was never counted leave the count at 0?"""
+
+        db.session.add(Likes(user_id=self.fan_ids[0], message_id=self.msg_id))
+        db.session.commit()
+        self.like(self.fan_ids[0], 'remove_like')
+        self.assertEqual(self.count(), 0)
+
+        app.config['LIKE_COUNT_SHARDS'] = 2
+        db.session.add(Likes(user_id=self.fan_ids[1], message_id=self.msg_id))
+        db.session.commit()
+        self.like(self.fan_ids[1], 'remove_like')
+        like_counts.fold_shards()
+        self.assertEqual(self.count(), 0)
+
+    def test_shown(self):
+        self.like(self.fan_ids[0])
+        resp = app.test_client().get(f'/messages/{self.msg_id}')
+        self.assertIn('1 like<', resp.get_data(as_text=True))
+
+    def test_sharded(self):
+        """Are sharded changes folded in, and only once?"""
+
+        app.config['LIKE_COUNT_SHARDS'] = 4
+        for fan_id in self.fan_ids:
+            self.like(fan_id)
+        self.like(self.fan_ids[0], 'remove_like')
+
+        self.assertEqual(self.count(), 0)
+        self.assertEqual(db.session.query(db.func.sum(LikeCountShard.delta))
+                         .scalar(), 2)
+
+        with app.app_context():
+            self.assertEqual(like_counts.fold_shards(), 1)
+        self.assertEqual(self.count(), 2)
+        self.assertEqual(LikeCountShard.query.count(), 0)
+
+        with app.app_context():
+            self.assertEqual(like_counts.fold_shards(), 0)
+        self.assertEqual(self.count(), 2)
+
+    def test_reconcile(self):
+        """Is drift repaired, allowing for unfolded shard deltas?"""
+
+        for fan_id in self.fan_ids:
+            db.session.add(Likes(user_id=fan_id, message_id=self.msg_id))
+        db.session.add(LikeCountShard(message_id=self.msg_id, shard=0,
+                                      delta=1))
+        db.session.commit()
+
+        self.assertEqual(like_counts.reconcile(), 1)
+        self.assertEqual(self.count(), 2)
+        self.assertEqual(like_counts.reconcile(), 0)
+
+        with app.app_context():
+            like_counts.fold_shards()
+        self.assertEqual(self.count(), 3)
+
+    def test_deleted_liker(self):
+        """Does deleting an account take its likes off the counts?"""
+
+        for fan_id in self.fan_ids:
+            self.like(fan_id)
+
+        User.bulk_delete(self.fan_ids[0])
+        self.assertEqual(self.count(), 2)
@@ -0,0 +1,148 @@
+"""Likes migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_likes_migration.py
+
+
+from app import create_app
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
+
+import models
+from models import db, User, Message, Likes
+import likes_migration
+
+OLD_LIKES = """CREATE TABLE likes (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+    message_id INTEGER REFERENCES messages (id) ON DELETE CASCADE
+)"""
+
+
+class LikesMigrationTests(TestCase):
+
+    def setUp(self):
+        self.db_app = models.db.app
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI':
+                f'sqlite:///{self.directory}/warbler.db',
+        })
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        db.engine.execute('DROP TABLE likes')
+        db.engine.execute(OLD_LIKES)
+
+        users = [User(email=f"u{i}@test.com", username=f"user{i}",
+                      password="HASHED_PASSWORD") for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        self.u0, self.u1, self.u2 = [user.id for user in users]
+        msgs = [Message(text=f"warble {i}", user_id=self.u0)
+                for i in range(4)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        self.m0, self.m1, self.m2, self.m3 = [msg.id for msg in msgs]
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+        models.db.app = self.db_app
+        shutil.rmtree(self.directory)
+
+    def like(self, user_id, message_id):
+        db.engine.execute(likes_migration.legacy.insert().values(
+            user_id=user_id, message_id=message_id))
+
+    def unlike_once(self, user_id, message_id):
+        """Delete one old row for the pair, as the old remove_like did."""
+
+        legacy = likes_migration.legacy
+        row_id = db.engine.execute(
+            legacy.select().where((legacy.c.user_id == user_id)
+                                  & (legacy.c.message_id == message_id))
+        ).first().id
+        db.engine.execute(legacy.delete().where(legacy.c.id == row_id))
+
+    def pairs(self):
+        return sorted(db.session.query(Likes.user_id, Likes.message_id))
+
+    def test_dedups_and_swaps(self):
+        """Are duplicates and half-empty rows dropped and the schema new?"""
+
+        for _ in range(3):
+            self.like(self.u1, self.m0)
+        self.like(self.u1, self.m1)
+        self.like(self.u2, self.m0)
+        self.like(self.u2, self.m0)
+        self.like(None, self.m2)
+        self.like(self.u2, None)
+        # counted as the old code did, duplicates and all
+        Message.query.filter_by(id=self.m0).update(dict(like_count=5))
+        Message.query.filter_by(id=self.m1).update(dict(like_count=1))
+        db.session.commit()
+
+        self.assertTrue(likes_migration.needs_migration())
+        result = likes_migration.migrate(batch_size=2)
+
+        self.assertEqual(result['before']['rows'], 8)
+        self.assertEqual(result['after']['rows'], 3)
+        self.assertIsNotNone(result['after']['lookup_ms'])
+        self.assertEqual(result['repaired'], 1)
+        self.assertEqual(Message.query.get(self.m0).like_count, 2)
+        self.assertEqual(self.pairs(), sorted([(self.u1, self.m0),
+                                               (self.u1, self.m1),
+                                               (self.u2, self.m0)]))
+
+        self.assertFalse(likes_migration.needs_migration())
+        inspector = inspect(db.engine)
+        self.assertEqual(
+            [col['name'] for col in inspector.get_columns('likes')],
+            ['user_id', 'message_id', 'created_at'])
+        self.assertEqual(
+            inspector.get_pk_constraint('likes')['constrained_columns'],
+            ['user_id', 'message_id'])
+        self.assertEqual(
+            [ix['name'] for ix in inspector.get_indexes('likes')],
+            ['ix_likes_message_id'])
+        self.assertNotIn('likes_compact', inspector.get_table_names())
+
+        db.session.add(Likes(user_id=self.u1, message_id=self.m0))
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+
+        self.assertIsNone(likes_migration.migrate())
+
+    def test_mirrors_writes_during_copy(self):
+        """Are likes and unlikes made mid-copy carried over?"""
+
+        self.like(self.u1, self.m0)
+        self.like(self.u1, self.m0)
+        self.like(self.u1, self.m1)
+        self.like(self.u2, self.m1)
+
+        def meanwhile(read, last_id):
+            if read != 2:
+                return
+            # one of two copies, already copied: still liked
+            self.unlike_once(self.u1, self.m0)
+            # likes not copied yet, and a brand new one
+            self.unlike_once(self.u1, self.m1)
+            self.unlike_once(self.u2, self.m1)
+            self.like(self.u2, self.m3)
+
+        likes_migration.prepare()
+        likes_migration.copy(datetime.utcnow(), batch_size=2,
+                             report=meanwhile)
+        likes_migration.swap()
+
+        self.assertEqual(self.pairs(), sorted([(self.u1, self.m0),
+                                               (self.u2, self.m3)]))
@@ -0,0 +1,116 @@
+"""Live timeline (Server-Sent Events) tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_live.py
+
+
+from app import app, CURR_USER_KEY
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+import live
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# run background jobs as they're queued
+app.config['JOBS_WORKERS'] = 0
+
+db.create_all()
+
+
+class LocalBrokerTests(TestCase):
+
+    def test_publish_subscribe(self):
+        """Do subscribers get events only for their channels?"""
+
+        broker = live.LocalBroker()
+        sub = broker.subscribe(['user:1', 'user:2'])
+        other = broker.subscribe(['user:3'])
+
+        broker.publish('user:2', {'html': '<li>hi</li>'})
+        self.assertEqual(sub.get(0.1), ('user:2', {'html': '<li>hi</li>'}))
+        self.assertIsNone(other.get(0.01))
+
+        sub.close()
+        self.assertEqual(broker.subscriber_count(), 1)
+
+    def test_slow_subscriber(self):
+        """Are events dropped, not queued forever, for slow clients?"""
+
+        broker = live.LocalBroker()
+        sub = broker.subscribe(['user:1'])
+        for i in range(live.SUBSCRIBER_QUEUE_SIZE + 10):
+            broker.publish('user:1', {'html': str(i)})
+        self.assertEqual(sub.queue.qsize(), live.SUBSCRIBER_QUEUE_SIZE)
+
+    def test_format_event(self):
+        self.assertEqual(live.format_event('warble', 'a\nb'),
+                         "event: warble\ndata: a\ndata: b\n\n")
+
+
+class TimelineStreamTests(TestCase):
+
+    def setUp(self):
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.author = User(email="test@test.com", username="author",
+                           password="HASHED_PASSWORD")
+        self.reader = User(email="test2@test.com", username="reader",
+                           password="HASHED_PASSWORD")
+        db.session.add_all([self.author, self.reader])
+        db.session.commit()
+        self.reader.following.append(self.author)
+        db.session.commit()
+
+        self.author_id = self.author.id
+        self.reader_id = self.reader.id
+        live.broker = live.LocalBroker()
+        app.config['LIVE_UPDATES'] = True
+
+    def tearDown(self):
+        app.config['LIVE_UPDATES'] = False
+
+    def test_stream(self):
+        """Does a new warble reach a follower's open stream?"""
+
+        reader = app.test_client()
+        with reader.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+        resp = reader.get('/timeline/stream', buffered=False)
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+
+        stream = iter(resp.response)
+        self.assertEqual(next(stream), b"retry: 5000\n\n")
+
+        author = app.test_client()
+        with author.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author_id
+        author.post('/messages/new', data={'text': 'live warble'})
+
+        event = next(stream).decode()
+        self.assertTrue(event.startswith('event: warble\n'))
+        self.assertIn('live warble', event)
+        self.assertIn('@author', event)
+        resp.close()
+
+        self.assertEqual(live.broker.subscriber_count(), 0)
+
+    def test_stream_requires_login(self):
+        resp = app.test_client().get('/timeline/stream')
+        self.assertEqual(resp.status_code, 401)
+
+    def test_off_by_default(self):
+        """Without LIVE_UPDATES, is there no stream for pages to hold open?"""
+
+        app.config['LIVE_UPDATES'] = False
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+        self.assertEqual(client.get('/timeline/stream').status_code, 404)
+        self.assertNotIn(b'EventSource', client.get('/').data)
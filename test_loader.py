@@ -0,0 +1,135 @@
+"""Request-scoped batch loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loader.py
+
+
+from app import app, CURR_USER_KEY
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import db, User, Message, Likes, Follows
+from loader import Loader, RequestLoaders
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class LoaderTests(TestCase):
+
+    def test_batches_and_memoizes(self):
+        calls = []
+
+        def batch(keys):
+            calls.append(set(keys))
+            return {key: key * 10 for key in keys if key != 3}
+
+        loader = Loader(batch)
+        loader.prime([1, 2])
+        self.assertEqual(loader.load(3), None)
+        self.assertEqual(loader.load_many([1, 2, 3]), [10, 20, None])
+        self.assertEqual(loader.load(4), 40)
+
+        self.assertEqual(calls, [{1, 2, 3}, {4}])
+        self.assertEqual(loader.round_trips, 2)
+
+
+class RoundTripTests(TestCase):
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.viewer = User(email="viewer@test.com", username="viewer",
+                           password="HASHED_PASSWORD")
+        db.session.add(self.viewer)
+        db.session.commit()
+        self.viewer_id = self.viewer.id
+
+    def add_followers(self, count):
+        users = [User(email=f"f{i}@test.com", username=f"f{i}",
+                      password="HASHED_PASSWORD")
+                 for i in range(User.query.count(), User.query.count() + count)]
+        db.session.add_all(users)
+        db.session.commit()
+        for user in users:
+            db.session.add(Follows(user_following_id=user.id,
+                                   user_being_followed_id=self.viewer_id))
+            # the viewer follows back every other one
+            if user.id % 2:
+                db.session.add(Follows(user_following_id=self.viewer_id,
+                                       user_being_followed_id=user.id))
+        db.session.commit()
+        return users
+
+    def queries_for(self, path):
+        count = 0
+
+        def counter(*args):
+            nonlocal count
+            count += 1
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+            event.listen(Engine, 'before_cursor_execute', counter)
+            try:
+                resp = client.get(path)
+            finally:
+                event.remove(Engine, 'before_cursor_execute', counter)
+        self.assertEqual(resp.status_code, 200)
+        return count, resp.get_data(as_text=True)
+
+    def test_followers_page_is_flat(self):
+        """Does the followers page cost the same for 2 or 12 followers?"""
+
+        self.add_followers(2)
+        few, _ = self.queries_for(f'/users/{self.viewer_id}/followers')
+
+        users = self.add_followers(10)
+        followed_back = sum(1 for (user_id,) in db.session.query(User.id)
+                            if user_id % 2 and user_id != self.viewer_id)
+        names = [user.username for user in users]
+        many, html = self.queries_for(f'/users/{self.viewer_id}/followers')
+
+        self.assertEqual(few, many)
+        for name in names:
+            self.assertIn(f'@{name}', html)
+        self.assertEqual(html.count('>Unfollow<'), followed_back)
+
+    def test_follow_state(self):
+        [user] = self.add_followers(1)
+        with app.test_request_context():
+            loaders = RequestLoaders()
+            loaders.follows.prime([(self.viewer_id, user.id),
+                                   (user.id, self.viewer_id)])
+            self.assertEqual(loaders.is_following(user.id, self.viewer_id),
+                             True)
+            self.assertEqual(loaders.is_following(self.viewer_id, user.id),
+                             bool(user.id % 2))
+            self.assertEqual(loaders.round_trips, 1)
+
+    def test_liked_by(self):
+        [author] = self.add_followers(1)
+        msgs = [Message(text=f"m{i}", user_id=author.id) for i in range(3)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        for msg in msgs[:2]:
+            db.session.add(Likes(user_id=self.viewer_id, message_id=msg.id))
+        db.session.commit()
+
+        with app.test_request_context():
+            loaders = RequestLoaders()
+            self.assertEqual([m.text for m in loaders.liked_by(self.viewer_id)],
+                             ['m0', 'm1'])
+            self.assertTrue(loaders.has_liked(self.viewer_id, msgs[0].id))
+            self.assertEqual(loaders.round_trips, 3)
@@ -32,6 +32,9 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# run background jobs as they're queued
+app.config['JOBS_WORKERS'] = 0
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -0,0 +1,133 @@
+"""Metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+from app import app
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db
+import metrics
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+db.create_all()
+
+
+class ExpositionTests(TestCase):
+
+    def setUp(self):
+        self.registry = list(metrics.REGISTRY)
+        del metrics.REGISTRY[:]
+        self.hist = metrics.Histogram('t_seconds', "Test.", ('route',),
+                                      buckets=(0.1, 1.0))
+        self.gauge = metrics.Gauge('t_active', "Active.")
+
+    def tearDown(self):
+        metrics.REGISTRY[:] = self.registry
+
+    def test_histogram(self):
+        for value in (0.05, 0.1, 0.5, 3):
+            self.hist.observe(value, '/a')
+
+        text = metrics.exposition(metrics.collect())
+        self.assertIn('# TYPE t_seconds histogram', text)
+        self.assertIn('t_seconds_bucket{route="/a",le="0.1"} 2', text)
+        self.assertIn('t_seconds_bucket{route="/a",le="1.0"} 3', text)
+        self.assertIn('t_seconds_bucket{route="/a",le="+Inf"} 4', text)
+        self.assertIn('t_seconds_count{route="/a"} 4', text)
+        self.assertIn('t_seconds_sum{route="/a"} 3.65', text)
+
+    def test_label_escaping(self):
+        self.hist.observe(1, 'say "hi"\n')
+        text = metrics.exposition(metrics.collect())
+        self.assertIn(r'route="say \"hi\"\n"', text)
+
+    def test_collect_across_workers(self):
+        """Are workers summed, ignoring gauges of exited ones?"""
+
+        directory = tempfile.mkdtemp()
+        try:
+            self.hist.observe(0.5, '/a')
+            self.gauge.inc(2)
+            metrics.write_snapshot(directory)
+
+            # a worker that has since exited
+            dead_pid = 2 ** 22 + 1
+            with open(os.path.join(directory,
+                                   f'metrics-{dead_pid}.json'), 'w') as f:
+                json.dump({'t_seconds': [[['/a'], [1, 0, 0, 0.05]]],
+                           't_active': [[[], 5]]}, f)
+
+            totals = metrics.collect(directory)
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(totals['t_seconds'][('/a',)], [1, 1, 0, 0.55])
+        self.assertEqual(totals['t_active'][()], 2)
+
+    def test_remove_snapshot(self):
+        """Is a file left under this pid by a dead worker removed?"""
+
+        directory = tempfile.mkdtemp()
+        try:
+            self.hist.observe(0.5, '/a')
+            metrics.write_snapshot(directory)
+            metrics.remove_snapshot(directory)
+            self.assertEqual(os.listdir(directory), [])
+            metrics.remove_snapshot(directory)
+        finally:
+            shutil.rmtree(directory)
+
+
+class MetricsViewTests(TestCase):
+
+    def test_request_metrics(self):
+        client = app.test_client()
+        client.get('/login')
+        client.get('/users')
+
+        text = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('warbler_request_duration_seconds_count'
+                      '{endpoint="warbler.login",status="200"}', text)
+        self.assertIn('warbler_db_queries_total{endpoint="warbler.list_users"}',
+                      text)
+        self.assertIn('warbler_template_render_seconds_count'
+                      '{template="users/login.html"}', text)
+        self.assertIn('warbler_requests_in_progress 1', text)
+
+    def test_not_found(self):
+        client = app.test_client()
+        client.get('/no-such-page')
+        text = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('{endpoint="none",status="404"}', text)
+
+    def test_access(self):
+        """Is /metrics only served to allowed addresses or the token?"""
+
+        config = dict(app.config)
+        self.addCleanup(app.config.update, config)
+        app.config['METRICS_TOKEN'] = 's3cret'
+        client = app.test_client()
+        outside = {'REMOTE_ADDR': '203.0.113.5'}
+
+        self.assertEqual(client.get('/metrics').status_code, 200)
+        self.assertEqual(
+            client.get('/metrics', environ_base=outside).status_code, 404)
+        resp = client.get('/metrics', environ_base=outside,
+                          headers={'Authorization': 'Bearer wrong'})
+        self.assertEqual(resp.status_code, 404)
+        resp = client.get('/metrics', environ_base=outside,
+                          headers={'Authorization': 'Bearer s3cret'})
+        self.assertEqual(resp.status_code, 200)
+
+        app.config['METRICS_ALLOWED_IPS'] = ['203.0.113.0/24']
+        self.assertEqual(
+            client.get('/metrics', environ_base=outside).status_code, 200)
+        self.assertEqual(client.get('/metrics').status_code, 404)
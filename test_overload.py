@@ -0,0 +1,177 @@
+"""Load shedding tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_overload.py
+
+
+from app import app, CURR_USER_KEY
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Likes, Follows
+import overload
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class OverloadTests(TestCase):
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        reader = User(email="reader@test.com", username="reader",
+                      password="HASHED_PASSWORD")
+        writer = User(email="writer@test.com", username="writer",
+                      password="HASHED_PASSWORD")
+        db.session.add_all([reader, writer])
+        db.session.commit()
+        db.session.add(Follows(user_following_id=reader.id,
+                               user_being_followed_id=writer.id))
+        db.session.add(Message(text="first warble", user_id=writer.id))
+        db.session.commit()
+        self.reader_id, self.writer_id = reader.id, writer.id
+
+        overload.pages.invalidate()
+        overload.tracker.reset()
+        self.config = dict(app.config)
+        app.config['OVERLOAD_MAX_IN_FLIGHT'] = 10
+        app.config['OVERLOAD_MAX_DB_SECONDS'] = 0.5
+        app.config['STALE_REFRESH_SECONDS'] = 0
+
+    def tearDown(self):
+        app.config.update(self.config)
+        overload.tracker.reset()
+
+    def get(self, url):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader_id
+            return client.get(url)
+
+    def slow_database(self):
+        overload.tracker.db_seconds = 5.0
+
+    def wait_for_refreshes(self):
+        for thread in list(overload._refreshing.values()):
+            thread.join(10)
+
+    def test_tracker(self):
+        """Do the thresholds trip on requests in flight and query time?"""
+
+        tracker = overload.LoadTracker()
+        self.assertFalse(tracker.overloaded(2, 0.5))
+
+        for _ in range(3):
+            tracker.started()
+        self.assertTrue(tracker.overloaded(2, 0.5))
+        self.assertFalse(tracker.overloaded(0, 0.5))
+        for _ in range(3):
+            tracker.finished()
+
+        for _ in range(50):
+            tracker.record_query(2.0)
+        self.assertTrue(tracker.overloaded(2, 0.5))
+        self.assertFalse(tracker.overloaded(2, 0))
+        for _ in range(100):
+            tracker.record_query(0.001)
+        self.assertFalse(tracker.overloaded(2, 0.5))
+
+    def test_only_request_queries_tracked(self):
+        """Are queries outside requests (jobs, commands) left out?"""
+
+        with app.app_context():
+            db.session.query(User.id).all()
+        self.assertEqual(overload.tracker.db_seconds, 0.0)
+
+        with app.test_request_context('/'):
+            db.session.query(User.id).all()
+        self.assertGreater(overload.tracker.db_seconds, 0.0)
+
+    def test_serves_stale_timeline_and_revalidates(self):
+        """Is the last good homepage served, then refreshed, when slow?"""
+
+        resp = self.get('/')
+        self.assertIn(b"first warble", resp.data)
+        self.assertNotIn('Warning', resp.headers)
+
+        db.session.add(Message(text="second warble", user_id=self.writer_id))
+        db.session.commit()
+
+        self.slow_database()
+        resp = self.get('/')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Warning'], overload.STALE_WARNING)
+        self.assertNotIn(b"second warble", resp.data)
+
+        self.wait_for_refreshes()
+        self.slow_database()
+        resp = self.get('/')
+        self.assertEqual(resp.headers['Warning'], overload.STALE_WARNING)
+        self.assertIn(b"second warble", resp.data)
+
+        overload.tracker.reset()
+        resp = self.get('/')
+        self.assertNotIn('Warning', resp.headers)
+
+    def test_refreshes_limited(self):
+        """Are few, and only old, stored copies refreshed while overloaded?"""
+
+        self.get('/')
+        self.get(f'/users/{self.writer_id}')
+        started = []
+        start_refresh = overload._start_refresh
+        overload._start_refresh = started.append
+        try:
+            self.slow_database()
+            app.config['STALE_REFRESH_SECONDS'] = 60
+            self.get('/')
+            self.assertEqual(started, [])
+            app.config['STALE_REFRESH_SECONDS'] = 0
+            self.get('/')
+            self.assertEqual(len(started), 1)
+        finally:
+            overload._start_refresh = start_refresh
+
+        # one refresh at a time per worker
+        with overload._refreshing_lock:
+            overload._refreshing['busy'] = None
+        try:
+            with app.test_request_context('/'):
+                overload._start_refresh('other')
+            self.assertEqual(list(overload._refreshing), ['busy'])
+        finally:
+            overload._refreshing.pop('busy')
+
+    def test_renders_without_a_stored_copy(self):
+        """Are pages never seen before still rendered when overloaded?"""
+
+        self.slow_database()
+        resp = self.get(f'/users/{self.writer_id}')
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('Warning', resp.headers)
+        self.assertIn(b"first warble", resp.data)
+
+    def test_sheds_search(self):
+        """Are searches refused with 503 when too many requests are busy?"""
+
+        app.config['OVERLOAD_RETRY_AFTER'] = 7
+        self.assertEqual(self.get('/users?q=writer').status_code, 200)
+
+        for _ in range(10):
+            overload.tracker.started()
+        resp = self.get('/users?q=writer')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '7')
+        self.assertEqual(self.get('/messages/search?q=warble').status_code,
+                         503)
+
+        # timelines aren't shed
+        self.assertEqual(self.get('/').status_code, 200)
@@ -0,0 +1,157 @@
+"""Concurrent read path tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_parallel.py
+
+
+from app import app, CURR_USER_KEY
+import os
+import threading
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, Follows, Likes
+import metrics
+import parallel
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class GatherTests(TestCase):
+
+    def tearDown(self):
+        app.config['PARALLEL_READS'] = 'auto'
+
+    def test_modes(self):
+        """Are results returned in order in every mode?"""
+
+        for mode in ('off', 'threads'):
+            app.config['PARALLEL_READS'] = mode
+            with app.app_context():
+                self.assertEqual(
+                    parallel.gather(lambda: 1, lambda: 2, lambda: 3),
+                    [1, 2, 3])
+
+    def test_errors_propagate(self):
+        app.config['PARALLEL_READS'] = 'threads'
+        with app.app_context():
+            with self.assertRaises(ZeroDivisionError):
+                parallel.gather(lambda: 1, lambda: 1 / 0)
+
+    def test_leaves_request_session_alone(self):
+        """Is the caller's unfinished work left uncommitted?"""
+
+        app.config['PARALLEL_READS'] = 'threads'
+        with app.app_context():
+            db.session.add(User(email="half@test.com", username="half",
+                                password="HASHED_PASSWORD"))
+            db.session.flush()
+            parallel.gather(lambda: 1, lambda: 2)
+            db.session.rollback()
+            self.assertIsNone(User.query.filter_by(username='half').first())
+
+    def test_request_connection_released(self):
+        """Once the caller commits, is no connection held while it waits?"""
+
+        app.config['PARALLEL_READS'] = 'threads'
+        checked_out = [0]
+        seen = []
+        barrier = threading.Barrier(2, timeout=10)
+
+        def checkout(*args):
+            checked_out[0] += 1
+
+        def checkin(*args):
+            checked_out[0] -= 1
+
+        def read():
+            db.session.execute('SELECT 1')
+            barrier.wait()
+            seen.append(checked_out[0])
+            barrier.wait()
+
+        with app.app_context():
+            pool = db.engine.pool
+            event.listen(pool, 'checkout', checkout)
+            event.listen(pool, 'checkin', checkin)
+            try:
+                db.session.execute('SELECT 1')
+                db.session.commit()
+                parallel.gather(read, read)
+            finally:
+                event.remove(pool, 'checkout', checkout)
+                event.remove(pool, 'checkin', checkin)
+
+        self.assertEqual(seen, [2, 2])
+
+    def test_queries_counted(self):
+        """Do queries on other threads count toward the request?"""
+
+        app.config['PARALLEL_READS'] = 'threads'
+        with app.app_context():
+            metrics.count_queries()
+            parallel.gather(lambda: db.session.execute('SELECT 1'),
+                            lambda: db.session.execute('SELECT 2'))
+            self.assertEqual(metrics.counted_queries(), 2)
+
+    def test_unknown_mode(self):
+        app.config['PARALLEL_READS'] = 'bogus'
+        with app.app_context():
+            with self.assertRaises(ValueError):
+                parallel.gather(lambda: 1, lambda: 2)
+
+
+class ConcurrentPageTests(TestCase):
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.author = User(email="test@test.com", username="author",
+                           password="HASHED_PASSWORD")
+        self.reader = User(email="test2@test.com", username="reader",
+                           password="HASHED_PASSWORD")
+        db.session.add_all([self.author, self.reader])
+        db.session.commit()
+        self.reader.following.append(self.author)
+        self.author.messages.append(Message(text="gathered warble"))
+        db.session.commit()
+
+        self.author_id = self.author.id
+        self.reader_id = self.reader.id
+        app.config['PARALLEL_READS'] = 'threads'
+
+    def tearDown(self):
+        app.config['PARALLEL_READS'] = 'auto'
+        db.session.rollback()
+
+    def test_home(self):
+        """Does the home page render queries run on other threads?"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader_id
+            resp = client.get('/')
+            html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('gathered warble', html)
+        self.assertIn('href="/users/%s/following">1<' % self.reader_id,
+                      html.replace('\n', '').replace(' ', ''))
+
+    def test_profile_counts(self):
+        with app.test_client() as client:
+            resp = client.get(f'/users/{self.author_id}')
+            html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('gathered warble', html)
+        self.assertIn('@author', html)
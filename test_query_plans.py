@@ -0,0 +1,255 @@
+"""Query plan regression tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+#
+# After an intended plan change, rewrite the snapshots with:
+#
+#    UPDATE_PLAN_SNAPSHOTS=1 python -m unittest test_query_plans.py
+#
+# Snapshots are kept per database under plan_snapshots/, for SQLite and
+# Postgres. A missing one fails the test, as does running against a
+# database with no snapshots at all.
+
+
+from app import app, CURR_USER_KEY
+import difflib
+import os
+from csv import DictReader
+from datetime import datetime
+from unittest import TestCase
+
+from author_cache import author_cards
+from cache import cache
+from models import (db, User, Message, Likes, Follows, SearchPosting,
+                    MessageTag, MessageMention, TrendingBucket,
+                    TrendingMessage, LikeCountShard)
+import paging
+import query_plans
+import search
+import tags
+import trending
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# run background jobs as they're queued
+app.config['JOBS_WORKERS'] = 0
+
+db.create_all()
+
+SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'plan_snapshots')
+
+# tables no route may read in full
+LARGE_TABLES = {'messages', 'likes', 'follows', 'search_postings',
+                'message_tags', 'message_mentions', 'trending_buckets'}
+
+# (name, method, path) of each route checked; {user}, {other} and
+# {message} are filled in from the seeded data, {cursor} with CURSOR
+ROUTES = [
+    ('homepage', 'GET', '/'),
+    ('homepage_older', 'GET', '/?before={cursor}'),
+    ('users_show', 'GET', '/users/{user}'),
+    ('show_following', 'GET', '/users/{user}/following'),
+    ('users_followers', 'GET', '/users/{user}/followers'),
+    ('likes_detail', 'GET', '/users/{user}/likes'),
+    ('list_users_search', 'GET', '/users?q=smith'),
+    ('messages_show', 'GET', '/messages/{message}'),
+    ('messages_search', 'GET', '/messages/search?q=field+seat'),
+    ('tag_timeline', 'GET', '/tags/seed'),
+    ('mention_timeline', 'GET', '/users/{user}/mentions'),
+    ('messages_trending', 'GET', '/trending'),
+    ('messages_add', 'POST', '/messages/new'),
+    ('add_like', 'POST', '/users/add_like/{message}'),
+    ('follow', 'POST', '/users/follow/{other}'),
+]
+
+# any cursor gives the older-page query its shape
+CURSOR = paging.encode_cursor(datetime(2017, 6, 1), 0)
+
+# indexes a route's plans must use
+EXPECTED_INDEXES = {
+    'homepage': {'ix_messages_user_id_timestamp'},
+    'homepage_older': {'ix_messages_user_id_timestamp'},
+    'users_show': {'ix_messages_user_id_timestamp'},
+    'tag_timeline': {'ix_message_tags_tag_timestamp'},
+    'mention_timeline': {'ix_message_mentions_user_id_timestamp'},
+}
+
+
+def seed():
+    """Load generator/ users, messages and follows, plus likes and tags."""
+
+    if db.engine.dialect.name == 'postgresql':
+        # new, empty tables, so the plans don't depend on what earlier runs
+        # and tests left behind
+        db.session.execute('TRUNCATE {} RESTART IDENTITY'.format(
+            ', '.join(table.name for table in db.metadata.sorted_tables)))
+    else:
+        for model in (SearchPosting, MessageTag, MessageMention,
+                      TrendingMessage, TrendingBucket, LikeCountShard, Likes,
+                      Follows, Message, User):
+            model.query.delete()
+    db.session.commit()
+
+    with open('generator/users.csv') as f:
+        db.session.bulk_insert_mappings(User, DictReader(f))
+    db.session.commit()
+    user_ids = [user_id for (user_id,)
+                in db.session.query(User.id).order_by(User.id)]
+
+    with open('generator/follows.csv') as f:
+        db.session.bulk_insert_mappings(Follows, [
+            dict(user_being_followed_id=user_ids[int(row[
+                     'user_being_followed_id']) - 1],
+                 user_following_id=user_ids[int(row['user_following_id']) - 1])
+            for row in DictReader(f)])
+
+    with open('generator/messages.csv') as f:
+        rows = list(DictReader(f))
+    # every tenth message is tagged, every twentieth mentions someone
+    msgs = [Message(text=(row['text'][:100]
+                          + (' #seed' if i % 10 == 0 else '')
+                          + (' @' + 'user_mention' if i % 20 == 0 else '')),
+                    timestamp=datetime.fromisoformat(row['timestamp']),
+                    user_id=user_ids[int(row['user_id']) - 1])
+            for i, row in enumerate(rows)]
+    db.session.add_all(msgs)
+    db.session.commit()
+
+    db.session.bulk_insert_mappings(Likes, [
+        dict(user_id=user_ids[(i * 7) % len(user_ids)], message_id=msg.id)
+        for i, msg in enumerate(msgs) if i % 3 == 0])
+    search.index_messages(msgs)
+    tags.index_messages(msgs)
+    db.session.commit()
+    trending.refresh_trending()
+
+    if db.engine.dialect.name == 'postgresql':
+        # statistics and visibility maps as settled, not as autovacuum
+        # happens to have left them
+        with db.engine.connect() as conn:
+            (conn.execution_options(isolation_level='AUTOCOMMIT')
+             .execute('VACUUM ANALYZE'))
+
+
+class QueryPlanTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        seed()
+        # the most followed-about user, and someone they don't follow
+        cls.user_id = (db.session
+                       .query(Follows.user_following_id)
+                       .group_by(Follows.user_following_id)
+                       .order_by(db.func.count().desc(),
+                                 Follows.user_following_id)
+                       .first()[0])
+        User.query.get(cls.user_id).username = 'user_mention'
+        db.session.commit()
+        followed = {user_id for (user_id,) in (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == cls.user_id))}
+        cls.other_id = (db.session.query(User.id)
+                        .filter(~User.id.in_(followed | {cls.user_id}))
+                        .order_by(User.id)
+                        .first()[0])
+        cls.message_id = (db.session.query(Message.id)
+                          .filter(Message.user_id == cls.other_id)
+                          .order_by(Message.id)
+                          .first()[0])
+        cls.dialect = db.engine.dialect.name
+
+    def capture(self, method, path):
+        # cached authors and pages would leave queries out of the plans
+        cache.clear()
+        author_cards.clear()
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            path = path.format(user=self.user_id, other=self.other_id,
+                               message=self.message_id, cursor=CURSOR)
+
+            data = {'text': 'checking #plans'} if method == 'POST' else None
+            with query_plans.captured_queries() as queries:
+                resp = client.open(path, method=method, data=data)
+            self.assertLess(resp.status_code, 400, path)
+        return queries
+
+    def compare_snapshot(self, name, text):
+        directory = os.path.join(SNAPSHOT_DIR, self.dialect)
+        path = os.path.join(directory, f'{name}.txt')
+        if os.environ.get('UPDATE_PLAN_SNAPSHOTS'):
+            os.makedirs(directory, exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(text)
+            return
+
+        if not os.path.isdir(directory):
+            self.fail(f"no {self.dialect} plan snapshots are checked in; "
+                      f"write them with UPDATE_PLAN_SNAPSHOTS=1 and commit "
+                      f"{directory}")
+        if not os.path.exists(path):
+            self.fail(f"no plan snapshot for {name}; write it with "
+                      f"UPDATE_PLAN_SNAPSHOTS=1 and commit {path}")
+
+        with open(path) as f:
+            expected = f.read()
+        if text != expected:
+            diff = ''.join(difflib.unified_diff(
+                expected.splitlines(True), text.splitlines(True),
+                f'{path} (snapshot)', f'{name} (now)'))
+            self.fail(f"query plans of {name} changed; if that's intended, "
+                      f"rerun with UPDATE_PLAN_SNAPSHOTS=1\n{diff}")
+
+    def test_route_plans(self):
+        """Do route queries use indexes, and match their snapshots?"""
+
+        for name, method, path in ROUTES:
+            with self.subTest(route=name):
+                queries = self.capture(method, path)
+                plans = query_plans.explain_all(db.engine, queries)
+                self.assertTrue(plans)
+
+                for sql, lines in plans:
+                    scanned = query_plans.full_scans(lines, self.dialect)
+                    self.assertFalse(
+                        scanned & LARGE_TABLES,
+                        f"{name} reads whole tables:\n{sql}\n"
+                        + '\n'.join(lines))
+
+                used = set().union(*(
+                    query_plans.indexes_used(lines, self.dialect)
+                    for _, lines in plans))
+                self.assertLessEqual(EXPECTED_INDEXES.get(name, set()), used)
+
+                self.compare_snapshot(name, query_plans.format_plans(plans))
+
+    def test_full_scan_detection(self):
+        """Are full scans and indexes recognized in each dialect's plans?"""
+
+        self.assertEqual(
+            query_plans.full_scans(['SCAN messages',
+                                    'SEARCH likes USING INDEX ix (a=?)'],
+                                   'sqlite'),
+            {'messages'})
+        self.assertEqual(
+            query_plans.indexes_used(['SEARCH likes USING COVERING INDEX '
+                                      'ix_likes (a=?)'], 'sqlite'),
+            {'ix_likes'})
+        self.assertEqual(
+            query_plans.full_scans(['->  Seq Scan on follows',
+                                    'Index Scan using ix_m on messages'],
+                                   'postgresql'),
+            {'follows'})
+        self.assertEqual(
+            query_plans.indexes_used(['Index Only Scan Backward using '
+                                      'ix_m on messages'], 'postgresql'),
+            {'ix_m'})
+        self.assertEqual(query_plans.normalize("id = 42 AND name = 'x'"),
+                         "id = N AND name = ?")
+        self.assertEqual(query_plans.normalize("id IN (?, ?, ?)"),
+                         "id IN (...)")
@@ -0,0 +1,133 @@
+"""Message search tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+
+from app import app, CURR_USER_KEY
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Likes, Follows, SearchPosting
+import search
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# run background jobs as they're queued
+app.config['JOBS_WORKERS'] = 0
+
+db.create_all()
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        SearchPosting.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        user = User(email="test@test.com", username="testuser",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+    def add(self, text, days_ago=0):
+        msg = Message(text=text, user_id=self.user_id,
+                      timestamp=datetime(2020, 1, 10) - timedelta(days_ago))
+        db.session.add(msg)
+        db.session.flush()
+        search.index_messages([msg])
+        db.session.commit()
+        return msg.id
+
+    def found(self, query, **kwargs):
+        page = search.search(query, **kwargs)
+        return [result.message.id for result in page.results]
+
+    def test_terms(self):
+        """Is text split into lowercase words with counts?"""
+
+        self.assertEqual(search.terms("Tea, TEA and a #cake!"),
+                         {'tea': 2, 'and': 1, 'cake': 1})
+
+    def test_ranking(self):
+        """Do messages with more of the terms come first, then newer ones?"""
+
+        old_both = self.add("green tea", days_ago=3)
+        tea = self.add("tea time", days_ago=2)
+        new_both = self.add("tea, green and hot", days_ago=1)
+        newest_tea = self.add("more tea")
+        self.add("coffee only")
+
+        self.assertEqual(self.found("green tea"),
+                         [new_both, old_both, newest_tea, tea])
+        self.assertEqual(self.found("TEA"),
+                         [newest_tea, new_both, tea, old_both])
+
+        # each time a term appears counts
+        teas = self.add("tea? tea! TEA", days_ago=5)
+        self.assertEqual(self.found("green tea")[:2], [teas, new_both])
+        self.assertEqual(search.search("tea").results[0].score, 3)
+        self.assertEqual(self.found("nothing"), [])
+        self.assertEqual(self.found("!!"), [])
+
+    def test_cursor_paging(self):
+        """Do cursors walk every result exactly once?"""
+
+        ids = [self.add(f"warble number {i}", days_ago=i % 3)
+               for i in range(7)]
+
+        seen = []
+        cursor = None
+        while True:
+            page = search.search("warble", cursor=cursor, limit=3)
+            seen.extend(result.message.id for result in page.results)
+            cursor = page.cursor
+            if cursor is None:
+                break
+
+        self.assertEqual(sorted(seen), sorted(ids))
+        self.assertEqual(len(seen), len(set(seen)))
+
+        with self.assertRaises(ValueError):
+            search.search("warble", cursor="garbage")
+
+    def test_views_keep_index_current(self):
+        """Do adding and deleting messages update the index?"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            client.post('/messages/new', data={"text": "searchable warble"})
+            self.assertEqual(len(self.found("searchable")), 1)
+
+            resp = client.get('/messages/search?q=searchable')
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"searchable warble", resp.data)
+
+            msg_id = self.found("searchable")[0]
+            client.post(f'/messages/{msg_id}/delete')
+            self.assertEqual(self.found("searchable"), [])
+            self.assertEqual(SearchPosting.query.count(), 0)
+
+            resp = client.get('/messages/search?q=x&cursor=bad')
+            self.assertEqual(resp.status_code, 400)
+
+    def test_reindex(self):
+        """Does reindexing rebuild postings from message text?"""
+
+        db.session.add(Message(text="imported warble", user_id=self.user_id))
+        db.session.commit()
+        indexed = self.add("indexed warble")
+
+        self.assertEqual(search.reindex(batch_size=1), 2)
+        self.assertEqual(len(self.found("warble")), 2)
+        self.assertEqual(self.found("indexed"), [indexed])
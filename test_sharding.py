@@ -0,0 +1,157 @@
+"""Sharding tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sharding.py
+
+
+from app import create_app
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import models
+from models import db, User, Message, Likes, ShardBucket
+import sharding
+
+
+class ShardingTests(TestCase):
+
+    def setUp(self):
+        self.db_app = models.db.app
+        self.directory = tempfile.mkdtemp()
+        self.app = self.make_app(2)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+
+        self.users = [User(email=f"u{i}@test.com", username=f"user{i}",
+                           password="HASHED_PASSWORD") for i in range(6)]
+        db.session.add_all(self.users)
+        db.session.commit()
+        self.user_ids = [user.id for user in self.users]
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+        models.db.app = self.db_app
+        shutil.rmtree(self.directory)
+
+    def make_app(self, shards):
+        return create_app({
+            'SQLALCHEMY_DATABASE_URI':
+                f'sqlite:///{self.directory}/primary.db',
+            'SHARD_DATABASE_URLS': [f'sqlite:///{self.directory}/shard{i}.db'
+                                    for i in range(shards)],
+            'SHARD_MAP_SECONDS': 0,
+            'PARALLEL_READS': 'threads',
+        })
+
+    def test_messages_live_on_their_authors_shard(self):
+        """Are messages written to, and found on, the author's shard?"""
+
+        sharding.init_shards()
+        ids = {user_id: sharding.add_message(user_id, f"hi from {user_id}")
+               for user_id in self.user_ids}
+
+        self.assertEqual(len(set(ids.values())), len(ids))
+        for user_id, message_id in ids.items():
+            shard = sharding.shard_for(user_id)
+            self.assertEqual(message_id % sharding.MAX_SHARDS, shard)
+            self.assertEqual(sharding.find_message(message_id).user_id,
+                             user_id)
+        self.assertIsNone(sharding.find_message(123456789))
+
+    def test_timeline_fans_in_across_shards(self):
+        """Is a timeline merged newest first over every shard, in pages?"""
+
+        sharding.init_shards()
+        start = datetime(2020, 1, 1)
+        expected = []
+        for minute in range(12):
+            user_id = self.user_ids[minute % len(self.user_ids)]
+            expected.append(sharding.add_message(
+                user_id, f"minute {minute}",
+                timestamp=start + timedelta(minutes=minute)))
+        expected.reverse()
+
+        self.assertEqual(
+            len({sharding.shard_for(user_id) for user_id in self.user_ids}),
+            2)
+
+        seen, before = [], None
+        while True:
+            rows, before = sharding.timeline(self.user_ids, before, limit=5)
+            seen.extend(row.id for row in rows)
+            if before is None:
+                break
+        self.assertEqual(seen, expected)
+
+        rows, _ = sharding.timeline(self.user_ids[:1])
+        self.assertEqual({row.user_id for row in rows}, {self.user_ids[0]})
+
+    def test_init_copies_primary_data(self):
+        """Are existing messages and likes copied to the right shards?"""
+
+        msg = Message(text="from before sharding", user_id=self.user_ids[0])
+        db.session.add(msg)
+        db.session.commit()
+        db.session.add(Likes(user_id=self.user_ids[1], message_id=msg.id))
+        db.session.commit()
+
+        self.assertEqual(sharding.init_shards(), 1)
+        self.assertEqual(sharding.find_message(msg.id).text,
+                         "from before sharding")
+        self.assertEqual(sharding.liked_ids(self.user_ids[1]), [msg.id])
+
+        # new ids don't collide with copied ones
+        self.assertGreater(sharding.add_message(self.user_ids[0], "new"),
+                           msg.id)
+
+    def test_rebalance_onto_new_shard(self):
+        """Does adding a shard move an even share of buckets and data?"""
+
+        sharding.init_shards()
+        ids = [sharding.add_message(user_id, "before the move")
+               for user_id in self.user_ids]
+        sharding.add_like(self.user_ids[0], ids[1])
+
+        db.session.remove()
+        self.ctx.pop()
+        self.app = self.make_app(3)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        sharding.init_shards(copy_primary=False)
+
+        moves = sharding.rebalance(wait=0)
+        self.assertGreater(moves, 0)
+
+        per_shard = {}
+        for bucket in ShardBucket.query:
+            self.assertFalse(bucket.read_only)
+            per_shard[bucket.shard] = per_shard.get(bucket.shard, 0) + 1
+        self.assertEqual(sorted(per_shard.values()), [85, 85, 86])
+
+        for user_id, message_id in zip(self.user_ids, ids):
+            self.assertEqual(sharding.find_message(message_id).user_id,
+                             user_id)
+        rows, _ = sharding.timeline(self.user_ids)
+        self.assertEqual(sorted(row.id for row in rows), sorted(ids))
+        self.assertEqual(sharding.liked_ids(self.user_ids[0]), [ids[1]])
+
+        # balanced already
+        self.assertEqual(sharding.rebalance(wait=0), 0)
+
+    def test_writes_wait_while_moving(self):
+        """Are writes to a bucket that is being moved refused?"""
+
+        sharding.init_shards()
+        user_id = self.user_ids[0]
+        bucket = ShardBucket.query.get(sharding.bucket_for(user_id))
+        bucket.read_only = True
+        db.session.commit()
+
+        with self.assertRaises(sharding.ShardMoving):
+            sharding.add_message(user_id, "not now")
+        sharding.timeline([user_id])
@@ -0,0 +1,103 @@
+"""Who-to-follow suggestion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_suggestions.py
+
+
+from app import app
+import os
+from unittest import TestCase
+
+from models import db, User, Follows, FollowSuggestions
+from suggestions import follow_matrix, compute_suggestions, \
+    refresh_suggestions
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+db.create_all(app=app)
+
+
+def collect(batches):
+    """Return {user: [suggested, ...]} from compute_suggestions output."""
+
+    found = {}
+    for users, ranks, suggested, scores in batches:
+        for u, r, s in sorted(zip(users.tolist(), ranks.tolist(),
+                                  suggested.tolist())):
+            found.setdefault(u, []).append(s)
+    return found
+
+
+class ComputeSuggestionsTests(TestCase):
+
+    def test_friends_of_friends(self):
+        """Are friends of friends ranked by mutual follows, then popularity?"""
+
+        # 0 follows 1 and 2; 1 and 2 both follow 3; 1 follows 4; 5 follows 4
+        edges = [(0, 1), (0, 2), (1, 3), (2, 3), (1, 4), (5, 4), (2, 0)]
+        adjacency = follow_matrix([a for a, b in edges],
+                                  [b for a, b in edges], 6)
+
+        found = collect(compute_suggestions(adjacency, batch_size=2))
+        self.assertEqual(found[0], [3, 4])
+        # never suggest yourself or people you already follow
+        self.assertEqual(found[2], [1])
+        self.assertNotIn(5, found)
+
+    def test_top_k(self):
+        """Is each user limited to k suggestions?"""
+
+        edges = [(0, 1)] + [(1, n) for n in range(2, 10)]
+        adjacency = follow_matrix([a for a, b in edges],
+                                  [b for a, b in edges], 10)
+        found = collect(compute_suggestions(adjacency, [0], k=3))
+        self.assertEqual(len(found[0]), 3)
+
+
+class RefreshSuggestionsTests(TestCase):
+
+    def setUp(self):
+        FollowSuggestions.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.users = [User(email=f"test{i}@test.com", username=f"testuser{i}",
+                           password="HASHED_PASSWORD") for i in range(3)]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def test_refresh(self):
+        """Are suggestions stored and served by User.suggestions()?"""
+
+        u0, u1, u2 = self.users
+        u0.following.append(u1)
+        u1.following.append(u2)
+        db.session.commit()
+
+        self.assertEqual(refresh_suggestions(), 1)
+        self.assertEqual(u0.suggestions(), [u2])
+        self.assertEqual(u1.suggestions(), [])
+
+    def test_refresh_some_users(self):
+        """Are old suggestions dropped for users who no longer get any?"""
+
+        u0, u1, u2 = self.users
+        u0.following.append(u1)
+        u1.following.append(u2)
+        db.session.commit()
+        refresh_suggestions()
+
+        # u3 is past every follow, so outside the matrix
+        u3 = User(email="test3@test.com", username="testuser3",
+                  password="HASHED_PASSWORD")
+        db.session.add(u3)
+        db.session.commit()
+        db.session.add(FollowSuggestions(user_id=u3.id, rank=0,
+                                         suggested_user_id=u1.id, score=1))
+        u0.following.remove(u1)
+        db.session.commit()
+
+        self.assertEqual(refresh_suggestions([u0.id, u3.id]), 0)
+        self.assertEqual(u0.suggestions(), [])
+        self.assertEqual(u3.suggestions(), [])
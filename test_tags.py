@@ -0,0 +1,120 @@
+"""Tag and mention tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_tags.py
+
+
+from app import app, CURR_USER_KEY
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import (db, User, Message, Likes, Follows, MessageTag,
+                    MessageMention)
+import tags
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# run background jobs as they're queued
+app.config['JOBS_WORKERS'] = 0
+
+db.create_all()
+
+
+class TagTests(TestCase):
+
+    def setUp(self):
+        MessageTag.query.delete()
+        MessageMention.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.alice = User(email="alice@test.com", username="alice",
+                          password="HASHED_PASSWORD")
+        self.bob = User(email="bob@test.com", username="bob",
+                        password="HASHED_PASSWORD")
+        db.session.add_all([self.alice, self.bob])
+        db.session.commit()
+        self.alice_id, self.bob_id = self.alice.id, self.bob.id
+
+    def add(self, text, minutes_ago=0):
+        msg = Message(text=text, user_id=self.alice_id,
+                      timestamp=datetime(2020, 1, 1)
+                      - timedelta(minutes=minutes_ago))
+        db.session.add(msg)
+        db.session.flush()
+        tags.index_messages([msg])
+        db.session.commit()
+        return msg.id
+
+    def test_parse(self):
+        """Are tags lowercased and emails left alone?"""
+
+        self.assertEqual(
+            tags.parse("#Python and #flask, ask @bob or bob@x.com #py-thon"),
+            ({'python', 'flask', 'py'}, {'bob'}))
+
+    def test_tag_timeline_pages(self):
+        """Do tag timelines page newest first through every message?"""
+
+        ids = [self.add(f"post {i} #Tea", minutes_ago=i) for i in range(5)]
+        self.add("no tags here")
+
+        first, before = tags.tag_timeline('TEA', limit=2)
+        second, before = tags.tag_timeline('tea', before, limit=2)
+        third, before = tags.tag_timeline('tea', before, limit=2)
+
+        self.assertEqual([msg.id for msg in first + second + third], ids)
+        self.assertIsNone(before)
+
+    def test_mentions(self):
+        """Are mentions of real users recorded, and unknown ones dropped?"""
+
+        mention = self.add("hi @bob and @nobody")
+        self.add("hi everyone")
+
+        messages, before = tags.mention_timeline(self.bob_id)
+        self.assertEqual([msg.id for msg in messages], [mention])
+        self.assertEqual(MessageMention.query.count(), 1)
+
+    def test_views(self):
+        """Do new and deleted messages update the tag pages?"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.alice_id
+
+            client.post('/messages/new', data={"text": "cake time #Baking"})
+            resp = client.get('/tags/baking')
+            self.assertIn(b'<a href="/tags/baking">#Baking</a>', resp.data)
+
+            client.post('/messages/new', data={"text": "@bob <b>hi</b>"})
+            resp = client.get(f'/users/{self.bob_id}/mentions')
+            self.assertIn(b"&lt;b&gt;hi&lt;/b&gt;", resp.data)
+
+            msg_id = MessageTag.query.one().message_id
+            client.post(f'/messages/{msg_id}/delete')
+            self.assertEqual(MessageTag.query.count(), 0)
+
+            resp = client.get('/tags/baking?before=nonsense')
+            self.assertEqual(resp.status_code, 400)
+
+    def test_backfill(self):
+        """Does the backfill index messages written before tags existed?"""
+
+        db.session.add(Message(text="old #news for @bob",
+                               user_id=self.alice_id))
+        db.session.commit()
+
+        self.assertEqual(tags.backfill(batch_size=1), 1)
+        self.assertEqual(len(tags.tag_timeline('news')[0]), 1)
+        self.assertEqual(len(tags.mention_timeline(self.bob_id)[0]), 1)
+
+        # running it again doesn't duplicate anything
+        tags.backfill()
+        self.assertEqual(MessageTag.query.count(), 1)
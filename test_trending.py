@@ -0,0 +1,87 @@
+"""Trending messages tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+from app import app
+import os
+from unittest import TestCase
+
+from models import db, User, Message, TrendingBucket, TrendingMessage
+import trending
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+NOW = 1700000000
+
+
+class TrendingTests(TestCase):
+
+    def setUp(self):
+        TrendingMessage.query.delete()
+        TrendingBucket.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        user = User(email="test@test.com", username="testuser",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+
+        self.msgs = [Message(text=f"message {i}", user_id=user.id)
+                     for i in range(3)]
+        db.session.add_all(self.msgs)
+        db.session.commit()
+
+    def test_record_like(self):
+        """Are likes counted into the current bucket?"""
+
+        m0 = self.msgs[0].id
+        trending.record_like(m0, now=NOW)
+        trending.record_like(m0, now=NOW)
+        trending.record_like(m0, -1, now=NOW)
+        db.session.commit()
+
+        bucket = TrendingBucket.query.one()
+        self.assertEqual(bucket.bucket, trending.current_bucket(NOW))
+        self.assertEqual(bucket.likes, 1)
+
+    def test_refresh_window(self):
+        """Are only likes inside the window ranked, and old buckets dropped?"""
+
+        m0, m1, m2 = [m.id for m in self.msgs]
+        window = trending.BUCKET_SECONDS * trending.WINDOW_BUCKETS
+
+        for _ in range(3):
+            trending.record_like(m0, now=NOW - window)
+        trending.record_like(m1, now=NOW)
+        trending.record_like(m2, now=NOW - trending.BUCKET_SECONDS)
+        trending.record_like(m2, now=NOW)
+        db.session.commit()
+
+        self.assertEqual(trending.refresh_trending(now=NOW), 2)
+        top = trending.trending_messages()
+        self.assertEqual([(t.message_id, t.likes) for t in top],
+                         [(m2, 2), (m1, 1)])
+        self.assertEqual(TrendingBucket.query.filter_by(message_id=m0).count(),
+                         0)
+
+    def test_trending_page(self):
+        """Does /trending show the stored list?"""
+
+        trending.record_like(self.msgs[1].id)
+        db.session.commit()
+        trending.refresh_trending()
+
+        resp = app.test_client().get('/trending')
+        html = resp.get_data(as_text=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('message 1', html)
+        self.assertIn('1 like<', html)
+        self.assertNotIn('message 0', html)
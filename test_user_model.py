@@ -9,7 +9,7 @@ from app import app
 import os
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes, UserDeletion
 import psycopg2.errors as psy2_E
 
 # BEFORE we import our app, let's set an environmental variable
@@ -169,3 +169,36 @@ class UserModelTestCase(TestCase):
         # Does it return False if given a wrong username
         auth_user = User.authenticate(username="not_a_valid_user", password=pw)
         self.assertEqual(auth_user, False)
+
+    def test_bulk_delete(self):
+        """Does User.bulk_delete remove the user, their messages and links?"""
+
+        u1 = User(email="test@test.com", username="testuser1",
+                  password="u1_PASSWORD")
+        u2 = User(email="test1@test.com", username="testuser2",
+                  password="u2_PASSWORD")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        msgs = [Message(text=f"message {i}", user_id=u1.id) for i in range(5)]
+        db.session.add_all(msgs)
+        db.session.add(Follows(user_following_id=u2.id,
+                               user_being_followed_id=u1.id))
+        db.session.commit()
+        db.session.add(Likes(user_id=u2.id, message_id=msgs[0].id))
+        db.session.commit()
+
+        u1_id = u1.id
+        chunks = []
+        record = User.bulk_delete(u1_id, batch_size=2,
+                                  before_chunk=lambda: chunks.append(1))
+
+        # three chunks of messages, then one finding none left
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(record.messages_deleted, 5)
+        self.assertIsNotNone(record.finished_at)
+        self.assertEqual(User.query.filter_by(id=u1_id).count(), 0)
+        self.assertEqual(Message.query.filter_by(user_id=u1_id).count(), 0)
+        self.assertEqual(Likes.query.filter_by(user_id=u2.id).count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(UserDeletion.query.filter_by(user_id=u1_id).count(), 1)
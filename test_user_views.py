@@ -21,6 +21,9 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 app.config['WTF_CSRF_ENABLED'] = False
+
+# run background jobs as they're queued
+app.config['JOBS_WORKERS'] = 0
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
@@ -344,7 +347,7 @@ class UserViewsTests(TestCase):
                           follow_redirects=True)
             html = resp.get_data(as_text=True)
             self.assertEqual(resp.status_code, 200)
-            page_html = '''<p>A message from user 1</p>\n        </div>\n        \n        <form method="POST" action="/users/add_like/9" id="messages-form">\n'''
+            page_html = f'''<p>A message from user 1</p>\n          \n        </div>\n        \n        <form method="POST" action="/users/add_like/{self.msg.id}" id="messages-form">\n'''
             self.assertIn(page_html, html)
 
     def test_likes_detail(self):
@@ -0,0 +1,90 @@
+"""Trending messages: most likes received over a sliding time window.
+
+Likes are counted into fixed-size time buckets as they happen
+(`record_like`). `refresh_trending` sums the buckets still inside the
+window, stores the top TRENDING_SIZE messages in trending_messages and drops
+expired buckets, so the bucket table never holds more than one window of
+counts. Run it periodically with `flask refresh-trending`; the /trending
+page only reads the stored top list.
+"""
+
+from time import time
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from models import db, TrendingBucket, TrendingMessage
+
+BUCKET_SECONDS = 60 * 60
+WINDOW_BUCKETS = 24
+TRENDING_SIZE = 50
+
+
+def current_bucket(now=None):
+    """Bucket number for the time `now` (defaults to the present)."""
+
+    return int((time() if now is None else now) // BUCKET_SECONDS)
+
+
+def record_like(message_id, delta=1, now=None):
+    """Add `delta` likes for `message_id` to the current bucket.
+
+    Joins the caller's transaction; the caller commits.
+    """
+
+    bucket = current_bucket(now)
+    table = TrendingBucket.__table__
+    match = (table.c.bucket == bucket) & (table.c.message_id == message_id)
+    update = table.update().where(match).values(likes=table.c.likes + delta)
+
+    if db.session.execute(update).rowcount:
+        return
+
+    try:
+        with db.session.begin_nested():
+            db.session.execute(table.insert().values(
+                bucket=bucket, message_id=message_id, likes=delta))
+    except IntegrityError:
+        # another request created the row first
+        db.session.execute(update)
+
+
+def refresh_trending(now=None, size=TRENDING_SIZE):
+    """Recompute the stored top list and expire old buckets.
+
+    Returns the number of trending messages stored.
+    """
+
+    oldest = current_bucket(now) - WINDOW_BUCKETS + 1
+    total = func.sum(TrendingBucket.likes).label('total')
+    top = (db.session
+           .query(TrendingBucket.message_id, total)
+           .filter(TrendingBucket.bucket >= oldest)
+           .group_by(TrendingBucket.message_id)
+           .having(total > 0)
+           .order_by(total.desc(), TrendingBucket.message_id.desc())
+           .limit(size)
+           .all())
+
+    TrendingMessage.query.delete()
+    db.session.bulk_insert_mappings(TrendingMessage, [
+        dict(rank=rank, message_id=message_id, likes=likes)
+        for rank, (message_id, likes) in enumerate(top)
+    ])
+    (TrendingBucket.query
+     .filter(TrendingBucket.bucket < oldest)
+     .delete(synchronize_session=False))
+    db.session.commit()
+
+    return len(top)
+
+
+def trending_messages():
+    """Return the stored trending list as TrendingMessage rows."""
+
+    return (TrendingMessage
+            .query
+            .join(TrendingMessage.message)
+            .options(db.contains_eager(TrendingMessage.message))
+            .order_by(TrendingMessage.rank)
+            .all())